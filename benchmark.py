@@ -0,0 +1,363 @@
+# Benchmarks the render, rename and check stages on a synthetic sheet, using fake_renderer.py in place of the
+# renderer and a local stand-in for the wiki, so it runs without a JVM, a cache or network access
+import argparse
+import contextlib
+import csv
+import hashlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+from equipped_render import EquippedRender
+from fake_renderer import make_png
+from renderer import DEFAULT_SHARD_SIZE, WORKER_TYPES, validate_worker_args
+from scheduler import DEFAULT_JOBS
+
+STAGES = ['render', 'pipeline', 'check', 'rename']
+# The pool renderer reading the sheet a row at a time, see create_renders.py --stream
+STREAM_MODE = 'pool-stream'
+RENDER_MODES = list(WORKER_TYPES.keys()) + [STREAM_MODE]
+# Render and rename at once like master_script.py --pipeline, with the whole sheet loaded first or streamed
+PIPELINE_MODES = ['pool', STREAM_MODE]
+RENAME_MODES = ['link', 'copy', 'move']
+CHECK_MODES = ['download', 'hash']
+PERCENTILES = [50, 90, 99]
+FAKE_RENDERER = Path(__file__).resolve().with_name('fake_renderer.py')
+DEFAULT_ROWS = 1000
+DEFAULT_STARTUP = 0.05
+DEFAULT_LATENCY = 0.002
+
+# Shape of the synthetic sheet: every Nth row is an infobox version of the row before it (same render, another
+# file name), and every Nth row is a head slot item, which also gets chatheads
+DUPLICATE_EVERY = 10
+HEAD_EVERY = 5
+EQUIP_SLOTS = [0, 1, 3, 4, 5, 7, 9, 10]
+# Every Nth wiki image is missing, and every Nth other one differs from the render
+MISSING_EVERY = 20
+CHANGED_EVERY = 7
+
+
+def write_sheet(path: Path, num_rows: int):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=EquippedRender.get_csv_headers(), dialect='excel')
+        writer.writeheader()
+        item_id = 10000
+        for row in range(num_rows):
+            if row % DUPLICATE_EVERY != 1:
+                item_id += 1
+            version = f'Version {row % DUPLICATE_EVERY}' if row % DUPLICATE_EVERY in (0, 1) else ''
+            name = f'Item {item_id}' + (f' ({version})' if version else '')
+            equip_slot = 0 if item_id % HEAD_EVERY == 0 else EQUIP_SLOTS[item_id % len(EQUIP_SLOTS)]
+            playerkit = [0, 0, 0, 0, 256 + item_id % 20, 0, 266, 267, 0, 273, 281, 0]
+            colorkit = [item_id % 7, item_id % 5, 0, 0, item_id % 3]
+            writer.writerow({
+                'item_id': item_id, 'page_name': f'Item {item_id}', 'infobox_version': version,
+                'male_file_name': f'[[File:{name} equipped male.png]]', 'male_playerkit': json.dumps(playerkit),
+                'male_colorkit': json.dumps(colorkit),
+                'female_file_name': f'[[File:{name} equipped female.png]]', 'female_playerkit': json.dumps(playerkit),
+                'female_colorkit': json.dumps(colorkit),
+                'zero_bitmap': json.dumps([1] * 12), 'equip_slot': equip_slot, 'pose_anim': 808, 'xan2d': 96,
+                'yan2d': 1, 'zan2d': 0})
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    # Serves /images/[md5]/[md5]/[name] with ETags, and the imageinfo query of api.php, out of wiki_dir
+    wiki_dir: Path = Path('.')
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes = b'', headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_file(self, name: str) -> Optional[bytes]:
+        path = self.wiki_dir.joinpath(name.replace(' ', '_'))
+        return path.read_bytes() if path.is_file() else None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith('api.php'):
+            self.send_imageinfo(parse_qs(url.query)['titles'][0].split('|'))
+            return
+        data = self.read_file(unquote(url.path.split('/')[-1]))
+        if data is None:
+            self.send_body(404)
+            return
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304)
+            return
+        self.send_body(200, data, {'ETag': etag, 'Content-Type': 'image/png'})
+
+    def send_imageinfo(self, titles: List[str]):
+        pages = []
+        for title in titles:
+            data = self.read_file(title[len('File:'):])
+            if data is None:
+                pages.append({'title': title, 'missing': True})
+            else:
+                pages.append({'title': title, 'imageinfo': [{'sha1': hashlib.sha1(data).hexdigest(),
+                                                             'size': len(data)}]})
+        self.send_body(200, json.dumps({'query': {'pages': pages}}).encode('utf-8'))
+
+
+def start_wiki(wiki_dir: Path) -> ThreadingHTTPServer:
+    handler = type('Handler', (WikiHandler,), {'wiki_dir': wiki_dir})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fill_wiki(infile: str, renders_dir: str, wiki_dir: Path):
+    # The wiki gets a copy of most renders, with some missing and some changed
+    from compiled_sheet import load_sheet
+    from kit_matrix import create_plan
+    wiki_dir.mkdir(parents=True, exist_ok=True)
+    with load_sheet(infile) as sheet:
+        plan = create_plan(sheet, None, None, None)
+    index = 0
+    for jobs in plan.jobs_by_key.values():
+        render_path = jobs[0].get_output_path(renders_dir)
+        for job in jobs:
+            index += 1
+            if not job.file_name or index % MISSING_EVERY == 0 or not render_path.is_file():
+                continue
+            path = wiki_dir.joinpath(job.file_name.replace(' ', '_'))
+            if index % CHANGED_EVERY == 0:
+                path.write_bytes(make_png(hashlib.md5(job.file_name.encode('utf-8')).digest()))
+            else:
+                shutil.copyfile(render_path, path)
+
+
+def timed(latencies: List[float], func: Callable) -> Callable:
+    # Wraps a stage's per item function to record how long each call takes
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+def get_render_result(trace: Any, seconds: float) -> Dict[str, Any]:
+    # From the trace, since a streamed run only hands back its failures
+    stats = trace.get_stats('render')
+    return {'items': stats.num_final, 'failed': stats.num_failed, 'seconds': seconds, 'latencies': stats.durations}
+
+
+def run_render(config: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    import create_renders
+    from run_trace import RunTrace
+    trace = RunTrace()
+    started = time.perf_counter()
+    if mode == STREAM_MODE:
+        # Nothing is read until the plan is rendered, so reading the sheet is part of rendering
+        plan = create_renders.load_stream_plan(config['infile'], None, None, None)
+    else:
+        plan = create_renders.load_plan(config['infile'], None, None, None)
+    plan_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    create_renders.render_plan(plan, config['cache'], config['outdir'], 'pool' if mode == STREAM_MODE else mode,
+                               config['jobs'], config['shard_size'], force=True, trace=trace)
+    return dict(get_render_result(trace, time.perf_counter() - started), plan_seconds=plan_seconds)
+
+
+def run_pipeline(config: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    import master_script
+    from run_trace import RunTrace
+    trace = RunTrace()
+    started = time.perf_counter()
+    master_script.run_pipeline(config['infile'], config['cache'], config['outdir'], None, None, None, 'pool',
+                               config['jobs'], config['shard_size'], True, None, 'link', trace=trace,
+                               stream=mode == STREAM_MODE)
+    return get_render_result(trace, time.perf_counter() - started)
+
+
+def run_rename(config: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    import rename_files
+    latencies = []
+    rename_files.rename_job_group = timed(latencies, rename_files.rename_job_group)
+    rename_files.create_outdir_tree(config['renamed_dir'])
+    started = time.perf_counter()
+    rename_files.rename_images(config['infile'], config['renders_dir'], config['renamed_dir'], None, None, None, mode)
+    return {'items': len(latencies), 'failed': 0, 'seconds': time.perf_counter() - started, 'latencies': latencies}
+
+
+def run_check(config: Dict[str, Any], mode: str) -> Dict[str, Any]:
+    import check_wiki_images
+    from run_trace import RunTrace
+    trace = RunTrace()
+    started = time.perf_counter()
+    report = check_wiki_images.run_jobs(config['infile'], config['cache'], config['renders_dir'], None, False,
+                                        max_connections=config['wiki_connections'], requests_per_second=0,
+                                        hash_check=mode == 'hash', trace=trace)
+    seconds = time.perf_counter() - started
+    counts = report.get_counts()
+    stats = trace.get_stats('check')
+    return {'items': stats.num_final, 'failed': counts[check_wiki_images.FAILED] + counts[check_wiki_images.ERROR],
+            'seconds': seconds, 'latencies': stats.durations}
+
+
+STAGE_RUNNERS = {'render': run_render, 'pipeline': run_pipeline, 'rename': run_rename, 'check': run_check}
+
+
+def run_case(stage: str, mode: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs in a fresh process so peak RSS belongs to this case alone. Output from the stage is thrown away.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        result = STAGE_RUNNERS[stage](config, mode)
+    latencies = result.pop('latencies')
+    percentiles = np.percentile(latencies, PERCENTILES).tolist() if latencies else [0.0] * len(PERCENTILES)
+    result.update({
+        'stage': stage, 'mode': mode,
+        'items_per_second': result['items'] / result['seconds'] if result['seconds'] else 0.0,
+        'latency_ms': {f'p{p}': value * 1000 for p, value in zip(PERCENTILES, percentiles)},
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    })
+    return result
+
+
+def run_isolated(stage: str, mode: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_case, stage, mode, config).result()
+
+
+def print_result(num_rows: int, result: Dict[str, Any]):
+    latency = result['latency_ms']
+    print(f'{num_rows:>7} {result["stage"]:<8} {result["mode"]:<11} {result["items"]:>7} {result["failed"]:>6} '
+          f'{result["seconds"]:>8.2f} {result["items_per_second"]:>9.1f} {latency["p50"]:>8.2f} '
+          f'{latency["p90"]:>8.2f} {latency["p99"]:>8.2f} {result["peak_rss_mb"]:>8.1f} '
+          f'{result["peak_child_rss_mb"]:>9.1f}')
+
+
+def run_benchmarks(workdir: Path, rows: List[int], stages: List[str], renderer_modes: List[str],
+                   rename_modes: List[str], check_modes: List[str], config: Dict[str, Any],
+                   pipeline_modes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    results = []
+    print(f'{"rows":>7} {"stage":<8} {"mode":<11} {"items":>7} {"failed":>6} {"seconds":>8} {"items/s":>9} '
+          f'{"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"rss MB":>8} {"child MB":>9}')
+    for num_rows in rows:
+        run_dir = workdir.joinpath(f'rows_{num_rows}')
+        run_dir.mkdir(parents=True, exist_ok=True)
+        infile = run_dir.joinpath('sheet.csv')
+        write_sheet(infile, num_rows)
+        cache = run_dir.joinpath('cache')
+        cache.mkdir(exist_ok=True)
+        case_config = dict(config, infile=str(infile), cache=str(cache))
+
+        def record(stage: str, mode: str, **paths: str):
+            result = run_isolated(stage, mode, dict(case_config, **paths))
+            result['rows'] = num_rows
+            results.append(result)
+            print_result(num_rows, result)
+
+        # Rename and check work on the renders of the first renderer mode, or of a pool run if render is skipped
+        render_modes = renderer_modes if 'render' in stages else []
+        for mode in render_modes:
+            record('render', mode, outdir=str(run_dir.joinpath(f'renders_{mode}')))
+        renders_dir = run_dir.joinpath(f'renders_{render_modes[0]}' if render_modes else 'renders')
+        if not render_modes and ('check' in stages or 'rename' in stages):
+            run_isolated('render', 'pool', dict(case_config, outdir=str(renders_dir)))
+
+        if 'pipeline' in stages:
+            for mode in pipeline_modes or PIPELINE_MODES:
+                # A fresh outdir each time, the pipeline renames into the outdir's _renamed dir
+                outdir = run_dir.joinpath(f'pipeline_{mode}')
+                shutil.rmtree(outdir, ignore_errors=True)
+                shutil.rmtree(f'{outdir}_renamed', ignore_errors=True)
+                record('pipeline', mode, outdir=str(outdir))
+
+        if 'check' in stages:
+            wiki_dir = run_dir.joinpath('wiki')
+            fill_wiki(str(infile), str(renders_dir), wiki_dir)
+            server = start_wiki(wiki_dir)
+            os.environ['WIKI_IMAGES_URL'] = f'http://127.0.0.1:{server.server_address[1]}/images'
+            os.environ['WIKI_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/api.php'
+            for mode in check_modes:
+                # Start every check from an empty mirror
+                shutil.rmtree(f'{renders_dir}_wiki', ignore_errors=True)
+                record('check', mode, renders_dir=str(renders_dir))
+            server.shutdown()
+
+        if 'rename' in stages:
+            # Move empties the renders dir, so it has to go last
+            for mode in sorted(rename_modes, key=lambda m: m == 'move'):
+                record('rename', mode, renders_dir=str(renders_dir),
+                       renamed_dir=str(run_dir.joinpath(f'renamed_{mode}')))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[DEFAULT_ROWS],
+                        help=f'Sheet sizes to benchmark. Default: {DEFAULT_ROWS}')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help='Stages to benchmark. Defaults to all of them.')
+    parser.add_argument('--renderer-modes', nargs='+', choices=RENDER_MODES, default=RENDER_MODES,
+                        help=f'Renderer modes to benchmark, {STREAM_MODE} is pool mode with the sheet streamed. '
+                             'Defaults to all.')
+    parser.add_argument('--pipeline-modes', nargs='+', choices=PIPELINE_MODES, default=PIPELINE_MODES,
+                        help='Renderer modes to benchmark rendering and renaming at once in. Defaults to both.')
+    parser.add_argument('--rename-modes', nargs='+', choices=RENAME_MODES, default=RENAME_MODES,
+                        help='Rename modes to benchmark. Defaults to all.')
+    parser.add_argument('--check-modes', nargs='+', choices=CHECK_MODES, default=CHECK_MODES,
+                        help='download fetches every wiki image, hash checks SHA-1s first. Defaults to both.')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help='Number of renderers to run at once. Defaults to the number of cores.')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Number of jobs per renderer launch in manifest mode. Default: {DEFAULT_SHARD_SIZE}')
+    parser.add_argument('--wiki-connections', type=int, default=8,
+                        help='Most requests to have open to the local wiki at once. Default: 8')
+    parser.add_argument('--startup', type=float, default=DEFAULT_STARTUP,
+                        help=f'Seconds the fake renderer takes to start. Default: {DEFAULT_STARTUP}')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help=f'Seconds the fake renderer takes per image. Default: {DEFAULT_LATENCY}')
+    parser.add_argument('--workdir', help='Folder for the sheets, renders and wiki. Defaults to a temporary folder '
+                                          'that is removed afterwards.')
+    parser.add_argument('--out', help='File to write the results to as json')
+    args = parser.parse_args()
+
+    if not validate_worker_args(args.jobs, args.shard_size):
+        exit(1)
+
+    # Every stage is run in a child process, which picks these up
+    os.environ['RENDERER_COMMAND'] = f'{sys.executable} {FAKE_RENDERER}'
+    os.environ['FAKE_RENDERER_STARTUP'] = str(args.startup)
+    os.environ['FAKE_RENDERER_LATENCY'] = str(args.latency)
+    os.environ.setdefault('USER_AGENT', 'osw_renders benchmark')
+
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='osw_renders_benchmark_'))
+    config = {'jobs': args.jobs, 'shard_size': args.shard_size, 'wiki_connections': args.wiki_connections}
+    try:
+        results = run_benchmarks(workdir, args.rows, args.stages, args.renderer_modes, args.rename_modes,
+                                 args.check_modes, config, args.pipeline_modes)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
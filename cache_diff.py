@@ -0,0 +1,79 @@
+# Find the items whose renders could have changed between two caches
+import argparse
+from pathlib import Path
+from typing import List
+
+from js5_cache import DAT_FILE, MODEL_INDEX, Js5Cache, get_item_model_ids
+
+
+def validate_args(old_cache: str, new_cache: str) -> bool:
+    for cache in (old_cache, new_cache):
+        if not Path(cache).joinpath(DAT_FILE).is_file():
+            print(f'Cannot find {DAT_FILE} in {cache}!')
+            return False
+    return True
+
+
+def get_changed_items(old_cache_dir: str, new_cache_dir: str) -> List[int]:
+    old_cache = Js5Cache(old_cache_dir)
+    new_cache = Js5Cache(new_cache_dir)
+    try:
+        old_items = old_cache.read_item_configs()
+        new_items = new_cache.read_item_configs()
+        old_models = old_cache.read_reference_table(MODEL_INDEX)
+        new_models = new_cache.read_reference_table(MODEL_INDEX)
+    finally:
+        old_cache.close()
+        new_cache.close()
+
+    changed_models = set()
+    for model_id, info in new_models.items():
+        old_info = old_models.get(model_id)
+        if old_info is None or (old_info.crc, old_info.version) != (info.crc, info.version):
+            changed_models.add(model_id)
+
+    changed_items = []
+    # Items whose definition could not be read to the end, so some of their models may not be known
+    incomplete_items = []
+    for item_id, data in new_items.items():
+        # An item changes if its own definition changed or any model it is rendered with did
+        if old_items.get(item_id) != data:
+            changed_items.append(item_id)
+            continue
+        model_ids, complete = get_item_model_ids(data)
+        if model_ids & changed_models:
+            changed_items.append(item_id)
+        elif not complete and changed_models:
+            # One of the models after where the parse stopped could have changed, so it is safer to render it
+            incomplete_items.append(item_id)
+    if incomplete_items:
+        print(f'Warning: {len(incomplete_items)} item definitions could not be read to the end, counting them as '
+              f'changed: {", ".join(str(item_id) for item_id in sorted(incomplete_items))}')
+        changed_items += incomplete_items
+    removed_items = sorted(set(old_items) - set(new_items))
+    if removed_items:
+        print(f'Warning: {len(removed_items)} items were removed from the cache, their renders are not deleted: '
+              f'{", ".join(str(item_id) for item_id in removed_items)}')
+    return sorted(changed_items)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--old-cache', required=True, help='Path to the cache the current renders were made with')
+    parser.add_argument('--new-cache', required=True, help='Path to the updated cache')
+    parser.add_argument('--out', default='changed_ids.txt',
+                        help='File to write the changed item ids to, usable as an --id-list. '
+                             'Default: changed_ids.txt')
+    args = parser.parse_args()
+
+    if not validate_args(args.old_cache, args.new_cache):
+        exit(1)
+
+    changed_items = get_changed_items(args.old_cache, args.new_cache)
+    print(f'{len(changed_items)} items changed')
+    with open(args.out, 'w') as f:
+        f.write(', '.join(str(item_id) for item_id in changed_items))
+
+
+if __name__ == '__main__':
+    main()
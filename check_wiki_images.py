@@ -1,26 +1,40 @@
 # Check images to see which ones need to be updated
 import argparse
-import csv
-import filecmp
-import hashlib
+import asyncio
+import json
 import os
-import random
-import string
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from queue import Queue
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-import requests
+from tqdm import tqdm
 
-from equipped_render import EquippedRender
+from compiled_sheet import load_sheet
+from kit_matrix import create_plan
+from pixel_diff import ImageDiff, compare_pair
+from render_index import IndexedRender, open_index
+from render_jobs import RenderJob
+from render_manifest import hash_file
+from renderer import RENDERER_COMMAND
+from run_trace import RunTrace
+from scheduler import DEFAULT_JOBS
+from wiki_api import RemoteFile, WikiApi
+from wiki_mirror import DEFAULT_MAX_CONNECTIONS, DEFAULT_REQUESTS_PER_SECOND, WikiMirror
 
-RENDERER_PATH = os.environ.get('RENDERER_PATH', './renderer-all.jar')
-diff_files = set()
-non_uploaded_files = set()
-failed_to_generate_files = set()
-COMMA = ','
-MAX_THREADS = 5
+# What happened to each checked image
+MISSING = 'missing'
+FAILED = 'failed'
+SAME_HASH = 'same_hash'
+SAME_PIXELS = 'same_pixels'
+MATCH = 'match'
+DIFF = 'diff'
+ERROR = 'error'
+RESULTS = [DIFF, MISSING, FAILED, ERROR, SAME_HASH, SAME_PIXELS, MATCH]
+# Items waiting between stages, per worker of the stage they wait for
+QUEUE_DEPTH = 4
 try:
     USER_AGENT = os.environ['USER_AGENT']
 except KeyError:
@@ -52,110 +66,340 @@ def validate_args(infile: str, cache: str, outdir: str, idfile: str) -> bool:
         if not idfile_path.is_file():
             print('Idfile given does not exist!')
             return False
+        try:
+            read_ids(idfile)
+        except ValueError:
+            print('Idfile must be a list of item ids, one per line or comma separated!')
+            return False
 
     return True
 
 
-def download_image(file_name: str, outdir: str) -> Optional[str]:
-    if not file_name:
-        return None
-    md5_val = hashlib.md5(file_name.encode('utf-8')).hexdigest()
-    url_encoded_file_name = file_name.replace("(", "%28").replace(")", "%29")
-    cache_buster = ''.join([random.choice(string.hexdigits) for _ in range(5)])
-
-    file_url = f'https://oldschool.runescape.wiki/images/{md5_val[:1]}/{md5_val[:2]}/{url_encoded_file_name}?{cache_buster}'
-    download_path = Path(outdir).joinpath(file_name)
-    resp = requests.get(file_url, headers={'User-agent': USER_AGENT})
-    if resp.status_code == 200:
-        out_file = open(download_path, 'wb+')
-        out_file.write(resp.content)
-        out_file.close()
-        return download_path
-    else:
-        # print(f'{file_name}: Error code {resp.status_code}')
-        return None
-
-
-def check_image(render: EquippedRender, is_female: bool, cache: str, renders_outdir: str, wiki_path: str,
-                force_rerender: bool):
-    download_path = Path(wiki_path).joinpath(render.get_file_name(is_female)[7:-2])
-    if not download_path.exists():
-        downloaded_name = download_image(render.get_file_name(is_female)[7:-2], wiki_path)
-    else:
-        downloaded_name = str(download_path)
-    render_file_name = Path(renders_outdir).joinpath('female' if is_female else 'male').joinpath('player').joinpath(
-        f'{render.get_complete_playerkit(is_female)}_{render.get_colorkit(is_female)}.png')
-    # Check if we have the image already generated. If not, generate it
-    if downloaded_name:
-        if not render_file_name.is_file() or force_rerender:
-            print(f'Rendering a file for {render.page_name}')
-            playerkit = [str(k) for k in render.get_complete_playerkit(is_female)]
-            colorkit = [str(k) for k in render.get_colorkit(is_female)]
-            complete_outdir = Path(renders_outdir).joinpath('female' if is_female else 'male')
-            os.system(
-                f'java -jar {RENDERER_PATH} --cache {cache} --out {complete_outdir} '
-                f'{"--playerfemale" if is_female else ""} '
-                f'--playerkit "{COMMA.join(playerkit)}" --playercolors "{COMMA.join(colorkit)}" '
-                f'--poseanim {render.pose_anim} --xan2d {render.xan2d} --yan2d {render.yan2d} --zan2d {render.zan2d}')
-        # Compare the two files
-        if render_file_name.is_file():
-            is_same_image = filecmp.cmp(render_file_name, downloaded_name, shallow=False)
-            if not is_same_image:
-                diff_files.add(render)
+def read_ids(idfile: str) -> List[int]:
+    return [int(item_id) for item_id in open(idfile, 'r').read().replace(',', '\n').split()]
+
+
+@dataclass
+class CheckResult:
+    # One line of the report
+    item_id: int
+    file_name: str
+    gender: str
+    render_type: str
+    result: str
+    render_path: str = ''
+    wiki_path: str = ''
+    diff_pixels: int = 0
+    bbox: Optional[Tuple[int, int, int, int]] = None
+    size_mismatch: bool = False
+    diff_image_path: Optional[str] = None
+    exit_status: Optional[int] = None
+    error: str = ''
+
+
+class CheckReport:
+    # Collects the result of every checked image. Results can be added from any thread.
+
+    def __init__(self):
+        self.results: List[CheckResult] = []
+        self.lock = threading.Lock()
+
+    def add(self, result: CheckResult):
+        with self.lock:
+            self.results.append(result)
+
+    def get_results(self, result: str) -> List[CheckResult]:
+        with self.lock:
+            return sorted((r for r in self.results if r.result == result), key=lambda r: (r.item_id, r.file_name))
+
+    def get_counts(self) -> Dict[str, int]:
+        return {result: len(self.get_results(result)) for result in RESULTS}
+
+    def print_report(self):
+        print('DIFF FILES:')
+        for result in self.get_results(DIFF):
+            size_note = ', different size' if result.size_mismatch else ''
+            print(f'{result.item_id}: {result.file_name} ({result.diff_pixels} pixels in {result.bbox}{size_note})')
+        print('MISSING FILES:')
+        for result in self.get_results(MISSING):
+            print(f'{result.item_id}: {result.file_name}')
+        print('FAILED FILES:')
+        for result in self.get_results(FAILED):
+            print(f'{result.item_id}: {result.file_name} ({result.error})')
+        print('ERRORS:')
+        for result in self.get_results(ERROR):
+            print(f'{result.item_id}: {result.file_name} ({result.error})')
+        counts = self.get_counts()
+        print(', '.join(f'{count} {result}' for result, count in counts.items()))
+
+    def write(self, path: str):
+        # Written in one go so a reader never sees half a report
+        data = {'counts': self.get_counts(),
+                'results': [asdict(r) for result in RESULTS for r in self.get_results(result)]}
+        tmp_path = Path(f'{path}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+
+@dataclass
+class CheckItem:
+    # An image on its way through the stages
+    job: RenderJob
+    started: float
+    wiki_path: Optional[str] = None
+    fetched: bool = False
+    rendered: bool = False
+    exit_status: Optional[int] = None
+    fetch: float = 0.0
+    render: float = 0.0
+    compare: float = 0.0
+
+
+class CheckPipeline:
+    # Fetches wiki images, renders local images and compares them in separate stages, each with its own number of
+    # workers, connected by bounded queues. Downloads no longer hold up render slots, or the other way around.
+    #   Download mode: fetch -> render -> compare
+    #   Hash mode:     render -> fetch, only if the hash and the pixel hash differ -> compare
+
+    def __init__(self, cache: str, renders_outdir: str, mirror: WikiMirror, force_rerender: bool,
+                 remote_files: Optional[Dict[str, RemoteFile]], tolerance: int, diff_dir: Optional[str],
+                 fetch_workers: int, render_workers: int, compare_workers: int, report: CheckReport, trace: RunTrace,
+                 indexed: Optional[Dict[str, IndexedRender]] = None):
+        self.cache = cache
+        self.renders_outdir = renders_outdir
+        self.mirror = mirror
+        self.force_rerender = force_rerender
+        self.remote_files = remote_files
+        self.tolerance = tolerance
+        self.diff_dir = diff_dir
+        self.num_workers = {'fetch': fetch_workers, 'render': render_workers, 'compare': compare_workers}
+        self.report = report
+        self.trace = trace
+        # Renders already in the outdir's index, which do not have to be looked for or hashed
+        self.indexed = {} if force_rerender else indexed or {}
+        # Renders in the index that turned out to be deleted since
+        self.stale_keys: List[str] = []
+        # Jobs that share a render key share one render
+        self.renders: Dict[str, asyncio.Task] = {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.progress: Optional[tqdm] = None
+
+    def get_stages(self) -> List[str]:
+        if self.remote_files is not None:
+            return ['render', 'fetch', 'compare']
+        return ['fetch', 'render', 'compare']
+
+    def get_next_stage(self, item: CheckItem) -> str:
+        for stage in self.get_stages():
+            if stage == 'fetch' and not item.fetched or stage == 'render' and not item.rendered:
+                return stage
+        return 'compare'
+
+    def finish(self, item: CheckItem, result: str, diff: Optional[ImageDiff] = None, error: str = ''):
+        job = item.job
+        check_result = CheckResult(item_id=job.item_id, file_name=job.file_name,
+                                   gender='female' if job.is_female else 'male', render_type=job.render_type,
+                                   result=result, render_path=str(job.get_output_path(self.renders_outdir)),
+                                   wiki_path=item.wiki_path or '', exit_status=item.exit_status, error=error)
+        if diff is not None:
+            check_result.diff_pixels = diff.diff_pixels
+            check_result.bbox = diff.bbox
+            check_result.size_mismatch = diff.size_mismatch
+            check_result.diff_image_path = diff.diff_image_path
+            check_result.error = diff.error
+        self.report.add(check_result)
+        self.trace.emit('check', item_id=job.item_id, name=job.file_name, result=result,
+                        ok=result not in (FAILED, ERROR), fetch=item.fetch, render=item.render, compare=item.compare,
+                        exit_status=item.exit_status, duration=time.time() - item.started, error=check_result.error)
+        self.progress.update(1)
+
+    def finish_failed(self, item: CheckItem):
+        self.finish(item, FAILED, error=f'Renderer exited with status {item.exit_status}' if item.exit_status
+                    else 'No render')
+
+    async def fetch(self, item: CheckItem):
+        started = time.time()
+        # The mirror uses requests, so downloads run on threads. The mirror limits connections and the request rate.
+        path = await asyncio.get_running_loop().run_in_executor(self.fetch_executor, self.mirror.fetch,
+                                                                item.job.file_name)
+        item.fetch += time.time() - started
+        item.fetched = True
+        if path is None:
+            self.finish(item, MISSING)
+            return
+        item.wiki_path = str(path)
+        await self.queues[self.get_next_stage(item)].put(item)
+
+    async def render_job(self, job: RenderJob) -> Tuple[bool, Optional[int], float]:
+        # Returns whether the render is there, the renderer's exit status, and how long rendering took
+        output_path = job.get_output_path(self.renders_outdir)
+        if job.get_render_key() in self.indexed or output_path.is_file() and not self.force_rerender:
+            return True, None, 0.0
+        started = time.time()
+        process = await asyncio.create_subprocess_exec(
+            *RENDERER_COMMAND, '--cache', self.cache, *job.get_renderer_args(self.renders_outdir),
+            stdout=asyncio.subprocess.DEVNULL)
+        exit_status = await process.wait()
+        return exit_status == 0 and output_path.is_file(), exit_status, time.time() - started
+
+    async def render(self, item: CheckItem):
+        render_key = item.job.get_render_key()
+        if render_key not in self.renders:
+            self.renders[render_key] = asyncio.ensure_future(self.render_job(item.job))
+        ok, item.exit_status, item.render = await self.renders[render_key]
+        item.rendered = True
+        if not ok:
+            self.finish_failed(item)
+            return
+        if self.remote_files is not None:
+            # Byte for byte the same as the wiki, no need to download it
+            remote_file = self.remote_files[item.job.file_name]
+            indexed = self.indexed.get(render_key)
+            if indexed is not None:
+                sha1 = indexed.sha1
+            else:
+                sha1 = await asyncio.to_thread(hash_file, item.job.get_output_path(self.renders_outdir))
+            if sha1 == remote_file.sha1:
+                self.finish(item, SAME_HASH)
+                return
+            # Compressed differently, but the same pixels as this version of the wiki image when it was last compared
+            if indexed is not None and indexed.pixel_sha1 and \
+                    self.mirror.get_pixel_hash(item.job.file_name, remote_file.sha1) == indexed.pixel_sha1:
+                self.finish(item, SAME_PIXELS)
+                return
+        await self.queues[self.get_next_stage(item)].put(item)
+
+    async def rerender_stale(self, item: CheckItem) -> bool:
+        # The render was in the index but deleted since. It is rendered again, once for every job that shares it, and
+        # taken out of the index. Returns whether the render is there now.
+        render_key = item.job.get_render_key()
+        if self.indexed.pop(render_key, None) is not None:
+            self.stale_keys.append(render_key)
+            self.renders[render_key] = asyncio.ensure_future(self.render_job(item.job))
+        ok, item.exit_status, render_seconds = await self.renders[render_key]
+        item.render += render_seconds
+        return ok
+
+    async def compare_render(self, item: CheckItem, render_path: str) -> ImageDiff:
+        started = time.time()
+        # Decoding is CPU bound, so it goes to processes
+        diff = await asyncio.get_running_loop().run_in_executor(
+            self.compare_executor, compare_pair, (item.wiki_path, render_path, self.tolerance, self.diff_dir))
+        item.compare += time.time() - started
+        return diff
+
+    async def compare(self, item: CheckItem):
+        render_path = str(item.job.get_output_path(self.renders_outdir))
+        diff = await self.compare_render(item, render_path)
+        if diff.error and not Path(render_path).is_file():
+            if not await self.rerender_stale(item):
+                self.finish_failed(item)
+                return
+            diff = await self.compare_render(item, render_path)
+        if self.remote_files is not None and diff.pixel_sha1:
+            # So the next check of an optimized render against the same wiki image needs no download or compare
+            self.mirror.set_pixel_hash(item.job.file_name, self.remote_files[item.job.file_name].sha1, diff.pixel_sha1)
+        if diff.error:
+            self.finish(item, ERROR, diff)
         else:
-            failed_to_generate_files.add(render)
-    else:
-        non_uploaded_files.add(render)
-
-
-def check_images(images_queue: Queue, cache: str, renders_outdir: str, wiki_path: str, force_rerender: bool):
-    while not images_queue.empty():
-        render: EquippedRender = images_queue.get()
-        # Get the file from the wiki, if it exists
-        if render.can_render(is_female=False):
-            check_image(render=render, is_female=False, cache=cache, renders_outdir=renders_outdir, wiki_path=wiki_path,
-                        force_rerender=force_rerender)
-
-        images_queue.task_done()
-
-
-def run_jobs(infile: str, cache_arg: str, outdir_arg: str, idfile_arg: str, force_rerender: bool):
-    should_use_whitelist = False
-    id_whitelist = set()
-    if idfile_arg:
-        should_use_whitelist = True
-        with open(idfile_arg, 'r') as idfile:
-            for line in idfile:
-                id_whitelist.add(int(line))
-
-    f = open(infile, 'r')
-    dict_reader = csv.DictReader(f, dialect='excel')
-    jobs = Queue()
-    for line in dict_reader:
-        render = EquippedRender.from_dict(line)
-        # If we are using the whitelist and the item id is in there, render it
-        # If not using the whitelist, render all equipped images
-        if should_use_whitelist and render.item_id in id_whitelist:
-            jobs.put(render)
-        elif not should_use_whitelist:
-            jobs.put(render)
+            self.finish(item, MATCH if diff.is_match() else DIFF, diff)
+
+    async def work(self, stage: str):
+        queue = self.queues[stage]
+        handler = getattr(self, stage)
+        while True:
+            item = await queue.get()
+            try:
+                await handler(item)
+            except Exception as e:
+                self.finish(item, ERROR, error=repr(e))
+            finally:
+                queue.task_done()
+
+    async def add_items(self, jobs: List[RenderJob]):
+        for job in jobs:
+            item = CheckItem(job=job, started=time.time())
+            if self.remote_files is not None and job.file_name not in self.remote_files:
+                self.finish(item, MISSING)
+                continue
+            await self.queues[self.get_next_stage(item)].put(item)
+
+    async def run(self, jobs: List[RenderJob]):
+        self.progress = tqdm(total=len(jobs), desc='Checking')
+        self.queues = {stage: asyncio.Queue(maxsize=num_workers * QUEUE_DEPTH)
+                       for stage, num_workers in self.num_workers.items()}
+        self.fetch_executor = ThreadPoolExecutor(max_workers=self.num_workers['fetch'])
+        self.compare_executor = ProcessPoolExecutor(max_workers=self.num_workers['compare'])
+        workers = [asyncio.ensure_future(self.work(stage)) for stage, num_workers in self.num_workers.items()
+                   for _ in range(num_workers)]
+        try:
+            await self.add_items(jobs)
+            # Items only ever move on to later stages, so once a stage's queue is empty, it stays empty
+            for stage in self.get_stages():
+                await self.queues[stage].join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.fetch_executor.shutdown()
+            self.compare_executor.shutdown()
+            self.progress.close()
+
+
+def load_jobs(infile: str, only_ids: Optional[List[int]], only_gender: Optional[str],
+              only_render: Optional[str]) -> List[RenderJob]:
+    # Every image with a file name on the wiki, for both genders and chatheads unless filtered
+    with load_sheet(infile) as sheet:
+        plan = create_plan(sheet, only_gender, only_render, only_ids)
+    return [job for jobs in plan.jobs_by_key.values() for job in jobs if job.file_name]
+
+
+def run_jobs(infile: str, cache_arg: str, outdir_arg: str, idfile_arg: str, force_rerender: bool, tolerance: int = 0,
+             diff_dir: Optional[str] = None, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+             requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND, hash_check: bool = False,
+             trace: Optional[RunTrace] = None, only_gender: Optional[str] = None, only_render: Optional[str] = None,
+             render_jobs: int = DEFAULT_JOBS, compare_processes: Optional[int] = None,
+             report_path: Optional[str] = None) -> CheckReport:
+    trace = trace or RunTrace()
+    jobs = load_jobs(infile, read_ids(idfile_arg) if idfile_arg else None, only_gender, only_render)
 
     wiki_path = Path(f'{str(Path(outdir_arg))}_wiki')
-    if not wiki_path.exists():
-        os.mkdir(wiki_path)
-    for i in range(MAX_THREADS):
-        t = threading.Thread(target=check_images, args=(jobs, cache_arg, outdir_arg, wiki_path, force_rerender))
-        t.start()
-    jobs.join()
-    print('DIFF FILES:')
-    for render in diff_files:
-        print(f'{render.item_id}: {render.file_name}')
-    print('MISSING FILES:')
-    for render in non_uploaded_files:
-        print(f'{render.item_id}: {render.file_name}')
-    print('FAILED FILES:')
-    for render in failed_to_generate_files:
-        print(f'{render.item_id}: {render.file_name}')
+    mirror = WikiMirror(str(wiki_path), USER_AGENT, max_connections=max_connections,
+                        requests_per_second=requests_per_second)
+    remote_files = None
+    if hash_check:
+        # Fetch the hash of every wiki image up front, 50 files per request
+        api = WikiApi(USER_AGENT, requests_per_second=requests_per_second)
+        remote_files = api.get_files(job.file_name for job in jobs)
+        api.close()
+
+    # Look every render up at once, rather than one at a time as each job gets to the render stage
+    indexed = None
+    index = open_index(outdir_arg)
+    if index is not None:
+        indexed = index.get_renders({job.get_render_key() for job in jobs})
+
+    report = CheckReport()
+    pipeline = CheckPipeline(cache_arg, outdir_arg, mirror, force_rerender, remote_files, tolerance, diff_dir,
+                             max_connections, render_jobs, compare_processes or os.cpu_count() or 1, report, trace,
+                             indexed)
+    trace.start_stage('check')
+    try:
+        asyncio.run(pipeline.run(jobs))
+    finally:
+        trace.end_stage('check')
+        mirror.close()
+        if index is not None:
+            index.remove(pipeline.stale_keys)
+            index.close()
+    if pipeline.stale_keys:
+        print(f'{len(pipeline.stale_keys)} renders in the index were deleted since, rendered them again')
+    report.print_report()
+    if report_path:
+        report.write(report_path)
+    trace.print_summary('check')
+    return report
 
 
 def main():
@@ -164,7 +408,27 @@ def main():
     parser.add_argument('--cache', required=True, help='Path to the cache to use')
     parser.add_argument('--outdir', help='Folder to use for the renderer output')
     parser.add_argument('--idfile', help='File containing ids to check')
+    parser.add_argument('--only-gender', choices=['male', 'female'],
+                        help='Only check images for the given gender. Defaults to checking both.')
+    parser.add_argument('--render-type', choices=['player', 'chathead'],
+                        help='Only check images of the given type. Defaults to checking both.')
     parser.add_argument('--rerender', action='store_true', help='Force rerender images')
+    parser.add_argument('--tolerance', type=int, default=0,
+                        help='How far a pixel channel can be off before the pixel counts as different. Default: 0')
+    parser.add_argument('--diff-dir', help='Folder to write an image highlighting the differences of each mismatch to')
+    parser.add_argument('--wiki-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help=f'Most requests to have open to the wiki at once. Default: {DEFAULT_MAX_CONNECTIONS}')
+    parser.add_argument('--wiki-rate', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help=f'Most requests to make to the wiki per second. Default: {DEFAULT_REQUESTS_PER_SECOND}')
+    parser.add_argument('--render-jobs', type=int, default=DEFAULT_JOBS,
+                        help='Most renderers to run at once. Defaults to the number of cores.')
+    parser.add_argument('--compare-processes', type=int,
+                        help='Most images to compare at once. Defaults to the number of cores.')
+    parser.add_argument('--hash-check', action='store_true',
+                        help='Compare against the SHA-1 of each wiki image first, only downloading images that differ')
+    parser.add_argument('--report', help='JSON file to write the result of every checked image to')
+    parser.add_argument('--trace', help='JSONL file to append an event for every checked image to')
+    parser.add_argument('--metrics', help='File to write Prometheus metrics for the run to')
     args = parser.parse_args()
 
     infile = args.infile
@@ -172,11 +436,22 @@ def main():
     outdir = args.outdir if args.outdir else 'renders'
     idfile = args.idfile
     force_rerender = args.rerender
+    tolerance = args.tolerance
+    diff_dir = args.diff_dir
+    max_connections = args.wiki_connections
+    requests_per_second = args.wiki_rate
+    hash_check = args.hash_check
 
     if not validate_args(infile, cache, outdir, idfile):
         exit(1)
 
-    run_jobs(infile, cache, outdir, idfile, force_rerender)
+    trace = RunTrace(args.trace)
+    run_jobs(infile, cache, outdir, idfile, force_rerender, tolerance, diff_dir, max_connections, requests_per_second,
+             hash_check, trace, args.only_gender, args.render_type, args.render_jobs, args.compare_processes,
+             args.report)
+    if args.metrics:
+        trace.write_metrics(args.metrics)
+    trace.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+# Compile the render sheet csv into a binary snapshot that can be memory mapped instead of parsed on every run
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from equipped_render import EquippedRender
+from render_manifest import hash_file
+
+SNAPSHOT_SUFFIX = '.sheet'
+SNAPSHOT_MAGIC = b'OSWSHEET'
+SNAPSHOT_VERSION = 1
+# Magic, then the length of the json header
+PREFIX_FORMAT = '<8sI'
+# Arrays start on this boundary so they can be viewed in place
+ARRAY_ALIGNMENT = 16
+
+INT_COLUMNS = ['item_id', 'equip_slot', 'pose_anim', 'xan2d', 'yan2d', 'zan2d']
+KIT_COLUMNS = ['male_playerkit', 'male_colorkit', 'female_playerkit', 'female_colorkit', 'zero_bitmap']
+STRING_COLUMNS = ['page_name', 'infobox_version', 'male_file_name', 'female_file_name']
+# Kit length used for a missing kit, so it can be told apart from an empty one
+MISSING_KIT = -1
+
+
+def get_snapshot_path(infile: str) -> Path:
+    return Path(f'{infile}{SNAPSHOT_SUFFIX}')
+
+
+def compile_arrays(infile: str) -> Dict[str, np.ndarray]:
+    # Parse each row once with the same rules as EquippedRender.from_dict
+    renders = [EquippedRender.from_dict(line) for line in csv.DictReader(open(infile, 'r'), dialect='excel')]
+    arrays = {}
+    for column in INT_COLUMNS:
+        arrays[column] = np.array([getattr(render, column) for render in renders], dtype=np.int32)
+    for column in KIT_COLUMNS:
+        kits = [getattr(render, column) for render in renders]
+        width = max([len(kit) for kit in kits if kit is not None], default=0)
+        # Kits are stored as fixed width rows, padded with zeros, plus the real length of each row
+        values = np.zeros((len(kits), width), dtype=np.int32)
+        lengths = np.full(len(kits), MISSING_KIT, dtype=np.int16)
+        for row, kit in enumerate(kits):
+            if kit is not None:
+                values[row, :len(kit)] = kit
+                lengths[row] = len(kit)
+        arrays[column] = values
+        arrays[f'{column}_len'] = lengths
+    for column in STRING_COLUMNS:
+        # Every string of a column goes in one utf-8 blob, row i is blob[offsets[i]:offsets[i + 1]]
+        encoded = [(getattr(render, column) or '').encode('utf-8') for render in renders]
+        arrays[column] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[f'{column}_offsets'] = np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64)
+    return arrays
+
+
+def align(offset: int) -> int:
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def get_data_start(header_length: int) -> int:
+    return align(struct.calcsize(PREFIX_FORMAT) + header_length)
+
+
+def write_snapshot(path: Path, csv_sha1: str, arrays: Dict[str, np.ndarray]):
+    header: Dict[str, Any] = {'version': SNAPSHOT_VERSION, 'csv_sha1': csv_sha1,
+                              'rows': len(arrays['item_id']), 'arrays': {}}
+    # Offsets are relative to the end of the header, so they do not depend on its length
+    offset = 0
+    for name, array in arrays.items():
+        offset = align(offset)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = get_data_start(len(header_bytes))
+
+    # A temp file of its own, so runs compiling the same csv at once never write into each other's snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack(PREFIX_FORMAT, SNAPSHOT_MAGIC, len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class CompiledSheet:
+    # Read only view of a compiled sheet, rows are only turned into EquippedRenders when asked for
+
+    def __init__(self, arrays: Dict[str, np.ndarray], csv_sha1: str, buffer: Optional[mmap.mmap] = None):
+        self.arrays = arrays
+        self.csv_sha1 = csv_sha1
+        self.buffer = buffer
+        self.item_ids = arrays['item_id']
+
+    @classmethod
+    def open(cls, path: Path) -> Optional['CompiledSheet']:
+        # Returns None if the snapshot is not one this version can read, or is cut short
+        with open(path, 'rb') as f:
+            # An empty file cannot be mapped
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, header_length = struct.unpack_from(PREFIX_FORMAT, buffer)
+            header = json.loads(buffer[struct.calcsize(PREFIX_FORMAT):struct.calcsize(PREFIX_FORMAT) + header_length])
+        except (struct.error, ValueError):
+            buffer.close()
+            return None
+        if magic != SNAPSHOT_MAGIC or header.get('version') != SNAPSHOT_VERSION:
+            buffer.close()
+            return None
+        arrays = {}
+        data_start = get_data_start(header_length)
+        data_end = max((data_start + info['offset'] + int(np.prod(info['shape'])) * np.dtype(info['dtype']).itemsize
+                        for info in header['arrays'].values()), default=data_start)
+        if len(buffer) < data_end:
+            buffer.close()
+            return None
+        for name, info in header['arrays'].items():
+            count = int(np.prod(info['shape']))
+            arrays[name] = np.frombuffer(buffer, dtype=np.dtype(info['dtype']), count=count,
+                                         offset=data_start + info['offset']).reshape(info['shape'])
+        return cls(arrays, header['csv_sha1'], buffer)
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def get_kit(self, column: str, row: int) -> Optional[List[int]]:
+        length = int(self.arrays[f'{column}_len'][row])
+        if length == MISSING_KIT:
+            return None
+        return self.arrays[column][row, :length].tolist()
+
+    def get_string(self, column: str, row: int) -> str:
+        offsets = self.arrays[f'{column}_offsets']
+        return self.arrays[column][offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def get_render(self, row: int) -> EquippedRender:
+        fields = {column: int(self.arrays[column][row]) for column in INT_COLUMNS}
+        fields.update({column: self.get_kit(column, row) for column in KIT_COLUMNS})
+        fields.update({column: self.get_string(column, row) for column in STRING_COLUMNS})
+        return EquippedRender(**fields)
+
+    def get_rows(self, only_ids: Optional[List[int]] = None) -> np.ndarray:
+        if only_ids is None:
+            return np.arange(len(self))
+        return np.flatnonzero(np.isin(self.item_ids, list(only_ids)))
+
+    def find(self, item_id: int) -> Optional[EquippedRender]:
+        # Later rows win, like they would when building a dict of the sheet
+        rows = np.flatnonzero(self.item_ids == item_id)
+        return self.get_render(int(rows[-1])) if len(rows) else None
+
+    def close(self):
+        # The arrays are views of the mapping, so they have to go before it can be closed
+        self.arrays = {}
+        self.item_ids = None
+        if self.buffer is not None:
+            self.buffer.close()
+
+    def __enter__(self) -> 'CompiledSheet':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compile_sheet(infile: str, csv_sha1: Optional[str] = None) -> Path:
+    path = get_snapshot_path(infile)
+    write_snapshot(path, csv_sha1 or hash_file(Path(infile)), compile_arrays(infile))
+    return path
+
+
+def load_sheet(infile: str) -> CompiledSheet:
+    # Use the snapshot if it was compiled from this exact csv, otherwise compile it again
+    csv_sha1 = hash_file(Path(infile))
+    path = get_snapshot_path(infile)
+    if path.is_file():
+        sheet = CompiledSheet.open(path)
+        if sheet is not None and sheet.csv_sha1 == csv_sha1:
+            return sheet
+        if sheet is not None:
+            sheet.close()
+    try:
+        compile_sheet(infile, csv_sha1)
+    except OSError as e:
+        # Read only dir or similar, the sheet still works, it just is not saved for next time
+        print(f'Could not save compiled sheet to {path}: {e}')
+        return CompiledSheet(compile_arrays(infile), csv_sha1)
+    return CompiledSheet.open(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--infile', required=True, help='Path to a csv to compile')
+    args = parser.parse_args()
+
+    infile_path = Path(args.infile)
+    if not infile_path.is_file():
+        print('Infile given does not exist!')
+        exit(1)
+
+    path = compile_sheet(args.infile)
+    with CompiledSheet.open(path) as sheet:
+        print(f'Compiled {len(sheet)} rows to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+# Adjusts how many renderers run at once while a run is going. Each renderer holds a full copy of the cache, so a fixed
+# number either leaves cores idle or runs the box out of memory, depending on the box.
+
+# Memory to always leave free, in MB
+DEFAULT_MIN_FREE_MEMORY = 1024
+# Most load average per core before renderers are stopped
+DEFAULT_MAX_LOAD = 1.0
+ADJUST_INTERVAL_SECONDS = 5.0
+# An extra renderer is only kept if it makes the run at least this much faster
+MIN_THROUGHPUT_GAIN = 0.05
+# Intervals to wait after backing off before trying more renderers again. The load average is a one minute average, so
+# it takes a while to catch up.
+HOLD_INTERVALS = 6
+
+
+@dataclass
+class ConcurrencyLimits:
+    floor: int
+    ceiling: int
+    min_free_memory: int = DEFAULT_MIN_FREE_MEMORY
+    max_load: float = DEFAULT_MAX_LOAD
+
+
+def parse_concurrency_limits(limits_arg: str, min_free_memory: int = DEFAULT_MIN_FREE_MEMORY,
+                             max_load: float = DEFAULT_MAX_LOAD) -> ConcurrencyLimits:
+    floor, ceiling = (int(part) for part in limits_arg.split(':'))
+    if not 1 <= floor <= ceiling:
+        raise ValueError(limits_arg)
+    return ConcurrencyLimits(floor, ceiling, min_free_memory, max_load)
+
+
+def validate_concurrency_limits(limits_arg: str) -> bool:
+    try:
+        parse_concurrency_limits(limits_arg)
+    except ValueError:
+        print('Adaptive jobs must be given as MIN:MAX, where MIN is at least 1 and at most MAX!')
+        return False
+    return True
+
+
+def get_available_memory() -> Optional[int]:
+    # In bytes, None if the system does not say
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_load_per_core() -> Optional[float]:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class ConcurrencyController:
+    # Keeps the number of renderers between the floor and ceiling, checking every interval:
+    #   Low on memory: stop a quarter of the renderers
+    #   Load average too high: stop a renderer
+    #   The last extra renderer did not make jobs finish faster: stop it again
+    #   Otherwise, if there is memory to spare for another renderer: start one
+    # How fast jobs finish is worked out from the number of renderers and how long each job took.
+
+    def __init__(self, limits: ConcurrencyLimits, interval: float = ADJUST_INTERVAL_SECONDS):
+        self.limits = limits
+        self.interval = interval
+        # Start in the middle of the range and work towards the best number from there
+        self.limit = max(limits.floor, min(limits.ceiling, (os.cpu_count() or 1) // 2))
+        self.lowest = self.highest = self.limit
+        self.changed = threading.Condition()
+        # How long each job took since the last check
+        self.latencies: List[float] = []
+        self.last_change = 0
+        self.last_throughput: Optional[float] = None
+        self.hold = 0
+        # Memory available before any renderer started, to work out how much each one uses
+        self.baseline_memory = get_available_memory()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        print(f'Running {self.limit} renderers, adjusting between {self.limits.floor} and {self.limits.ceiling}')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Lets every parked worker go, so they can pick up their stop markers
+        self.stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        print(f'Ran between {self.lowest} and {self.highest} renderers, ending on {self.limit}')
+
+    def record(self, latency: float):
+        with self.changed:
+            self.latencies.append(latency)
+
+    def is_active(self, index: int) -> bool:
+        return self.stopped.is_set() or index < self.limit
+
+    def wait_for_slot(self, index: int, on_park: Callable[[], None]):
+        # Blocks worker number index while it is over the limit. on_park runs once it is, to free the worker's renderer.
+        with self.changed:
+            if self.is_active(index):
+                return
+        on_park()
+        with self.changed:
+            self.changed.wait_for(lambda: self.is_active(index))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+    def get_memory_per_renderer(self, available: int) -> int:
+        if self.baseline_memory is None:
+            return 0
+        return max(0, self.baseline_memory - available) // self.limit
+
+    def get_new_limit(self, latencies: List[float], available: Optional[int],
+                      load: Optional[float]) -> Tuple[int, str]:
+        # Returns the new limit and why it changed
+        limits = self.limits
+        min_free = limits.min_free_memory * 1024 * 1024
+        if available is not None and available < min_free:
+            self.hold = HOLD_INTERVALS
+            return max(limits.floor, self.limit - max(1, self.limit // 4)), f'{available // 2 ** 20} MB free'
+        if load is not None and load > limits.max_load:
+            self.hold = HOLD_INTERVALS
+            return max(limits.floor, self.limit - 1), f'load {load:.2f} per core'
+        if not latencies:
+            # Nothing finished, so no way to tell if more renderers would help
+            return self.limit, ''
+        # Jobs in flight over time per job is jobs per second
+        throughput = self.limit / (sum(latencies) / len(latencies))
+        last_change = self.last_change
+        last_throughput = self.last_throughput
+        self.last_throughput = throughput
+        if last_change > 0 and last_throughput is not None and \
+                throughput < last_throughput * (1 + MIN_THROUGHPUT_GAIN):
+            self.hold = HOLD_INTERVALS
+            return max(limits.floor, self.limit - 1), f'{throughput:.1f} jobs/s, no faster than before'
+        if self.hold:
+            self.hold -= 1
+            return self.limit, ''
+        if available is not None and available - self.get_memory_per_renderer(available) < min_free:
+            return self.limit, ''
+        return min(limits.ceiling, self.limit + 1), f'{throughput:.1f} jobs/s'
+
+    def adjust(self):
+        with self.changed:
+            latencies, self.latencies = self.latencies, []
+        new_limit, reason = self.get_new_limit(latencies, get_available_memory(), get_load_per_core())
+        self.last_change = new_limit - self.limit
+        if not self.last_change:
+            return
+        print(f'Renderers: {self.limit} -> {new_limit} ({reason})')
+        with self.changed:
+            self.limit = new_limit
+            self.lowest = min(self.lowest, new_limit)
+            self.highest = max(self.highest, new_limit)
+            self.changed.notify_all()
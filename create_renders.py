@@ -1,21 +1,35 @@
 import argparse
 import csv
-import os
 import threading
+import time
 from pathlib import Path
-from queue import Queue
-from typing import List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
 
-from tqdm import tqdm
+import cache_diff
+from compiled_sheet import load_sheet
+from concurrency import (DEFAULT_MAX_LOAD, DEFAULT_MIN_FREE_MEMORY, ConcurrencyController, ConcurrencyLimits,
+                         parse_concurrency_limits, validate_concurrency_limits)
+from item_sets import create_set_jobs, load_sets, validate_set_list
+from kit_matrix import create_plan
+from png_optimizer import OptimizeResult, PngOptimizer
+from render_index import RenderIndex, get_index_path
+from render_jobs import JobOutcome, RenderJob, RenderPlan
+from render_journal import RenderJournal, get_journal_path
+from render_manifest import RenderManifest, get_cache_fingerprint, get_manifest_path
+from render_timings import load_timings
+from renderer import DEFAULT_SHARD_SIZE, WORKER_TYPES, create_workers, validate_worker_args
+from run_trace import RunTrace
+from scheduler import DEFAULT_JOBS, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BACKOFF, RenderScheduler
+from sheet_stream import StreamPlan, iter_sheet_jobs
+from shards import Shard, get_shard_path, parse_shard, validate_shard
 
-from equipped_render import EquippedRender, ItemSet
+FAILURE_REPORT_HEADERS = ['item_id', 'file_name', 'gender', 'render_type', 'attempts', 'exit_status', 'error']
+# Jobs read from a streamed sheet ahead of each renderer, enough to keep it busy without holding much of the sheet
+STREAM_JOBS_PER_RENDERER = 4
 
-RENDERER_PATH = os.environ.get('RENDERER_PATH', './renderer-all.jar')
-COMMA = ','
-MAX_THREADS = 1
 
-
-def validate_args(infile_arg: str, cache_arg: str, outdir_arg: str, only_ids_file: Optional[str]) -> bool:
+def validate_args(infile_arg: str, cache_arg: str, outdir_arg: str, only_ids_file: Optional[str],
+                  changed_since: Optional[str] = None, set_list: Optional[str] = None) -> bool:
     # Validate infile
     infile_path = Path(infile_arg)
     if not infile_path.is_file():
@@ -46,98 +60,324 @@ def validate_args(infile_arg: str, cache_arg: str, outdir_arg: str, only_ids_fil
             print('id-list file is not a comma separated list of integers!')
             return False
 
+    # Validate old cache
+    if changed_since and not cache_diff.validate_args(changed_since, cache_arg):
+        return False
+
+    # Validate set list
+    if set_list and not validate_set_list(set_list):
+        return False
+
     return True
 
 
-def render_chathead_images(images_queue: Queue, cache: str, outdir: str, only_gender: Optional[str]):
-    def render_image(render_: EquippedRender, is_female: bool, cache_: str, outdir_: str):
-        playerkit = [str(k) for k in render_.get_complete_playerkit(is_female)]
-        colorkit = [str(k) for k in render_.get_colorkit(is_female)]
-        complete_outdir = Path(outdir_).joinpath('female' if is_female else 'male')
-        os.system(
-            f'java -jar {RENDERER_PATH} --cache {cache_} --out {complete_outdir} '
-            f'--playerkit "{COMMA.join(playerkit)}" --playercolors "{COMMA.join(colorkit)}" '
-            f'{"--playerfemale" if is_female else ""} --playerchathead --anim 589 --lowres --crophead --yan2d 128'
-        )
-
-    while not images_queue.empty():
-        render: EquippedRender = images_queue.get()
-        if render.can_render(is_female=False) and only_gender != 'female' and render.equip_slot == 0:
-            render_image(render_=render, is_female=False, cache_=cache, outdir_=outdir)
-        if render.can_render(is_female=True) and only_gender != 'male' and render.equip_slot == 0:
-            render_image(render_=render, is_female=True, cache_=cache, outdir_=outdir)
-        images_queue.task_done()
-
-
-def render_equip_images(images_queue: Queue, cache: str, outdir: str, only_gender: Optional[str]):
-    def render_image(render_: EquippedRender, is_female: bool, cache_: str, outdir_: str):
-        playerkit = [str(k) for k in render_.get_complete_playerkit(is_female)]
-        colorkit = [str(k) for k in render_.get_colorkit(is_female)]
-
-        complete_outdir = Path(outdir_).joinpath('female' if is_female else 'male')
-        os.system(
-            f'java -jar {RENDERER_PATH} --cache {cache_} --out {complete_outdir} '
-            f'--playerkit "{COMMA.join(playerkit)}" --playercolors "{COMMA.join(colorkit)}" '
-            f'--poseanim {render_.pose_anim} --xan2d {render_.xan2d} --yan2d {render_.yan2d} --zan2d {render_.zan2d} '
-            f'{"--playerfemale" if is_female else ""}'
-        )
-
-    while not images_queue.empty():
-        render: EquippedRender = images_queue.get()
-        if render.can_render(is_female=False) and only_gender != 'female':
-            render_image(render_=render, is_female=False, cache_=cache, outdir_=outdir)
-        if render.can_render(is_female=True) and only_gender != 'male':
-            render_image(render_=render, is_female=True, cache_=cache, outdir_=outdir)
-        images_queue.task_done()
+def report_failures(outcomes: List[JobOutcome]):
+    failed = [outcome for outcome in outcomes if not outcome.ok]
+    print(f'Rendered {len(outcomes) - len(failed)}/{len(outcomes)} images')
+    list_failures(failed)
+
+
+def list_failures(failed: List[JobOutcome]):
+    for outcome in failed:
+        job = outcome.job
+        print(f'Id {job.item_id}: Failed {"female" if job.is_female else "male"} {job.render_type} render '
+              f'({outcome.error})')
+
+
+def get_failure_report_path(outdir: str) -> Path:
+    return Path(f'{str(Path(outdir))}_failed.csv')
+
+
+def write_failure_report(outcomes: List[JobOutcome], path: Path):
+    # Every item that still failed after all of its attempts, so they can be looked at or passed back in with --id-list
+    failed = [outcome for outcome in outcomes if not outcome.ok]
+    if not failed:
+        # A report from an earlier run would be misleading
+        if path.is_file():
+            path.unlink()
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, dialect='excel')
+        writer.writerow(FAILURE_REPORT_HEADERS)
+        for outcome in failed:
+            job = outcome.job
+            writer.writerow([job.item_id, job.file_name, 'female' if job.is_female else 'male', job.render_type,
+                             outcome.attempt, '' if outcome.exit_status is None else outcome.exit_status,
+                             outcome.error])
+    print(f'Failed renders written to {path}')
+
+
+def trace_outcome(trace: RunTrace, outcome: JobOutcome, outdir: str, num_shared: int):
+    job = outcome.job
+    output_bytes = 0
+    if outcome.ok:
+        try:
+            output_bytes = job.get_output_path(outdir).stat().st_size
+        except OSError:
+            pass
+    trace.emit('render', item_id=job.item_id, name=job.file_name, render_type=job.render_type,
+               gender='female' if job.is_female else 'male', render_key=job.get_render_key(), ok=outcome.ok,
+               exit_status=outcome.exit_status, queue_wait=outcome.get_queue_wait(), spawn=outcome.spawn,
+               render=outcome.get_duration() - outcome.spawn, duration=outcome.get_duration(),
+               output_bytes=output_bytes, shared=num_shared, attempt=outcome.attempt, final=outcome.final,
+               error=outcome.error)
+
+
+def trace_optimize(trace: RunTrace, job: RenderJob, result: OptimizeResult):
+    # A render that could not be optimized is left as it was
+    output_bytes = result.bytes_after if result.ok else result.bytes_before
+    trace.emit('optimize', item_id=job.item_id, name=job.file_name, ok=result.ok, duration=result.duration,
+               bytes_before=result.bytes_before, output_bytes=output_bytes, pixel_sha1=result.pixel_sha1,
+               error=result.error)
+
+
+def load_plan(infile: str, only_gender: Optional[str], only_render: Optional[str], only_ids: Optional[List[int]],
+              set_list: Optional[str] = None) -> RenderPlan:
+    # The jobs hold their own copies of the kits, so the sheet is closed once the plan is made
+    with load_sheet(infile) as sheet:
+        plan = create_plan(sheet, only_gender, only_render, only_ids)
+        # Sets go in the same plan, so they render alongside everything else
+        if set_list:
+            for job in create_set_jobs(sheet, load_sets(set_list), only_gender, only_render):
+                plan.add(job)
+    return plan
+
+
+def load_stream_plan(infile: str, only_gender: Optional[str], only_render: Optional[str],
+                     only_ids: Optional[List[int]], set_list: Optional[str] = None,
+                     shard: Optional[Shard] = None) -> StreamPlan:
+    # Nothing is read until the plan is rendered
+    return StreamPlan(iter_sheet_jobs(infile, only_gender, only_render, only_ids, set_list), shard)
+
+
+def render_plan(plan: Union[RenderPlan, StreamPlan], cache_arg: str, outdir_arg: str, renderer_mode: str = 'process',
+                num_jobs: int = DEFAULT_JOBS, shard_size: int = DEFAULT_SHARD_SIZE, force: bool = False,
+                on_ready: Optional[Callable[[List[RenderJob]], None]] = None,
+                trace: Optional[RunTrace] = None, resume: bool = False, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                retry_backoff: float = DEFAULT_RETRY_BACKOFF, shard: Optional[Shard] = None, optimize: bool = False,
+                trim: bool = False, concurrency: Optional[ConcurrencyLimits] = None,
+                index: Optional[RenderIndex] = None) -> List[JobOutcome]:
+    # on_ready gets every group of jobs sharing a render key as soon as that render is on disk and in the index, and
+    # optimized if optimize or trim is set. An index that is passed in is left open for the caller.
+    # A StreamPlan is rendered as it is read, with only a few jobs per renderer read ahead, and only the failed
+    # outcomes are returned. A StreamPlan does its own sharding.
+    streaming = isinstance(plan, StreamPlan)
+    cache_fingerprint = get_cache_fingerprint(cache_arg)
+    manifest = RenderManifest(get_shard_path(get_manifest_path(outdir_arg), shard), outdir_arg, cache_fingerprint)
+    manifest_lock = threading.Lock()
+    journal = RenderJournal(get_shard_path(get_journal_path(outdir_arg), shard), cache_fingerprint)
+    resume = resume and journal.load()
+    timings = load_timings(outdir_arg, shard)
+    own_index = index is None
+    if own_index:
+        index = RenderIndex(get_shard_path(get_index_path(outdir_arg), shard))
+    trace = trace or RunTrace()
+    optimizer = PngOptimizer(trim) if optimize or trim else None
+    # Renders this run did not have to do, and the ones it did
+    skipped = {'resumed': 0, 'current': 0}
+    num_rendered = 0
+    failed_outcomes = []
+    # Renders that came back fine but could not be recorded once they were optimized, by render key
+    record_failures: Dict[str, JobOutcome] = {}
+    # The scheduler calls on_outcome from every worker at once
+    count_lock = threading.Lock()
+
+    def ready(job: RenderJob):
+        jobs = plan.finish(job.get_render_key())
+        if on_ready is not None:
+            on_ready(jobs)
+
+    def on_rendered(job: RenderJob, result: Optional[OptimizeResult] = None):
+        # Optimized renders are recorded with the hash of their pixels, a render that could not be optimized is
+        # still good to use as it is
+        with manifest_lock:
+            if result is None:
+                manifest.record(job)
+            else:
+                trace_optimize(trace, job, result)
+                if result.ok:
+                    manifest.record(job, optimizer.mode, result.pixel_sha1)
+                else:
+                    print(f'Could not optimize {result.path}: {result.error}')
+                    manifest.record(job)
+            index.record(job.get_render_key(), manifest.entries[job.get_render_key()])
+        ready(job)
+
+    def fail_rendered(job: RenderJob, error: Exception, skipped: bool):
+        # The render cannot be used, e.g. it was deleted before it was hashed. It goes down as failed, so neither
+        # --resume nor the next run takes it for done.
+        nonlocal num_rendered
+        key = job.get_render_key()
+        print(f'Could not record render {job.get_output_path(outdir_arg)}: {error!r}')
+        now = time.time()
+        outcome = JobOutcome(job=job, ok=False, started=now, finished=now, error=f'Could not record render: {error!r}')
+        journal.record(outcome)
+        with manifest_lock:
+            manifest.entries.pop(key, None)
+            index.remove([key])
+        with count_lock:
+            record_failures[key] = outcome
+            # Rendered renders were counted when they came back
+            if skipped:
+                num_rendered += 1
+        if streaming:
+            failed_outcomes.extend(plan.fan_out(outcome))
+
+    def on_optimized(job: RenderJob, result: OptimizeResult, skipped: bool):
+        # Runs on the optimizer's own thread, after the scheduler already took the render for done
+        try:
+            on_rendered(job, result)
+        except Exception as e:
+            fail_rendered(job, e, skipped)
+
+    def optimize_render(job: RenderJob, skipped: bool = False):
+        optimizer.submit(job.get_output_path(outdir_arg), lambda result: on_optimized(job, result, skipped))
+
+    def on_outcome(outcome: JobOutcome):
+        nonlocal num_rendered
+        journal.record(outcome)
+        jobs = plan.jobs_by_key[outcome.job.get_render_key()]
+        trace_outcome(trace, outcome, outdir_arg, len(jobs))
+        # Every job of a manifest shard gets the time of the whole shard, which says nothing about the job itself
+        if outcome.ok and renderer_mode != 'manifest':
+            timings.record(outcome.job, outcome.get_duration())
+        if outcome.ok:
+            if optimizer is not None:
+                optimize_render(outcome.job)
+            else:
+                on_rendered(outcome.job)
+        elif outcome.final and streaming:
+            failed_outcomes.extend(plan.fan_out(outcome))
+        # Last, so an outcome that raised is only counted when the scheduler passes it back in as a failure
+        if outcome.final:
+            with count_lock:
+                num_rendered += 1
+
+    def skip(job: RenderJob):
+        # Renders from before optimizing was turned on, or changed, still need it
+        if optimizer is not None and not manifest.is_optimized(job, optimizer.mode):
+            optimize_render(job, skipped=True)
+        else:
+            ready(job)
+
+    done_keys = journal.get_done_keys() if resume else set()
+
+    def select_jobs(jobs: Iterable[RenderJob]) -> Iterator[RenderJob]:
+        # Skips anything the run being resumed finished. The manifest is only saved at the end of a run, so it may not
+        # know about them yet. Then skips anything already rendered from this cache by an earlier run.
+        # Either way, the render goes in the index, for outdirs rendered to before it had one.
+        for job in jobs:
+            key = job.get_render_key()
+            if key in done_keys and job.get_output_path(outdir_arg).is_file():
+                with manifest_lock:
+                    if not manifest.is_current(job):
+                        manifest.record(job)
+                    index.record(key, manifest.entries[key])
+                skipped['resumed'] += 1
+            elif not force and manifest.is_current(job):
+                index.record(key, manifest.entries[key], replace=False)
+                skipped['current'] += 1
+            else:
+                yield job
+                continue
+            skip(job)
+
+    def print_skipped():
+        if resume:
+            print(f'Resuming: {skipped["resumed"]} renders were already done, {journal.get_num_failed()} had failed')
+        print(f'{skipped["current"]} renders are unchanged since the last run, use --force to redo them')
+
+    def on_duplicate(job: RenderJob):
+        # A row whose render was finished before the row was read
+        if on_ready is not None:
+            on_ready([job])
+
+    def plan_jobs(jobs: Iterable[RenderJob]) -> Iterator[RenderJob]:
+        for job in jobs:
+            journal.record_planned([job])
+            yield job
+
+    if optimizer is not None:
+        trace.start_stage('optimize')
+    journal.open(resume)
+    controller = None
+    # With concurrency limits, num_jobs is ignored and the number of renderers is adjusted between them while the run
+    # goes
+    if concurrency is not None:
+        num_jobs = concurrency.ceiling
+        controller = ConcurrencyController(concurrency)
+    workers = create_workers(renderer_mode, cache_arg, outdir_arg, num_jobs, shard_size)
+    scheduler = RenderScheduler(workers, on_outcome, max_attempts, retry_backoff, controller, timings,
+                                keep_outcomes=not streaming)
+    run_outcomes = []
+    trace.start_stage('render')
+    try:
+        if streaming:
+            # Read ahead enough to fill a manifest shard for every renderer
+            read_ahead = shard_size if renderer_mode == 'manifest' else STREAM_JOBS_PER_RENDERER
+            jobs = plan_jobs(select_jobs(plan.iter_unique_jobs(on_duplicate)))
+            scheduler.run(jobs, max_in_flight=len(workers) * read_ahead)
+            print(f'{plan.num_jobs} images rendered or skipped, {plan.get_num_saved()} renderer calls saved by '
+                  f'skipping duplicates')
+            print_skipped()
+        else:
+            jobs = plan.get_unique_jobs()
+            print(f'{plan.get_num_jobs()} images to render, {plan.get_num_saved()} renderer calls saved by skipping '
+                  f'duplicates')
+            # Split the whole plan, before anything is skipped, so every shard gets the same jobs on every run
+            if shard is not None:
+                jobs = shard.select(jobs)
+                print(f'Shard {shard}: {len(jobs)} renders')
+            jobs = list(select_jobs(jobs))
+            print_skipped()
+            journal.record_planned(jobs)
+            run_outcomes = scheduler.run(jobs, total=len(jobs))
+    finally:
+        trace.end_stage('render')
+        if optimizer is not None:
+            # Every render that could not be recorded once optimized is in record_failures after this
+            optimizer.close()
+            trace.end_stage('optimize')
+        journal.close()
+        manifest.save()
+        timings.save()
+        if own_index:
+            index.close()
+    if streaming:
+        outcomes = failed_outcomes + plan.late_failures
+        # Rows that share a render can turn up long after it is done, so count renders rather than images
+        print(f'Rendered {num_rendered - len(plan.failed)}/{num_rendered} renders')
+        list_failures(outcomes)
+    else:
+        # A render that failed to be recorded takes the place of its outcome from the scheduler
+        outcomes_by_key = {outcome.job.get_render_key(): outcome for outcome in run_outcomes}
+        outcomes_by_key.update(record_failures)
+        outcomes = [job_outcome for outcome in outcomes_by_key.values() for job_outcome in plan.fan_out(outcome)]
+        report_failures(outcomes)
+    write_failure_report(outcomes, get_shard_path(get_failure_report_path(outdir_arg), shard))
+    trace.print_summary('render')
+    stats = trace.get_stats('optimize')
+    if stats.num_final:
+        print(f'Optimized {stats.num_final} renders, {stats.totals["bytes_before"]} bytes to '
+              f'{stats.totals["output_bytes"]} bytes')
+        trace.print_summary('optimize')
+    return outcomes
 
 
 def run_jobs(infile: str, cache_arg: str, outdir_arg: str, only_gender: Optional[str], only_render: Optional[str],
-             only_ids: Optional[List[int]], set_list: Optional[str]):
-    num_lines_data = sum(1 for _ in open(infile, 'r'))
-    f = open(infile, 'r')
-    dict_reader = csv.DictReader(f, dialect='excel')
-
-    equip_jobs = Queue()
-    chathead_jobs = Queue()
-    renders = {}
-    for line in tqdm(dict_reader, total=num_lines_data):
-        render = EquippedRender.from_dict(line)
-        renders[render.item_id] = render
-        if only_ids is None or render.item_id in only_ids:
-            if only_render is None or only_render == 'equip':
-                equip_jobs.put(render)
-            if only_render is None or only_render == 'chathead':
-                chathead_jobs.put(render)
-
-    # Hacked in set support, pass in set list and it will only render sets
-    if set_list:
-        f2 = open(set_list)
-        d_r = csv.DictReader(f2, dialect='excel')
-        is_female = True
-        for line in d_r:
-            ids = line['item_ids'].split(',')
-            rotation = line['yan2d']
-            l = [renders[int(i)] for i in ids]
-            s = ItemSet(l)
-            playerkit = [str(k) for k in s.get_complete_playerkit(is_female)]
-            colorkit = [str(k) for k in s.get_colorkit(is_female)]
-            complete_outdir = Path(outdir_arg).joinpath('female' if is_female else 'male')
-            comm = (f'java -jar {RENDERER_PATH} --cache {cache_arg} --out {complete_outdir} '
-                    f'--playerkit "{COMMA.join(playerkit)}" --playercolors "{COMMA.join(colorkit)}" '
-                    f'--poseanim {808} --xan2d {96} --yan2d {rotation} --zan2d {0} '
-                    f'{"--playerfemale" if is_female else ""}')
-            os.system(comm)
-
-        exit(0)
-
-    for i in range(MAX_THREADS):
-        t = threading.Thread(target=render_equip_images, args=(equip_jobs, cache_arg, outdir_arg, only_gender))
-        t.start()
-    equip_jobs.join()
-    for i in range(MAX_THREADS):
-        t = threading.Thread(target=render_chathead_images, args=(chathead_jobs, cache_arg, outdir_arg, only_gender))
-        t.start()
-    chathead_jobs.join()
+             only_ids: Optional[List[int]], set_list: Optional[str], renderer_mode: str = 'process',
+             num_jobs: int = DEFAULT_JOBS, shard_size: int = DEFAULT_SHARD_SIZE,
+             force: bool = False, trace: Optional[RunTrace] = None, resume: bool = False,
+             max_attempts: int = DEFAULT_MAX_ATTEMPTS, retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+             shard: Optional[Shard] = None, optimize: bool = False, trim: bool = False,
+             concurrency: Optional[ConcurrencyLimits] = None, stream: bool = False) -> List[JobOutcome]:
+    if stream:
+        plan = load_stream_plan(infile, only_gender, only_render, only_ids, set_list, shard)
+    else:
+        plan = load_plan(infile, only_gender, only_render, only_ids, set_list)
+    return render_plan(plan, cache_arg, outdir_arg, renderer_mode, num_jobs, shard_size, force, trace=trace,
+                       resume=resume, max_attempts=max_attempts, retry_backoff=retry_backoff, shard=shard,
+                       optimize=optimize, trim=trim, concurrency=concurrency)
 
 
 def main():
@@ -150,21 +390,96 @@ def main():
     parser.add_argument('--render-type', choices=['player', 'chathead'],
                         help='Only generate renders for the given type. Defaults to generating both.')
     parser.add_argument('--id-list', help='Only generate renders for the ids in this file (comma separated list)')
-    parser.add_argument('--set-list', help='Only generate sets, might break things')
+    parser.add_argument('--set-list', help='Path to a csv of sets to render along with the items')
+    parser.add_argument('--renderer-mode', choices=list(WORKER_TYPES.keys()), default='process',
+                        help='process launches the renderer once per image, pool keeps renderers running and '
+                             'streams jobs to them, manifest launches the renderer once per shard of jobs. '
+                             'Defaults to process.')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help='Number of renderers to run at once. Defaults to the number of cores.')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Number of jobs per renderer launch in manifest mode. Defaults to {DEFAULT_SHARD_SIZE}.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the sheet a row at a time while rendering instead of loading it all first, for '
+                             'very big sheets')
+    parser.add_argument('--adaptive-jobs',
+                        help='Adjust the number of renderers between MIN and MAX, given as MIN:MAX, from the load '
+                             'average, free memory and how fast jobs finish. Overrides --jobs.')
+    parser.add_argument('--min-free-memory', type=int, default=DEFAULT_MIN_FREE_MEMORY,
+                        help='MB of memory to keep free with --adaptive-jobs, renderers are stopped below this. '
+                             f'Defaults to {DEFAULT_MIN_FREE_MEMORY}.')
+    parser.add_argument('--max-load', type=float, default=DEFAULT_MAX_LOAD,
+                        help='Most load average per core with --adaptive-jobs, renderers are stopped above this. '
+                             f'Defaults to {DEFAULT_MAX_LOAD}.')
+    parser.add_argument('--force', action='store_true',
+                        help='Render everything, even renders that have not changed since the last run')
+    parser.add_argument('--changed-since', help='Path to an older cache, only items that changed since it are rendered')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from where the last run stopped, skipping every render it finished')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'Times to try each render before giving up on it. Defaults to {DEFAULT_MAX_ATTEMPTS}.')
+    parser.add_argument('--retry-backoff', type=float, default=DEFAULT_RETRY_BACKOFF,
+                        help='Seconds to wait before retrying a failed render, doubled for every attempt after. '
+                             f'Defaults to {DEFAULT_RETRY_BACKOFF}.')
+    parser.add_argument('--shard', help='Only render shard K of N of the jobs, given as K/N, e.g. 2/4')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Recompress every render losslessly in a process pool as soon as it is rendered')
+    parser.add_argument('--trim', action='store_true',
+                        help='Crop the transparent border off of every render, implies --optimize')
+    parser.add_argument('--trace', help='File to append a JSONL event for every job to')
+    parser.add_argument('--metrics', help='File to write Prometheus metrics for the run to')
     args = parser.parse_args()
 
-    if not validate_args(args.infile, args.cache, args.outdir, args.only_ids_file):
+    if not validate_args(args.infile, args.cache, args.outdir, args.id_list, args.changed_since, args.set_list):
+        exit(1)
+    if args.max_attempts < 1:
+        print('Max attempts must be at least 1!')
+        exit(1)
+    if not validate_worker_args(args.jobs, args.shard_size):
+        exit(1)
+    if args.shard and not validate_shard(args.shard):
+        exit(1)
+    if args.adaptive_jobs and not validate_concurrency_limits(args.adaptive_jobs):
         exit(1)
 
-    start_up(args.infile, args.cache, args.outdir, args.only_gender, args.only_render, args.only_ids_file, args.set_list)
+    trace = RunTrace(args.trace)
+    concurrency = None
+    if args.adaptive_jobs:
+        concurrency = parse_concurrency_limits(args.adaptive_jobs, args.min_free_memory, args.max_load)
+    start_up(args.infile, args.cache, args.outdir, args.only_gender, args.render_type, args.id_list, args.set_list,
+             args.renderer_mode, args.jobs, args.shard_size, args.force, args.changed_since, trace, args.resume,
+             args.max_attempts, args.retry_backoff, parse_shard(args.shard) if args.shard else None, args.optimize,
+             args.trim, concurrency, args.stream)
+    if args.metrics:
+        trace.write_metrics(args.metrics)
+    trace.close()
 
 
 def start_up(infile: str, cache: str, outdir: str, only_gender: Optional[str], only_render: Optional[str],
-             only_ids_file: Optional[str], set_list: Optional[str]):
+             only_ids_file: Optional[str], set_list: Optional[str], renderer_mode: str = 'process',
+             num_jobs: int = DEFAULT_JOBS, shard_size: int = DEFAULT_SHARD_SIZE,
+             force: bool = False, changed_since: Optional[str] = None,
+             trace: Optional[RunTrace] = None, resume: bool = False, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+             retry_backoff: float = DEFAULT_RETRY_BACKOFF, shard: Optional[Shard] = None, optimize: bool = False,
+             trim: bool = False, concurrency: Optional[ConcurrencyLimits] = None,
+             stream: bool = False) -> List[JobOutcome]:
+    only_ids = get_only_ids(cache, only_ids_file, changed_since)
+    return run_jobs(infile, cache, outdir, only_gender, only_render, only_ids, set_list, renderer_mode, num_jobs,
+                    shard_size, force, trace, resume, max_attempts, retry_backoff, shard, optimize, trim, concurrency,
+                    stream)
+
+
+def get_only_ids(cache: str, only_ids_file: Optional[str], changed_since: Optional[str]) -> Optional[List[int]]:
     only_ids = None
     if only_ids_file is not None:
         only_ids = [int(item_id) for item_id in open(only_ids_file).read().split(',')]
-    run_jobs(infile, cache, outdir, only_gender, only_render, only_ids, set_list)
+    if changed_since is not None:
+        changed_ids = set(cache_diff.get_changed_items(changed_since, cache))
+        print(f'{len(changed_ids)} items changed since {changed_since}')
+        if only_ids is None:
+            only_ids = list(changed_ids)
+        only_ids = [item_id for item_id in only_ids if item_id in changed_ids]
+    return only_ids
 
 
 if __name__ == '__main__':
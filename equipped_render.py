@@ -1,53 +1,86 @@
-import copy
 import json
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 
 class IncompleteDataException(BaseException):
     pass
 
 
-@dataclass
+# Kit fields are stored as tuples, which are smaller than lists and cannot be changed under the cached kits
+KIT_FIELDS = ('male_playerkit', 'male_colorkit', 'female_playerkit', 'female_colorkit', 'zero_bitmap')
+# Every field, in csv column order
+FIELDS = ('item_id', 'page_name', 'infobox_version',
+          'male_file_name', 'male_playerkit', 'male_colorkit',
+          'female_file_name', 'female_playerkit', 'female_colorkit',
+          'zero_bitmap', 'equip_slot', 'pose_anim', 'xan2d', 'yan2d', 'zan2d')
+
+
+def to_kit(kit: Optional[Iterable[int]]) -> Optional[Tuple[int, ...]]:
+    return tuple(kit) if kit is not None else None
+
+
 class EquippedRender:
-    # Fields about the item
-    item_id: int
-    page_name: str
-    infobox_version: str
-
-    # Male specific fields
-    male_file_name: Optional[str] = ''
-    male_playerkit: Optional[List[int]] = None
-    male_colorkit: Optional[List[int]] = None
-
-    # Female specific fields
-    female_file_name: Optional[str] = ''
-    female_playerkit: Optional[List[int]] = None
-    female_colorkit: Optional[List[int]] = None
-
-    # Fields for generating images
-    zero_bitmap: Optional[List[int]] = None
-    equip_slot: int = -1
-    pose_anim: int = -1
-    xan2d: int = -1
-    yan2d: int = -1
-    zan2d: int = -1
+    # Slotted so that holding every row of the sheet in memory is cheap.
+    # The complete playerkit of each gender is worked out once, the first time it is needed, so fields should not be
+    # changed after that.
+    __slots__ = FIELDS + ('male_complete_playerkit', 'female_complete_playerkit')
+
+    def __init__(self, item_id: int, page_name: str, infobox_version: str,
+                 male_file_name: Optional[str] = '', male_playerkit: Optional[List[int]] = None,
+                 male_colorkit: Optional[List[int]] = None,
+                 female_file_name: Optional[str] = '', female_playerkit: Optional[List[int]] = None,
+                 female_colorkit: Optional[List[int]] = None,
+                 zero_bitmap: Optional[List[int]] = None, equip_slot: int = -1, pose_anim: int = -1,
+                 xan2d: int = -1, yan2d: int = -1, zan2d: int = -1):
+        # Fields about the item
+        self.item_id = item_id
+        self.page_name = page_name
+        self.infobox_version = infobox_version
+
+        # Male specific fields
+        self.male_file_name = male_file_name
+        self.male_playerkit = to_kit(male_playerkit)
+        self.male_colorkit = to_kit(male_colorkit)
+
+        # Female specific fields
+        self.female_file_name = female_file_name
+        self.female_playerkit = to_kit(female_playerkit)
+        self.female_colorkit = to_kit(female_colorkit)
+
+        # Fields for generating images
+        self.zero_bitmap = to_kit(zero_bitmap)
+        self.equip_slot = equip_slot
+        self.pose_anim = pose_anim
+        self.xan2d = xan2d
+        self.yan2d = yan2d
+        self.zan2d = zan2d
+
+        # Worked out from the fields above by get_complete_playerkit
+        self.male_complete_playerkit: Optional[Tuple[int, ...]] = None
+        self.female_complete_playerkit: Optional[Tuple[int, ...]] = None
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, EquippedRender):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in FIELDS)
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in FIELDS)
+        return f'EquippedRender({fields})'
 
     def get_file_name(self, is_female: bool) -> str:
         if is_female:
             return self.female_file_name
         return self.male_file_name
 
-    def get_playerkit(self, is_female: bool) -> List[int]:
-        if is_female:
-            return self.female_playerkit
-        return self.male_playerkit
+    def get_playerkit(self, is_female: bool) -> Optional[List[int]]:
+        playerkit = self.female_playerkit if is_female else self.male_playerkit
+        return list(playerkit) if playerkit is not None else None
 
-    def get_colorkit(self, is_female: bool) -> List[int]:
+    def get_colorkit(self, is_female: bool) -> Optional[List[int]]:
         # Colorkit order: hair, shirt, pants, boots, skin
-        if is_female:
-            return self.female_colorkit
-        return self.male_colorkit
+        colorkit = self.female_colorkit if is_female else self.male_colorkit
+        return list(colorkit) if colorkit is not None else None
 
     def has_zero_bitmap(self) -> bool:
         return bool(self.zero_bitmap)
@@ -68,30 +101,37 @@ class EquippedRender:
         return self.zan2d != -1
 
     def get_complete_playerkit(self, is_female: bool) -> Optional[List[int]]:
-        # Determine which playerkit we want
-        playerkit = self.get_playerkit(is_female)
+        complete_playerkit = self.female_complete_playerkit if is_female else self.male_complete_playerkit
+        if complete_playerkit is None:
+            # Determine which playerkit we want
+            playerkit = self.female_playerkit if is_female else self.male_playerkit
 
-        # If we are missing any crucial pieces throw an error
-        if not (playerkit and self.has_equip_slot() and self.has_zero_bitmap()):
-            raise IncompleteDataException()
+            # If we are missing any crucial pieces throw an error
+            if not (playerkit and self.has_equip_slot() and self.has_zero_bitmap()):
+                raise IncompleteDataException()
 
-        # Copy the base playerkit
-        playerkit_copy = copy.deepcopy(playerkit)
+            # Replace equip slot with the item
+            playerkit_copy = list(playerkit)
+            playerkit_copy[self.equip_slot] = self.item_id + 2048
 
-        # Replace equip slot with the item
-        playerkit_copy[self.equip_slot] = self.item_id + 2048
+            # Hide all needed slots from zbm
+            for i, val in enumerate(self.zero_bitmap):
+                if val == 0:
+                    playerkit_copy[i] = 0
 
-        # Hide all needed slots from zbm
-        for i, val in enumerate(self.zero_bitmap):
-            if val == 0:
-                playerkit_copy[i] = 0
+            complete_playerkit = tuple(playerkit_copy)
+            if is_female:
+                self.female_complete_playerkit = complete_playerkit
+            else:
+                self.male_complete_playerkit = complete_playerkit
 
-        return playerkit_copy
+        # Callers are free to change the list they get back
+        return list(complete_playerkit)
 
     def can_render(self, is_female: bool) -> bool:
-        if not self.get_playerkit(is_female):
+        if not (self.female_playerkit if is_female else self.male_playerkit):
             return False
-        if not self.get_colorkit(is_female):
+        if not (self.female_colorkit if is_female else self.male_colorkit):
             return False
         if not self.has_zero_bitmap():
             return False
@@ -108,7 +148,11 @@ class EquippedRender:
         return True
 
     def to_dict(self) -> Dict[str, Any]:
-        return self.__dict__
+        data = {name: getattr(self, name) for name in FIELDS}
+        for name in KIT_FIELDS:
+            if data[name] is not None:
+                data[name] = list(data[name])
+        return data
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'EquippedRender':
@@ -134,7 +178,7 @@ class EquippedRender:
 
     @staticmethod
     def get_csv_headers() -> List[str]:
-        return list(EquippedRender.__dict__['__dataclass_fields__'].keys())
+        return list(FIELDS)
 
 
 class ItemSet:
@@ -0,0 +1,97 @@
+# Stand-in for the renderer jar, for benchmarks and testing on a box without a JVM or a cache.
+# Takes the same arguments as the renderer (single image, --stdin-jobs and --manifest) and writes a small PNG to the
+# same path the renderer would. Use it with RENDERER_COMMAND="python3 fake_renderer.py".
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List
+
+# Seconds to wait before the first job, like JVM startup and the cache load
+STARTUP_SECONDS = float(os.environ.get('FAKE_RENDERER_STARTUP', '0'))
+# Seconds each image takes
+LATENCY_SECONDS = float(os.environ.get('FAKE_RENDERER_LATENCY', '0'))
+IMAGE_SIZE = 8
+FLAGS = {'--playerfemale', '--playerchathead', '--lowres', '--crophead', '--stdin-jobs'}
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def make_png(colour: bytes, size: int = IMAGE_SIZE) -> bytes:
+    # A single colour RGBA image, built by hand so the stand-in starts as fast as possible
+    header = struct.pack('>IIBBBBB', size, size, 8, 6, 0, 0, 0)
+    row = b'\x00' + colour[:3] + b'\xff'
+    pixels = row[:1] + row[1:] * size
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + png_chunk(b'IDAT', zlib.compress(pixels * size)) +
+            png_chunk(b'IEND', b''))
+
+
+def parse_args(args: List[str]) -> Dict[str, str]:
+    parsed = {}
+    i = 0
+    while i < len(args):
+        if args[i] in FLAGS:
+            parsed[args[i]] = ''
+            i += 1
+        else:
+            parsed[args[i]] = args[i + 1]
+            i += 2
+    return parsed
+
+
+def render(args: List[str]):
+    parsed = parse_args(args)
+    if LATENCY_SECONDS:
+        time.sleep(LATENCY_SECONDS)
+    playerkit = [int(k) for k in parsed['--playerkit'].split(',')]
+    colorkit = [int(k) for k in parsed['--playercolors'].split(',')]
+    out_dir = Path(parsed['--out']).joinpath('playerchathead' if '--playerchathead' in parsed else 'player')
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # Same inputs always give the same image, like the real renderer
+    inputs = sorted((name, value) for name, value in parsed.items() if name not in ('--out', '--cache'))
+    colour = hashlib.md5(json.dumps(inputs).encode('utf-8')).digest()
+    out_dir.joinpath(f'{playerkit}_{colorkit}.png').write_bytes(make_png(colour))
+
+
+def entry_to_args(entry: Dict) -> List[str]:
+    args = ['--out', entry['out'], '--playerkit', ','.join(str(k) for k in entry['playerkit']),
+            '--playercolors', ','.join(str(k) for k in entry['playercolors'])]
+    if entry.get('female'):
+        args.append('--playerfemale')
+    if entry.get('chathead'):
+        args += ['--playerchathead', '--anim', str(entry.get('anim', 589)), '--lowres', '--crophead',
+                 '--yan2d', str(entry.get('yan2d', 128))]
+    else:
+        args += ['--poseanim', str(entry['poseanim']), '--xan2d', str(entry['xan2d']), '--yan2d', str(entry['yan2d']),
+                 '--zan2d', str(entry['zan2d'])]
+    return args
+
+
+def main():
+    args = sys.argv[1:]
+    if STARTUP_SECONDS:
+        time.sleep(STARTUP_SECONDS)
+    if '--manifest' in args:
+        for line in open(args[args.index('--manifest') + 1], 'r'):
+            render(entry_to_args(json.loads(line)))
+    elif '--stdin-jobs' in args:
+        for line in sys.stdin:
+            request = json.loads(line)
+            try:
+                render(request['args'])
+                response = {'id': request['id'], 'ok': True}
+            except (KeyError, ValueError, OSError) as e:
+                response = {'id': request['id'], 'ok': False, 'error': str(e)}
+            print(json.dumps(response), flush=True)
+    else:
+        render(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Sets of items rendered together on one player, for outfit and set pages
+import csv
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Union
+
+from compiled_sheet import CompiledSheet
+from equipped_render import EquippedRender, ItemSet
+from render_jobs import CHATHEAD, PLAYER, RenderJob
+
+# Used when the set list does not give a pose or angle
+SET_POSE_ANIM = 808
+SET_XAN2D = 96
+SET_YAN2D = 0
+SET_ZAN2D = 0
+
+
+@dataclass
+class SetRow:
+    item_ids: List[int]
+    pose_anim: int = SET_POSE_ANIM
+    xan2d: int = SET_XAN2D
+    yan2d: int = SET_YAN2D
+    zan2d: int = SET_ZAN2D
+    # Renamed file names, sets without one are rendered but not renamed
+    male_file_name: str = ''
+    female_file_name: str = ''
+
+    def get_file_name(self, is_female: bool) -> str:
+        if is_female:
+            return self.female_file_name
+        return self.male_file_name
+
+
+def strip_file_link(file_name: str) -> str:
+    # Accept file names with or without the [[File:...]] wrapper the sheet uses
+    if file_name.startswith('[[File:') and file_name.endswith(']]'):
+        return file_name[7:-2]
+    return file_name
+
+
+def read_int(line: Dict[str, str], column: str, default: int) -> int:
+    value = line.get(column)
+    return int(value) if value else default
+
+
+def validate_set_list(set_list: str) -> bool:
+    if not Path(set_list).is_file():
+        print('Set list file does not exist!')
+        return False
+    try:
+        load_sets(set_list)
+    except (KeyError, ValueError):
+        print('Set list must have an item_ids column of comma separated ids, and whole numbers for any angles!')
+        return False
+    return True
+
+
+def load_sets(set_list: str) -> List[SetRow]:
+    sets = []
+    for line in csv.DictReader(open(set_list, 'r'), dialect='excel'):
+        sets.append(SetRow(item_ids=[int(item_id) for item_id in line['item_ids'].split(',')],
+                           pose_anim=read_int(line, 'pose_anim', SET_POSE_ANIM),
+                           xan2d=read_int(line, 'xan2d', SET_XAN2D),
+                           yan2d=read_int(line, 'yan2d', SET_YAN2D),
+                           zan2d=read_int(line, 'zan2d', SET_ZAN2D),
+                           male_file_name=strip_file_link(line.get('male_file_name') or ''),
+                           female_file_name=strip_file_link(line.get('female_file_name') or '')))
+    return sets
+
+
+class SheetIndex:
+    # Where in the csv the row of each item id asked for starts, so sets can look items up without loading the whole
+    # sheet. Only the ids asked for are indexed, so the index stays tiny however big the sheet is.
+
+    def __init__(self, infile: str, item_ids: Set[int]):
+        self.infile = infile
+        self.offsets: Dict[int, int] = {}
+        with open(infile, 'rb') as f:
+            # The reader pulls one line at a time, so after each row the file is at the start of the next one
+            reader = csv.reader((line.decode('utf-8') for line in iter(f.readline, b'')), dialect='excel')
+            self.headers = next(reader)
+            id_column = self.headers.index('item_id')
+            offset = f.tell()
+            for row in reader:
+                # Later rows win, like they do in a compiled sheet
+                if row and int(row[id_column]) in item_ids:
+                    self.offsets[int(row[id_column])] = offset
+                offset = f.tell()
+
+    def find(self, item_id: int) -> Optional[EquippedRender]:
+        offset = self.offsets.get(item_id)
+        if offset is None:
+            return None
+        with open(self.infile, 'rb') as f:
+            f.seek(offset)
+            row = next(csv.reader((line.decode('utf-8') for line in iter(f.readline, b'')), dialect='excel'))
+        return EquippedRender.from_dict(dict(zip(self.headers, row)))
+
+
+def create_set_jobs(sheet: Union[CompiledSheet, SheetIndex], sets: List[SetRow], only_gender: Optional[str],
+                    only_render: Optional[str]) -> List[RenderJob]:
+    # Sets only have full player renders
+    if only_render == CHATHEAD:
+        return []
+    jobs = []
+    for item_set in sets:
+        items = [sheet.find(item_id) for item_id in item_set.item_ids]
+        if any(item is None for item in items):
+            print(f'Set {item_set.item_ids}: Item missing from the sheet...Skipping...')
+            continue
+        for is_female in [False, True]:
+            if only_gender == ('male' if is_female else 'female'):
+                continue
+            if not all(item.can_render(is_female) for item in items):
+                print(f'Set {item_set.item_ids}: Incomplete {"female" if is_female else "male"} data...Skipping...')
+                continue
+            renders = ItemSet(items)
+            jobs.append(RenderJob(render_type=PLAYER, is_female=is_female,
+                                  playerkit=renders.get_complete_playerkit(is_female),
+                                  colorkit=renders.get_colorkit(is_female),
+                                  pose_anim=item_set.pose_anim, xan2d=item_set.xan2d, yan2d=item_set.yan2d,
+                                  zan2d=item_set.zan2d, item_id=item_set.item_ids[0],
+                                  file_name=item_set.get_file_name(is_female)))
+    return jobs
@@ -0,0 +1,255 @@
+import bz2
+import gzip
+import mmap
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+# Reads groups out of the game's on disk cache (main_file_cache.dat2 + main_file_cache.idxN)
+DAT_FILE = 'main_file_cache.dat2'
+IDX_FILE = 'main_file_cache.idx{}'
+IDX_ENTRY_SIZE = 6
+SECTOR_SIZE = 520
+# Index 255 holds the reference table of every other index
+REFERENCE_INDEX = 255
+CONFIG_INDEX = 2
+ITEM_CONFIG_GROUP = 10
+MODEL_INDEX = 7
+
+# Reference table flags
+FLAG_NAMES = 0x1
+FLAG_DIGESTS = 0x2
+FLAG_LENGTHS = 0x4
+FLAG_UNCOMPRESSED_CHECKSUMS = 0x8
+
+# Item config opcodes that point at models used when the item is worn
+ITEM_MODEL_OPCODES = {23, 24, 25, 26, 78, 79, 90, 91, 92, 93}
+
+
+class CacheFormatException(Exception):
+    pass
+
+
+@dataclass
+class GroupInfo:
+    crc: int
+    version: int
+    file_ids: List[int] = field(default_factory=list)
+
+
+class Buffer:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def read(self, fmt: str) -> int:
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def read_u8(self) -> int:
+        return self.read('>B')
+
+    def read_u16(self) -> int:
+        return self.read('>H')
+
+    def read_u24(self) -> int:
+        value = int.from_bytes(self.data[self.pos:self.pos + 3], 'big')
+        self.pos += 3
+        return value
+
+    def read_i32(self) -> int:
+        return self.read('>i')
+
+    def read_u32(self) -> int:
+        return self.read('>I')
+
+    def read_versioned_smart(self, protocol: int) -> int:
+        # Protocol 7 and up use a big smart: a short, or an int with the top bit set
+        if protocol >= 7 and self.data[self.pos] & 0x80:
+            return self.read_u32() & 0x7FFFFFFF
+        return self.read_u16()
+
+    def skip_string(self):
+        self.pos = self.data.index(0, self.pos) + 1
+
+    def skip(self, num_bytes: int):
+        self.pos += num_bytes
+
+
+def decompress_container(container: bytes) -> bytes:
+    compression = container[0]
+    length = struct.unpack_from('>I', container, 1)[0]
+    if compression == 0:
+        return container[5:5 + length]
+    data = container[9:9 + length]
+    if compression == 1:
+        # The cache strips the bzip2 header
+        return bz2.decompress(b'BZh1' + data)
+    if compression == 2:
+        return gzip.decompress(data)
+    raise CacheFormatException(f'Unsupported compression type {compression}')
+
+
+def split_group(data: bytes, file_ids: List[int]) -> Dict[int, bytes]:
+    if len(file_ids) == 1:
+        return {file_ids[0]: data}
+    # Files are stored in stripes, the last byte is the stripe count and before it is a table of chunk sizes
+    stripes = data[-1]
+    buf = Buffer(data)
+    buf.pos = len(data) - 1 - stripes * len(file_ids) * 4
+    files = [bytearray() for _ in file_ids]
+    offset = 0
+    for _ in range(stripes):
+        chunk_size = 0
+        for i in range(len(file_ids)):
+            chunk_size += buf.read_i32()
+            files[i] += data[offset:offset + chunk_size]
+            offset += chunk_size
+    return {file_id: bytes(f) for file_id, f in zip(file_ids, files)}
+
+
+def get_item_model_ids(data: bytes) -> Tuple[Set[int], bool]:
+    # Only reads as far as needed, unknown opcodes stop the parse since their length is unknown
+    # Returns the model ids found and whether the whole definition was read, if not there may be more models after
+    model_ids = set()
+    buf = Buffer(data)
+    try:
+        while True:
+            opcode = buf.read_u8()
+            if opcode == 0:
+                return model_ids, True
+            if opcode in ITEM_MODEL_OPCODES:
+                model_ids.add(buf.read_u16())
+                # The first male and female models are followed by a y offset
+                if opcode in (23, 25):
+                    buf.skip(1)
+            elif opcode in (1, 4, 5, 6, 7, 8, 75, 94, 95, 97, 98, 110, 111, 112, 139, 140, 148, 149):
+                buf.skip(2)
+            elif opcode in (2, 3, 9) or 30 <= opcode < 40:
+                buf.skip_string()
+            elif opcode in (11, 16, 65):
+                pass
+            elif opcode == 12:
+                buf.skip(4)
+            elif opcode in (13, 14, 27, 42, 113, 114, 115):
+                buf.skip(1)
+            elif opcode in (40, 41):
+                buf.skip(buf.read_u8() * 4)
+            elif opcode == 43:
+                buf.skip(1)
+                while buf.read_u8() != 0:
+                    buf.skip_string()
+            elif 100 <= opcode < 110:
+                buf.skip(4)
+            elif opcode == 249:
+                for _ in range(buf.read_u8()):
+                    is_string = buf.read_u8() == 1
+                    buf.skip(3)
+                    if is_string:
+                        buf.skip_string()
+                    else:
+                        buf.skip(4)
+            else:
+                break
+    except (struct.error, ValueError):
+        pass
+    return model_ids, False
+
+
+class Js5Cache:
+
+    def __init__(self, cache_dir: str):
+        self.path = Path(cache_dir)
+        dat_file = open(self.path.joinpath(DAT_FILE), 'rb')
+        self.dat = mmap.mmap(dat_file.fileno(), 0, access=mmap.ACCESS_READ)
+        dat_file.close()
+        self.indexes: Dict[int, bytes] = {}
+
+    def get_index(self, index_id: int) -> bytes:
+        if index_id not in self.indexes:
+            idx_path = self.path.joinpath(IDX_FILE.format(index_id))
+            self.indexes[index_id] = idx_path.read_bytes() if idx_path.is_file() else b''
+        return self.indexes[index_id]
+
+    def read_container(self, index_id: int, group_id: int) -> Optional[bytes]:
+        index = self.get_index(index_id)
+        entry = group_id * IDX_ENTRY_SIZE
+        if entry + IDX_ENTRY_SIZE > len(index):
+            return None
+        size = int.from_bytes(index[entry:entry + 3], 'big')
+        sector = int.from_bytes(index[entry + 3:entry + 6], 'big')
+        if size == 0 or sector == 0:
+            return None
+
+        # Groups with big ids use a longer sector header
+        extended = group_id > 0xFFFF
+        header_size = 10 if extended else 8
+        data = bytearray()
+        part = 0
+        while len(data) < size:
+            buf = Buffer(self.dat[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE])
+            sector_group = buf.read_u32() if extended else buf.read_u16()
+            sector_part = buf.read_u16()
+            next_sector = buf.read_u24()
+            sector_index = buf.read_u8()
+            if (sector_group, sector_part, sector_index) != (group_id, part, index_id):
+                raise CacheFormatException(f'Corrupt sector {sector} in group {index_id}/{group_id}')
+            chunk_size = min(size - len(data), SECTOR_SIZE - header_size)
+            data += buf.data[header_size:header_size + chunk_size]
+            sector = next_sector
+            part += 1
+        return bytes(data)
+
+    def read_group(self, index_id: int, group_id: int) -> Optional[bytes]:
+        container = self.read_container(index_id, group_id)
+        return decompress_container(container) if container is not None else None
+
+    def read_reference_table(self, index_id: int) -> Dict[int, GroupInfo]:
+        data = self.read_group(REFERENCE_INDEX, index_id)
+        if data is None:
+            return {}
+        buf = Buffer(data)
+        protocol = buf.read_u8()
+        if protocol >= 6:
+            buf.skip(4)
+        flags = buf.read_u8()
+        num_groups = buf.read_versioned_smart(protocol)
+        group_ids = []
+        group_id = 0
+        for _ in range(num_groups):
+            group_id += buf.read_versioned_smart(protocol)
+            group_ids.append(group_id)
+        if flags & FLAG_NAMES:
+            buf.skip(4 * num_groups)
+        crcs = [buf.read_u32() for _ in group_ids]
+        if flags & FLAG_UNCOMPRESSED_CHECKSUMS:
+            buf.skip(4 * num_groups)
+        if flags & FLAG_DIGESTS:
+            buf.skip(64 * num_groups)
+        if flags & FLAG_LENGTHS:
+            buf.skip(8 * num_groups)
+        versions = [buf.read_u32() for _ in group_ids]
+        num_files = [buf.read_versioned_smart(protocol) for _ in group_ids]
+
+        groups = {}
+        for group_id, crc, version, count in zip(group_ids, crcs, versions, num_files):
+            info = GroupInfo(crc, version)
+            file_id = 0
+            for _ in range(count):
+                file_id += buf.read_versioned_smart(protocol)
+                info.file_ids.append(file_id)
+            groups[group_id] = info
+        return groups
+
+    def read_item_configs(self) -> Dict[int, bytes]:
+        group_info = self.read_reference_table(CONFIG_INDEX).get(ITEM_CONFIG_GROUP)
+        data = self.read_group(CONFIG_INDEX, ITEM_CONFIG_GROUP)
+        if group_info is None or data is None:
+            raise CacheFormatException(f'Cache at {self.path} has no item configs')
+        return split_group(data, group_info.file_ids)
+
+    def close(self):
+        self.dat.close()
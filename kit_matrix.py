@@ -0,0 +1,148 @@
+# Works out the complete kits of every row of a compiled sheet at once, instead of one EquippedRender at a time
+import hashlib
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from compiled_sheet import CompiledSheet
+from render_jobs import CHATHEAD, PLAYER, RenderJob, RenderPlan
+
+# Item ids are offset by this in a playerkit, lower values are identity kits
+ITEM_KIT_OFFSET = 2048
+ANGLE_COLUMNS = ['pose_anim', 'xan2d', 'yan2d', 'zan2d']
+# Chatheads always use the renderer's own angles
+CHATHEAD_ANGLES = (-1, -1, -1, -1)
+
+
+@dataclass
+class KitMatrix:
+    is_female: bool
+    # One row per sheet row, padded past each row's length
+    playerkits: np.ndarray
+    playerkit_lengths: np.ndarray
+    colorkits: np.ndarray
+    colorkit_lengths: np.ndarray
+    can_render: np.ndarray
+
+    def get_playerkit(self, row: int) -> List[int]:
+        return self.playerkits[row, :self.playerkit_lengths[row]].tolist()
+
+    def get_colorkit(self, row: int) -> List[int]:
+        return self.colorkits[row, :self.colorkit_lengths[row]].tolist()
+
+    def get_playerkits(self) -> List[List[int]]:
+        return to_lists(self.playerkits, self.playerkit_lengths)
+
+    def get_colorkits(self) -> List[List[int]]:
+        return to_lists(self.colorkits, self.colorkit_lengths)
+
+
+def to_lists(kits: np.ndarray, lengths: np.ndarray) -> List[List[int]]:
+    # Every kit of a sheet is usually the same length, then the whole matrix converts in one go
+    if (lengths == kits.shape[1]).all():
+        return kits.tolist()
+    return [kit[:max(length, 0)].tolist() for kit, length in zip(kits, lengths)]
+
+
+def compute_kits(sheet: CompiledSheet, is_female: bool) -> KitMatrix:
+    gender = 'female' if is_female else 'male'
+    arrays = sheet.arrays
+    playerkit_lengths = arrays[f'{gender}_playerkit_len']
+    colorkit_lengths = arrays[f'{gender}_colorkit_len']
+    zero_bitmaps = arrays['zero_bitmap']
+    equip_slots = arrays['equip_slot']
+
+    # Same checks as EquippedRender.can_render, missing kits have a length of -1
+    can_render = ((playerkit_lengths > 0) & (colorkit_lengths > 0) & (arrays['zero_bitmap_len'] > 0) &
+                  (equip_slots != -1) & (arrays['pose_anim'] != -1) & (arrays['xan2d'] != -1) &
+                  (arrays['yan2d'] != -1) & (arrays['zan2d'] != -1))
+    # An equip slot outside the playerkit cannot be rendered either
+    can_render &= (equip_slots >= 0) & (equip_slots < playerkit_lengths)
+
+    # Replace the equip slot of every row with its item, then hide every slot its zero bitmap hides
+    playerkits = np.array(arrays[f'{gender}_playerkit'])
+    rows = np.flatnonzero(can_render)
+    if playerkits.shape[1]:
+        playerkits[rows, equip_slots[rows]] = sheet.item_ids[rows] + ITEM_KIT_OFFSET
+    width = min(playerkits.shape[1], zero_bitmaps.shape[1])
+    columns = np.arange(width)
+    hidden = (zero_bitmaps[:, :width] == 0) & (columns < arrays['zero_bitmap_len'][:, None])
+    playerkits[:, :width][hidden] = 0
+
+    return KitMatrix(is_female=is_female, playerkits=playerkits, playerkit_lengths=playerkit_lengths,
+                     colorkits=arrays[f'{gender}_colorkit'], colorkit_lengths=colorkit_lengths, can_render=can_render)
+
+
+def get_kit_text(kit: List[int]) -> str:
+    # Same text json.dumps gives for a list of ints
+    return f'[{", ".join(map(str, kit))}]'
+
+
+def get_key_text(render_type: str, is_female: bool, playerkit_text: str, colorkit_text: str,
+                 angles: Tuple[int, int, int, int]) -> str:
+    # Same text json.dumps gives for the key list hashed by RenderJob.get_render_key, without going through the encoder
+    return (f'["{render_type}", {"true" if is_female else "false"}, {playerkit_text}, {colorkit_text}, '
+            f'{angles[0]}, {angles[1]}, {angles[2]}, {angles[3]}]')
+
+
+def hash_key_text(key_text: str) -> str:
+    return hashlib.sha1(key_text.encode('utf-8')).hexdigest()
+
+
+def get_player_angles(sheet: CompiledSheet) -> List[Tuple[int, int, int, int]]:
+    # (pose_anim, xan2d, yan2d, zan2d) of every row
+    angles = np.stack([sheet.arrays[column] for column in ANGLE_COLUMNS], axis=1).tolist()
+    return [tuple(row_angles) for row_angles in angles]
+
+
+def create_plan(sheet: CompiledSheet, only_gender: Optional[str], only_render: Optional[str],
+                only_ids: Optional[List[int]]) -> RenderPlan:
+    # Builds the same plan as calling create_jobs on every row, in the same order
+    genders = [is_female for is_female in [False, True] if only_gender != ('male' if is_female else 'female')]
+    kits_by_gender = [compute_kits(sheet, is_female) for is_female in genders]
+    render_types = [render_type for render_type in [PLAYER, CHATHEAD] if only_render in (None, render_type)]
+    # Plain lists are much faster to index one row at a time than arrays
+    item_ids = sheet.item_ids.tolist()
+    equip_slots = sheet.arrays['equip_slot'].tolist()
+    player_angles = get_player_angles(sheet)
+    gender_lists = [(kits.is_female, kits.can_render.tolist(), kits.get_playerkits(), kits.get_colorkits())
+                    for kits in kits_by_gender]
+
+    plan = RenderPlan()
+    for row in sheet.get_rows(only_ids).tolist():
+        for is_female, can_render, playerkits, colorkits in gender_lists:
+            if not can_render[row]:
+                continue
+            playerkit = playerkits[row]
+            colorkit = colorkits[row]
+            playerkit_text = get_kit_text(playerkit)
+            colorkit_text = get_kit_text(colorkit)
+            # Strip the [[File:...]] wrapper from the file name
+            file_name = sheet.get_string('female_file_name' if is_female else 'male_file_name', row)[7:-2]
+            for render_type in render_types:
+                if render_type == CHATHEAD:
+                    # Chatheads only make sense for head slot items
+                    if equip_slots[row] != 0:
+                        continue
+                    angles = CHATHEAD_ANGLES
+                    job_file_name = file_name.replace('equipped', 'chathead')
+                else:
+                    angles = player_angles[row]
+                    job_file_name = file_name
+                key_text = get_key_text(render_type, is_female, playerkit_text, colorkit_text, angles)
+                job = RenderJob(render_type=render_type, is_female=is_female, playerkit=playerkit, colorkit=colorkit,
+                                pose_anim=angles[0], xan2d=angles[1], yan2d=angles[2], zan2d=angles[3],
+                                item_id=item_ids[row], file_name=job_file_name, render_key=hash_key_text(key_text))
+                plan.add(job)
+    return plan
+
+
+def get_incomplete_rows(sheet: CompiledSheet, only_ids: Optional[List[int]] = None) -> np.ndarray:
+    # Rows that have a file name for a gender but not enough data to render it
+    rows = np.zeros(len(sheet), dtype=bool)
+    for is_female in [False, True]:
+        gender = 'female' if is_female else 'male'
+        has_file_name = np.diff(sheet.arrays[f'{gender}_file_name_offsets']) > 0
+        rows |= has_file_name & ~compute_kits(sheet, is_female).can_render
+    return np.intersect1d(np.flatnonzero(rows), sheet.get_rows(only_ids))
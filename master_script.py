@@ -1,7 +1,78 @@
 import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from tqdm import tqdm
 
 import create_renders
 import rename_files
+from concurrency import (DEFAULT_MAX_LOAD, DEFAULT_MIN_FREE_MEMORY, ConcurrencyLimits, parse_concurrency_limits,
+                         validate_concurrency_limits)
+from render_index import RenderIndex, get_index_path
+from render_jobs import RenderJob
+from renderer import DEFAULT_SHARD_SIZE, WORKER_TYPES, validate_worker_args
+from run_trace import RunTrace
+from scheduler import DEFAULT_JOBS, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BACKOFF
+from shards import parse_shard, validate_shard
+
+
+def run_pipeline(infile: str, cache: str, outdir: str, only_gender: Optional[str], only_render: Optional[str],
+                 only_ids_file: Optional[str], renderer_mode: str, num_jobs: int, shard_size: int, force: bool,
+                 changed_since: Optional[str], rename_mode: str, set_list: Optional[str] = None,
+                 trace: Optional[RunTrace] = None, resume: bool = False, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 retry_backoff: float = DEFAULT_RETRY_BACKOFF, optimize: bool = False, trim: bool = False,
+                 concurrency: Optional[ConcurrencyLimits] = None, stream: bool = False) -> int:
+    # Rename each render as soon as it is on disk instead of waiting for every render to finish
+    # Returns the number of renders whose rename raised
+    trace = trace or RunTrace()
+    only_ids = create_renders.get_only_ids(cache, only_ids_file, changed_since)
+    if stream:
+        plan = create_renders.load_stream_plan(infile, only_gender, only_render, only_ids, set_list)
+    else:
+        plan = create_renders.load_plan(infile, only_gender, only_render, only_ids, set_list)
+    renamed_dir = rename_files.get_renamed_dir(outdir)
+    rename_files.create_outdir_tree(renamed_dir)
+    # The number of renders in a streamed sheet is not known until it has all been read
+    rename_progress = tqdm(total=None if stream else len(plan.jobs_by_key), desc='Renaming', position=1)
+    # Shared with the render stage, so a moved render leaves the index after it was put in
+    index = RenderIndex(get_index_path(outdir))
+
+    def rename(jobs: List[RenderJob]):
+        files = rename_files.traced_rename_job_group(jobs, outdir, renamed_dir, rename_mode, trace)
+        if files and rename_mode == rename_files.MOVE:
+            index.remove([jobs[0].get_render_key()])
+        rename_progress.update(1)
+
+    # An exception on the executor's threads would otherwise only end up in a future nobody looks at
+    num_errors = 0
+    errors_lock = threading.Lock()
+
+    def check_rename(jobs: List[RenderJob], future: Future):
+        nonlocal num_errors
+        error = future.exception()
+        if error is None:
+            return
+        print(f'Could not rename {jobs[0].get_output_path(outdir)}: {error!r}')
+        trace.emit('rename', item_id=jobs[0].item_id, name=jobs[0].file_name, ok=False, files=0, duration=0.0,
+                   output_bytes=0, error=repr(error))
+        with errors_lock:
+            num_errors += 1
+
+    def submit_rename(executor: ThreadPoolExecutor, jobs: List[RenderJob]):
+        executor.submit(rename, jobs).add_done_callback(lambda future: check_rename(jobs, future))
+
+    trace.start_stage('rename')
+    with ThreadPoolExecutor(max_workers=rename_files.DEFAULT_RENAME_THREADS) as executor:
+        create_renders.render_plan(plan, cache, outdir, renderer_mode, num_jobs, shard_size, force,
+                                   on_ready=lambda jobs: submit_rename(executor, jobs), trace=trace, resume=resume,
+                                   max_attempts=max_attempts, retry_backoff=retry_backoff, optimize=optimize,
+                                   trim=trim, concurrency=concurrency, index=index)
+    index.close()
+    trace.end_stage('rename')
+    rename_progress.close()
+    trace.print_summary('rename')
+    return num_errors
 
 
 def main():
@@ -14,7 +85,50 @@ def main():
     parser.add_argument('--render-type', choices=['player', 'chathead'],
                         help='Only generate renders for the given type. Defaults to generating both.')
     parser.add_argument('--id-list', help='Only generate renders for the ids in this file (comma separated list)')
-    parser.add_argument('--set-list', help='Path to file for sets')
+    parser.add_argument('--set-list', help='Path to a csv of sets to render along with the items')
+    parser.add_argument('--renderer-mode', choices=list(WORKER_TYPES.keys()), default='process',
+                        help='process launches the renderer once per image, pool keeps renderers running and '
+                             'streams jobs to them, manifest launches the renderer once per shard of jobs. '
+                             'Defaults to process.')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help='Number of renderers to run at once. Defaults to the number of cores.')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Number of jobs per renderer launch in manifest mode. Defaults to {DEFAULT_SHARD_SIZE}.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the sheet a row at a time while rendering instead of loading it all first, for '
+                             'very big sheets. Best used with --pipeline.')
+    parser.add_argument('--adaptive-jobs',
+                        help='Adjust the number of renderers between MIN and MAX, given as MIN:MAX, from the load '
+                             'average, free memory and how fast jobs finish. Overrides --jobs.')
+    parser.add_argument('--min-free-memory', type=int, default=DEFAULT_MIN_FREE_MEMORY,
+                        help='MB of memory to keep free with --adaptive-jobs, renderers are stopped below this. '
+                             f'Defaults to {DEFAULT_MIN_FREE_MEMORY}.')
+    parser.add_argument('--max-load', type=float, default=DEFAULT_MAX_LOAD,
+                        help='Most load average per core with --adaptive-jobs, renderers are stopped above this. '
+                             f'Defaults to {DEFAULT_MAX_LOAD}.')
+    parser.add_argument('--force', action='store_true',
+                        help='Render everything, even renders that have not changed since the last run')
+    parser.add_argument('--changed-since', help='Path to an older cache, only items that changed since it are rendered')
+    parser.add_argument('--rename-mode', choices=rename_files.RENAME_MODES, default=rename_files.LINK,
+                        help='link hard links renamed files to the renders (copying if that is not possible), copy '
+                             'always copies and move moves the renders out of the renders dir. Defaults to link.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Rename each render as soon as it is done instead of after every render is done.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from where the last run stopped, skipping every render it finished')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'Times to try each render before giving up on it. Defaults to {DEFAULT_MAX_ATTEMPTS}.')
+    parser.add_argument('--retry-backoff', type=float, default=DEFAULT_RETRY_BACKOFF,
+                        help='Seconds to wait before retrying a failed render, doubled for every attempt after. '
+                             f'Defaults to {DEFAULT_RETRY_BACKOFF}.')
+    parser.add_argument('--shard', help='Only render shard K of N of the jobs, given as K/N, e.g. 2/4. Renders are '
+                                            'renamed by merge_shards.py once every shard is done.')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Recompress every render losslessly in a process pool before it is renamed')
+    parser.add_argument('--trim', action='store_true',
+                        help='Crop the transparent border off of every render, implies --optimize')
+    parser.add_argument('--trace', help='JSONL file to append an event for every render and rename to')
+    parser.add_argument('--metrics', help='File to write Prometheus metrics for the run to')
     args = parser.parse_args()
 
     infile = args.infile
@@ -24,15 +138,66 @@ def main():
     only_render = args.render_type
     only_ids_file = args.id_list
     set_list = args.set_list
+    renderer_mode = args.renderer_mode
+    num_jobs = args.jobs
+    shard_size = args.shard_size
+    force = args.force
+    changed_since = args.changed_since
+    rename_mode = args.rename_mode
+    pipeline = args.pipeline
+    resume = args.resume
+    max_attempts = args.max_attempts
+    retry_backoff = args.retry_backoff
+    optimize = args.optimize
+    trim = args.trim
 
-    rendering_valid = create_renders.validate_args(infile, cache, outdir, only_ids_file)
+    rendering_valid = create_renders.validate_args(infile, cache, outdir, only_ids_file, changed_since, set_list)
     renaming_valid = rename_files.validate_args(infile, outdir, only_ids_file, check_renders_dir=False)
     if not rendering_valid or not renaming_valid:
         exit(1)
+    if max_attempts < 1:
+        print('Max attempts must be at least 1!')
+        exit(1)
+    if not validate_worker_args(num_jobs, shard_size):
+        exit(1)
+    if args.shard and not validate_shard(args.shard):
+        exit(1)
+    if args.adaptive_jobs and not validate_concurrency_limits(args.adaptive_jobs):
+        exit(1)
+    if args.shard and pipeline:
+        print('A shard cannot be renamed on its own, leave out --pipeline!')
+        exit(1)
+
+    concurrency = None
+    if args.adaptive_jobs:
+        concurrency = parse_concurrency_limits(args.adaptive_jobs, args.min_free_memory, args.max_load)
 
-    # Note that the renders_dir for renaming is the outdir for rendering
-    create_renders.start_up(infile, cache, outdir, only_gender, only_render, only_ids_file, set_list)
-    rename_files.start_up(infile, outdir, None, only_gender, only_render, only_ids_file)
+    trace = RunTrace(args.trace)
+    num_rename_errors = 0
+    if pipeline:
+        num_rename_errors = run_pipeline(infile, cache, outdir, only_gender, only_render, only_ids_file,
+                                         renderer_mode, num_jobs, shard_size, force, changed_since, rename_mode,
+                                         set_list, trace, resume, max_attempts, retry_backoff, optimize, trim,
+                                         concurrency, args.stream)
+    elif args.shard:
+        # The other shards' renders are needed to rename, see merge_shards.py
+        create_renders.start_up(infile, cache, outdir, only_gender, only_render, only_ids_file, set_list,
+                                renderer_mode, num_jobs, shard_size, force, changed_since, trace, resume, max_attempts,
+                                retry_backoff, parse_shard(args.shard), optimize, trim, concurrency, args.stream)
+        print('Run merge_shards.py once every shard is done to rename the renders')
+    else:
+        # Note that the renders_dir for renaming is the outdir for rendering
+        create_renders.start_up(infile, cache, outdir, only_gender, only_render, only_ids_file, set_list,
+                                renderer_mode, num_jobs, shard_size, force, changed_since, trace, resume, max_attempts,
+                                retry_backoff, None, optimize, trim, concurrency, args.stream)
+        rename_files.start_up(infile, outdir, None, only_gender, only_render, only_ids_file, rename_mode,
+                              set_list=set_list, trace=trace)
+    if args.metrics:
+        trace.write_metrics(args.metrics)
+    trace.close()
+    if num_rename_errors:
+        print(f'{num_rename_errors} renders could not be renamed!')
+        exit(1)
 
 
 if __name__ == '__main__':
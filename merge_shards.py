@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from tqdm import tqdm
+
+import rename_files
+from item_sets import validate_set_list
+from render_index import RenderIndex, get_index_path
+from render_manifest import MANIFEST_VERSION, RenderManifest, get_manifest_path
+from shards import find_shard_paths, get_path_shard, get_shard_path
+
+# Combine the renders and manifests of every shard of a sharded run into one renders dir, then rename them
+
+
+def validate_args(infile: str, outdir: str, shard_dirs: List[str], only_ids_file: Optional[str],
+                  set_list: Optional[str]) -> bool:
+    if not rename_files.validate_args(infile, outdir, only_ids_file, check_renders_dir=False):
+        return False
+    for shard_dir in shard_dirs:
+        if not Path(shard_dir).is_dir():
+            print(f'Cannot find dir: {shard_dir}')
+            return False
+        if not find_shard_paths(get_manifest_path(shard_dir)):
+            print(f'No shard manifests next to {shard_dir}!')
+            return False
+    if set_list and not validate_set_list(set_list):
+        return False
+    return True
+
+
+def load_shard_manifests(shard_dirs: List[str]) -> Dict[Path, str]:
+    # Every shard manifest of the given dirs, and the dir holding its renders
+    manifests = {}
+    for shard_dir in shard_dirs:
+        for path in find_shard_paths(get_manifest_path(shard_dir)):
+            manifests[path] = shard_dir
+    shards = [get_path_shard(path, get_manifest_path(shard_dir)) for path, shard_dir in manifests.items()]
+    counts = {shard.count for shard in shards}
+    if len(counts) > 1:
+        print(f'Warning: the manifests are from runs split {len(counts)} different ways')
+    for count in counts:
+        missing = sorted(set(range(1, count + 1)) - {shard.index for shard in shards if shard.count == count})
+        if missing:
+            print(f'Warning: no manifest for shards {", ".join(f"{index}/{count}" for index in missing)}')
+    return manifests
+
+
+def merge_shards(outdir: str, shard_dirs: List[str], mode: str = rename_files.LINK) -> int:
+    # Returns the number of renders merged
+    merged = RenderManifest(get_manifest_path(outdir), outdir, '')
+    # When each render was rendered, from the shards' indexes
+    rendered: Dict[str, float] = {}
+    caches = set()
+    num_renders = 0
+    for manifest_path, shard_dir in load_shard_manifests(shard_dirs).items():
+        data = json.load(open(manifest_path, 'r'))
+        if data.get('version') != MANIFEST_VERSION:
+            print(f'Skipping {manifest_path}, it is from another version')
+            continue
+        entries: Dict[str, Dict[str, Any]] = data['entries']
+        same_dir = Path(shard_dir).resolve() == Path(outdir).resolve()
+        shard = get_path_shard(manifest_path, get_manifest_path(shard_dir))
+        shard_index_path = get_shard_path(get_index_path(shard_dir), shard)
+        if shard_index_path.is_file():
+            shard_index = RenderIndex(shard_index_path)
+            rendered.update({key: render.rendered for key, render in shard_index.get_renders(entries).items()})
+            shard_index.close()
+        for key, entry in tqdm(entries.items(), desc=f'Merging {manifest_path.name}'):
+            caches.add(entry['cache'])
+            existing = merged.entries.get(key)
+            if existing is not None and existing['sha1'] != entry['sha1']:
+                print(f'Warning: {entry["path"]} differs between shards, keeping the one from {manifest_path.name}')
+            # Shards run on the same box or shared storage already wrote to the outdir
+            if not same_dir:
+                path = Path(shard_dir).joinpath(entry['path'])
+                new_path = Path(outdir).joinpath(entry['path'])
+                if not path.is_file():
+                    print(f'Missing render {path}...Skipping...')
+                    continue
+                new_path.parent.mkdir(parents=True, exist_ok=True)
+                # Unless it was already linked by an earlier merge
+                if new_path.exists() and not os.path.samefile(path, new_path):
+                    new_path.unlink()
+                if not new_path.exists():
+                    rename_files.place_file(path, new_path, mode)
+            merged.entries[key] = entry
+            num_renders += 1
+    if len(caches) > 1:
+        print(f'Warning: the shards were rendered from {len(caches)} different caches')
+    merged.save()
+    # So renaming the merged outdir can look the renders up instead of looking for them
+    index = RenderIndex(get_index_path(outdir))
+    for key, entry in merged.entries.items():
+        index.record(key, entry, rendered=rendered.get(key))
+    index.close()
+    print(f'Merged {num_renders} renders into {outdir}')
+    return num_renders
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--infile', required=True, help='Path to the csv the shards were rendered from')
+    parser.add_argument('--outdir', default='renders', help='Folder to merge the renders into')
+    parser.add_argument('--shard-dirs', nargs='+', required=True,
+                        help='Renders dir of each shard, with its manifests next to it')
+    parser.add_argument('--only-gender', choices=['male', 'female'],
+                        help='Only rename renders for the given gender. Defaults to renaming both.')
+    parser.add_argument('--render-type', choices=['player', 'chathead'],
+                        help='Only rename renders for the given type. Defaults to renaming both.')
+    parser.add_argument('--id-list', help='Only rename renders for the ids in this file (comma separated list)')
+    parser.add_argument('--set-list', help='Path to a csv of sets to rename along with the items')
+    parser.add_argument('--rename-mode', choices=rename_files.RENAME_MODES, default=rename_files.LINK,
+                        help='How renders are merged and renamed: link hard links them (copying if that is not '
+                             'possible), copy always copies and move moves them. Defaults to link.')
+    args = parser.parse_args()
+
+    if not validate_args(args.infile, args.outdir, args.shard_dirs, args.id_list, args.set_list):
+        exit(1)
+
+    start_up(args.infile, args.outdir, args.shard_dirs, args.only_gender, args.render_type, args.id_list,
+             args.set_list, args.rename_mode)
+
+
+def start_up(infile: str, outdir: str, shard_dirs: List[str], only_gender: Optional[str], only_render: Optional[str],
+             only_ids_file: Optional[str], set_list: Optional[str], mode: str = rename_files.LINK):
+    merge_shards(outdir, shard_dirs, mode)
+    rename_files.start_up(infile, outdir, None, only_gender, only_render, only_ids_file, mode, set_list=set_list)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Compare images by their decoded pixels instead of their bytes, so recompressed PNGs still count as the same image
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from png_optimizer import get_pixel_hash
+
+# Differing pixels are drawn in this colour over a faded copy of the new image
+DIFF_COLOUR = (255, 0, 0, 255)
+DIFF_FADE = 0.3
+
+
+@dataclass
+class ImageDiff:
+    path: str
+    other_path: str
+    # Number of pixels that differ by more than the tolerance, 0 means the images match
+    diff_pixels: int = 0
+    # (left, top, right, bottom) of the differing pixels, right and bottom exclusive
+    bbox: Optional[Tuple[int, int, int, int]] = None
+    size_mismatch: bool = False
+    diff_image_path: Optional[str] = None
+    # Set if either image could not be decoded
+    error: str = ''
+    # Hash of the canonical pixels of the first image, like png_optimizer's
+    pixel_sha1: Optional[str] = None
+
+    def is_match(self) -> bool:
+        return self.diff_pixels == 0 and not self.size_mismatch and not self.error
+
+
+def load_rgba(path: str) -> np.ndarray:
+    with Image.open(path) as image:
+        pixels = np.asarray(image.convert('RGBA'), dtype=np.int16)
+    # Fully transparent pixels look the same whatever their colour, and encoders are free to change it
+    pixels = pixels.copy()
+    pixels[pixels[:, :, 3] == 0] = 0
+    return pixels
+
+
+def pad_to(pixels: np.ndarray, height: int, width: int) -> np.ndarray:
+    padded = np.zeros((height, width, 4), dtype=pixels.dtype)
+    padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+    return padded
+
+
+def write_diff_image(pixels: np.ndarray, mask: np.ndarray, path: Path):
+    diff = pixels.astype(np.float32)
+    diff[:, :, 3] *= DIFF_FADE
+    diff[mask] = DIFF_COLOUR
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(diff.astype(np.uint8), 'RGBA').save(path)
+
+
+def compare_images(path: str, other_path: str, tolerance: int = 0, diff_dir: Optional[str] = None) -> ImageDiff:
+    pixels = load_rgba(path)
+    other_pixels = load_rgba(other_path)
+    result = ImageDiff(path=str(path), other_path=str(other_path), pixel_sha1=get_pixel_hash(pixels.astype(np.uint8)))
+    if pixels.shape != other_pixels.shape:
+        # Still compare the overlap so the diff is useful when a render was only cropped differently
+        result.size_mismatch = True
+        height = max(pixels.shape[0], other_pixels.shape[0])
+        width = max(pixels.shape[1], other_pixels.shape[1])
+        pixels = pad_to(pixels, height, width)
+        other_pixels = pad_to(other_pixels, height, width)
+
+    # A pixel differs if any channel is off by more than the tolerance
+    mask = (np.abs(pixels - other_pixels) > tolerance).any(axis=2)
+    result.diff_pixels = int(mask.sum())
+    if result.diff_pixels:
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        result.bbox = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+    if diff_dir is not None and not result.is_match():
+        diff_image_path = Path(diff_dir).joinpath(Path(path).name)
+        write_diff_image(pixels, mask, diff_image_path)
+        result.diff_image_path = str(diff_image_path)
+    return result
+
+
+def compare_pair(args: Tuple[str, str, int, Optional[str]]) -> ImageDiff:
+    try:
+        return compare_images(*args)
+    except OSError as e:
+        return ImageDiff(path=str(args[0]), other_path=str(args[1]), error=str(e))
+
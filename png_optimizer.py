@@ -0,0 +1,207 @@
+# Lossless recompression of renders before they are uploaded, optionally trimming their transparent borders
+import argparse
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from queue import Queue
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# What the manifest records for an optimized render, so a render is optimized again if the settings change
+LOSSLESS = 'lossless'
+TRIM = 'trim'
+MAX_PALETTE_COLORS = 256
+PNG_COMPRESS_LEVEL = 9
+
+
+@dataclass
+class OptimizeResult:
+    path: str
+    ok: bool
+    bytes_before: int = 0
+    bytes_after: int = 0
+    # Hash of the canonical pixels, the same for any encoding of the same image
+    pixel_sha1: str = ''
+    duration: float = 0.0
+    error: str = ''
+
+
+def get_mode(trim: bool) -> str:
+    return TRIM if trim else LOSSLESS
+
+
+def get_canonical_pixels(image: Image.Image) -> np.ndarray:
+    # RGBA with every fully transparent pixel set to 0, the colour of an invisible pixel is up to the encoder
+    pixels = np.array(image.convert('RGBA'), dtype=np.uint8)
+    pixels[pixels[:, :, 3] == 0] = 0
+    return pixels
+
+
+def get_pixel_hash(pixels: np.ndarray) -> str:
+    sha1 = hashlib.sha1(f'{pixels.shape[1]}x{pixels.shape[0]}'.encode('utf-8'))
+    sha1.update(np.ascontiguousarray(pixels).tobytes())
+    return sha1.hexdigest()
+
+
+def trim_pixels(pixels: np.ndarray) -> np.ndarray:
+    # Crop to the visible pixels, an image with nothing visible is left alone
+    rows = np.flatnonzero(pixels[:, :, 3].any(axis=1))
+    cols = np.flatnonzero(pixels[:, :, 3].any(axis=0))
+    if not len(rows):
+        return pixels
+    return pixels[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def encode_palette(pixels: np.ndarray) -> Optional[bytes]:
+    # Renders with few colours fit in a palette image, with the alpha of each colour in the tRNS chunk
+    packed = np.ascontiguousarray(pixels).view(np.uint32).reshape(pixels.shape[:2])
+    colors, indices = np.unique(packed, return_inverse=True)
+    if len(colors) > MAX_PALETTE_COLORS:
+        return None
+    palette = colors.view(np.uint8).reshape(-1, 4)
+    image = Image.fromarray(indices.reshape(packed.shape).astype(np.uint8), 'P')
+    image.putpalette(palette[:, :3].tobytes())
+    out = io.BytesIO()
+    image.save(out, 'PNG', optimize=True, transparency=palette[:, 3].tobytes())
+    return out.getvalue()
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    # Smallest of the lossless encodings that decodes back to exactly the same pixels. Only depends on the pixels,
+    # so the same image always gives the same file.
+    encodings = []
+    palette_data = encode_palette(pixels)
+    if palette_data is not None:
+        encodings.append(palette_data)
+    opaque = bool((pixels[:, :, 3] == 255).all())
+    image = Image.fromarray(pixels[:, :, :3] if opaque else pixels, 'RGB' if opaque else 'RGBA')
+    out = io.BytesIO()
+    image.save(out, 'PNG', optimize=True, compress_level=PNG_COMPRESS_LEVEL)
+    encodings.append(out.getvalue())
+    for data in sorted(encodings, key=len):
+        with Image.open(io.BytesIO(data)) as decoded:
+            if np.array_equal(get_canonical_pixels(decoded), pixels):
+                return data
+    # The plain RGBA encoding always round trips
+    return encodings[-1]
+
+
+def optimize_png(path: str, trim: bool = False) -> OptimizeResult:
+    started = time.time()
+    result = OptimizeResult(path=path, ok=False)
+    try:
+        result.bytes_before = os.path.getsize(path)
+        with Image.open(path) as image:
+            pixels = get_canonical_pixels(image)
+        if trim:
+            pixels = trim_pixels(pixels)
+        data = encode_png(pixels)
+        if os.stat(path).st_nlink > 1:
+            # Hard linked to its renamed files, so write over it in place to keep the links. Replacing it would leave
+            # the renamed files as they were.
+            with open(path, 'r+b') as f:
+                f.write(data)
+                f.truncate()
+        else:
+            # Write to a temp file first so an interrupted run never leaves half a render
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        result.bytes_after = len(data)
+        result.pixel_sha1 = get_pixel_hash(pixels)
+        result.ok = True
+    except (OSError, ValueError) as e:
+        result.error = str(e)
+    result.duration = time.time() - started
+    return result
+
+
+class PngOptimizer:
+    # Optimizes renders in a process pool as they come in. Decoding and compressing is CPU bound, so threads would
+    # only get in each other's way. Results are handed to on_done one at a time on a thread of the optimizer's own,
+    # rather than on the pool's, which only logs a callback that raises.
+
+    def __init__(self, trim: bool = False, processes: Optional[int] = None):
+        self.trim = trim
+        self.mode = get_mode(trim)
+        # Forked workers would hold on to the pipes of any renderers already running, so the renderers would never see
+        # their stdin close
+        self.executor = ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.results: Queue = Queue()
+        self.thread = threading.Thread(target=self.hand_out_results, daemon=True)
+        self.thread.start()
+
+    def hand_out_results(self):
+        # None marks the end of the results
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            result, on_done = item
+            try:
+                on_done(result)
+            except Exception as e:
+                # on_done is expected to deal with its own errors, this only keeps the thread going
+                print(f'Could not handle optimized {result.path}: {e!r}')
+
+    def submit(self, path: Path, on_done: Callable[[OptimizeResult], None]):
+        def done(future: Future):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process died
+                result = OptimizeResult(path=str(path), ok=False, error=repr(e))
+            self.results.put((result, on_done))
+
+        self.executor.submit(optimize_png, str(path), self.trim).add_done_callback(done)
+
+    def close(self):
+        # Waits for every submitted render and for on_done to be done with it
+        self.executor.shutdown(wait=True)
+        self.results.put(None)
+        self.thread.join()
+
+
+def optimize_dir(directory: str, trim: bool = False, processes: Optional[int] = None):
+    paths = sorted(str(path) for path in Path(directory).rglob('*.png'))
+    bytes_before = 0
+    bytes_after = 0
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as executor:
+        results = executor.map(optimize_png, paths, [trim] * len(paths), chunksize=16)
+        for result in tqdm(results, total=len(paths), desc='Optimizing'):
+            if not result.ok:
+                print(f'Could not optimize {result.path}: {result.error}')
+                continue
+            bytes_before += result.bytes_before
+            bytes_after += result.bytes_after
+    print(f'Optimized {len(paths)} images, {bytes_before} bytes to {bytes_after} bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', required=True, help='Folder of PNGs to optimize in place, e.g. the renamed dir')
+    parser.add_argument('--trim', action='store_true', help='Crop the transparent border off of every image')
+    parser.add_argument('--processes', type=int, help='Number of images to optimize at once. Defaults to the number '
+                                                      'of cores.')
+    args = parser.parse_args()
+
+    if not Path(args.dir).is_dir():
+        print(f'Cannot find dir: {args.dir}')
+        exit(1)
+
+    optimize_dir(args.dir, args.trim, args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,30 @@
 import argparse
-import csv
 import os
+import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, List
 
 from tqdm import tqdm
 
-from equipped_render import EquippedRender, IncompleteDataException
+from compiled_sheet import load_sheet
+from item_sets import create_set_jobs, load_sets, validate_set_list
+from kit_matrix import create_plan, get_incomplete_rows
+from render_index import IndexedRender, RenderIndex, open_index
+from render_jobs import RenderJob
+from run_trace import RunTrace
 
 # Move each file of the form "[playerkit]_[colorkit].png" to "File name equipped female.png"
 # Print out a warning each time a file is overwritten and is not the same image.
 
 pages = defaultdict(set)
+LINK = 'link'
+COPY = 'copy'
+MOVE = 'move'
+RENAME_MODES = [LINK, COPY, MOVE]
+DEFAULT_RENAME_THREADS = 8
 
 
 def validate_args(infile: str, renders_dir: str, only_ids_file: str, check_renders_dir: bool = True) -> bool:
@@ -46,67 +58,175 @@ def validate_args(infile: str, renders_dir: str, only_ids_file: str, check_rende
     return True
 
 
-def rename_chathead_image(render: EquippedRender, renders_folder: str, outdir: str, is_female: bool):
-    path = Path(renders_folder).joinpath('female' if is_female else 'male').joinpath('playerchathead').joinpath(
-        f'{str(render.get_complete_playerkit(is_female))}_{str(render.get_colorkit(is_female))}.png')
-    if path.is_file():
-        # Copy file over to new spot
-        new_file_name = render.get_file_name(is_female)[7:-2].replace('equipped', 'chathead')
-        new_path = Path(outdir).joinpath('female' if is_female else 'male').joinpath('playerchathead').joinpath(
-            new_file_name)
-        if new_path.is_file():
-            print(f'{new_path} already exists!')
-        outfile = new_path.open(mode='wb+')
-        outfile.write(path.open('rb').read())
-        outfile.close()
-
-
-def rename_equipped_image(render: EquippedRender, renders_folder: str, outdir: str, is_female: bool):
-    path = Path(renders_folder).joinpath('female' if is_female else 'male').joinpath('player').joinpath(
-        f'{str(render.get_complete_playerkit(is_female))}_{str(render.get_colorkit(is_female))}.png')
-    if path.is_file():
-        # Copy file over to new spot
-        new_file_name = render.get_file_name(is_female)[7:-2]
-        new_path = Path(outdir).joinpath('female' if is_female else 'male').joinpath('player').joinpath(
-            new_file_name)
-        if new_path.is_file():
+def kernel_copy(src_fd: int, dst_fd: int, size: int):
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    copied = 0
+    while copied < size:
+        if use_copy_file_range:
+            try:
+                sent = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+            except OSError:
+                # Older kernels cannot copy_file_range across filesystems, sendfile can
+                use_copy_file_range = False
+                continue
+        else:
+            os.lseek(dst_fd, copied, os.SEEK_SET)
+            sent = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+
+
+def copy_file(path: Path, new_path: Path):
+    # Let the kernel copy the data instead of reading it into memory
+    with open(path, 'rb') as src, open(new_path, 'wb') as dst:
+        try:
+            kernel_copy(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+            return
+        except OSError:
+            # Start over in userspace
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst)
+
+
+def place_file(path: Path, new_path: Path, mode: str):
+    if mode == MOVE:
+        os.replace(path, new_path)
+        return
+    if mode == LINK:
+        try:
+            os.link(path, new_path)
+            return
+        except OSError:
+            # Different filesystem, or one without hard links
+            pass
+    copy_file(path, new_path)
+
+
+def rename_job_group(jobs: List[RenderJob], renders_folder: str, outdir: str, mode: str = LINK,
+                     indexed: bool = False) -> int:
+    # Every job in the group shares a render key, so the one render goes to each of their file names
+    # Returns the number of files placed. An indexed render is known to be there, so it is not looked for.
+    path = jobs[0].get_output_path(renders_folder)
+    if not indexed and not path.is_file():
+        return 0
+    new_paths = []
+    for job in jobs:
+        # If this render does not have a file name, ignore
+        if not job.file_name:
+            continue
+        new_path = job.get_renamed_path(outdir)
+        if new_path.exists():
+            # Already linked by an earlier run
+            if os.path.samefile(path, new_path):
+                continue
             print(f'{new_path} already exists!')
-        outfile = new_path.open(mode='wb+')
-        outfile.write(path.open('rb').read())
-        outfile.close()
+            new_path.unlink()
+        new_paths.append(new_path)
+    if not new_paths:
+        return 0
+    # When moving, the render can only be moved once, so the other names are linked to the moved file
+    if mode == MOVE:
+        place_file(path, new_paths[0], MOVE)
+        for new_path in new_paths[1:]:
+            place_file(new_paths[0], new_path, LINK)
+    else:
+        for new_path in new_paths:
+            place_file(path, new_path, mode)
+    return len(new_paths)
+
+
+def traced_rename_job_group(jobs: List[RenderJob], renders_folder: str, outdir: str, mode: str,
+                            trace: RunTrace, render: Optional[IndexedRender] = None,
+                            index: Optional[RenderIndex] = None) -> int:
+    # render is the group's render from the index, if it is in there, and index the index it came from. Returns the
+    # number of files placed.
+    started = time.time()
+    error = ''
+    files = 0
+    try:
+        try:
+            files = rename_job_group(jobs, renders_folder, outdir, mode, render is not None)
+        except FileNotFoundError:
+            if render is None or jobs[0].get_output_path(renders_folder).exists():
+                raise
+            # Deleted since it was indexed, so look for it on disk like a render that is not in the index, and take
+            # it out of the index
+            if index is not None:
+                index.remove([render.render_key])
+            render = None
+            files = rename_job_group(jobs, renders_folder, outdir, mode)
+    except OSError as e:
+        error = str(e)
+        print(f'Could not rename {jobs[0].get_output_path(renders_folder)}: {e}')
+    named_jobs = [job for job in jobs if job.file_name]
+    if not files and named_jobs and not all(job.get_renamed_path(outdir).is_file() for job in named_jobs):
+        error = error or 'No render to rename'
+    output_bytes = 0
+    if files and render is not None:
+        output_bytes = files * render.size
+    elif files:
+        try:
+            output_bytes = files * named_jobs[0].get_renamed_path(outdir).stat().st_size
+        except OSError:
+            pass
+    trace.emit('rename', item_id=jobs[0].item_id, name=jobs[0].file_name, ok=not error, files=files,
+               duration=time.time() - started, output_bytes=output_bytes, error=error)
+    return files
+
+
+def create_outdir_tree(outdir: str):
+    # Create the whole tree up front so renaming never has to check for it
+    paths = [Path(outdir), Path(outdir).joinpath('male'), Path(outdir).joinpath('female'),
+             Path(outdir).joinpath('male').joinpath('playerchathead'),
+             Path(outdir).joinpath('female').joinpath('playerchathead'),
+             Path(outdir).joinpath('male').joinpath('player'),
+             Path(outdir).joinpath('female').joinpath('player')]
+    for path in paths:
+        if not path.exists():
+            os.mkdir(path)
+
+
+def get_renamed_dir(renders_dir: str) -> str:
+    return f'{str(Path(renders_dir))}_renamed'
 
 
 def rename_images(infile: str, renders_folder: str, outdir: str, only_gender: Optional[str], only_render: Optional[str],
-                  only_ids: Optional[List[int]]):
-    num_lines_data = sum(1 for _ in open(infile, 'r'))
-    f = open(infile, 'r')
-    dict_reader = csv.DictReader(f, dialect='excel')
-    for line in tqdm(dict_reader, total=num_lines_data):
-        render: EquippedRender = EquippedRender.from_dict(line)
+                  only_ids: Optional[List[int]], mode: str = LINK, num_threads: int = DEFAULT_RENAME_THREADS,
+                  set_list: Optional[str] = None, trace: Optional[RunTrace] = None):
+    with load_sheet(infile) as sheet:
         # Only rename the ones we specify, if we specify any
-        if only_ids is not None and render.item_id not in only_ids:
-            continue
+        plan = create_plan(sheet, only_gender, only_render, only_ids)
+        for row in get_incomplete_rows(sheet, only_ids):
+            print(f'Id {sheet.item_ids[row]}: Incomplete data...Skipping...')
+        if set_list:
+            for job in create_set_jobs(sheet, load_sets(set_list), only_gender, only_render):
+                plan.add(job)
 
-        try:
-            # Only render the gender we specify, if we specify any
-            if only_gender is None:
-                genders_to_render = [False, True]
-            elif only_gender == 'female':
-                genders_to_render = [True]
-            else:
-                genders_to_render = [False]
-
-            for is_female in genders_to_render:
-                # If this render does not have a file name or an image, ignore
-                if not render.get_file_name(is_female):
-                    continue
-                # Only render the type of image we specify, if we specify any
-                if only_render is None or only_render == 'player':
-                    rename_equipped_image(render, renders_folder, outdir, is_female)
-                if only_render is None or only_render == 'chathead':
-                    rename_chathead_image(render, renders_folder, outdir, is_female)
-        except IncompleteDataException as e:
-            print(f'Id {render.item_id}: Incomplete data...Skipping...')
+    # Look every render up in the index at once instead of checking for each file. Renders that are not in it, e.g.
+    # from before the renders dir had an index, are still looked for on disk.
+    index = open_index(renders_folder)
+    renders = index.get_renders(plan.jobs_by_key.keys()) if index is not None else {}
+    if index is not None:
+        print(f'{len(renders)}/{len(plan.jobs_by_key)} renders are in the index, looking for the rest on disk')
+
+    trace = trace or RunTrace()
+    trace.start_stage('rename')
+    # Most of the time goes to waiting on the filesystem, so threads are enough
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        groups = executor.map(lambda item: traced_rename_job_group(item[1], renders_folder, outdir, mode, trace,
+                                                                   renders.get(item[0]), index),
+                              plan.jobs_by_key.items())
+        moved = [key for key, files in zip(plan.jobs_by_key, tqdm(groups, total=len(plan.jobs_by_key),
+                                                                   desc='Renaming')) if files]
+    trace.end_stage('rename')
+    if index is not None:
+        # Moved renders are not in the renders dir any more
+        if mode == MOVE:
+            index.remove(moved)
+        index.close()
+    trace.print_summary('rename')
 
 
 def main():
@@ -119,6 +239,14 @@ def main():
     parser.add_argument('--render-type', choices=['player', 'chathead'],
                         help='Only generate renders for the given type. Defaults to generating both.')
     parser.add_argument('--id-list', help='Only generate renders for the ids in this file (comma separated list)')
+    parser.add_argument('--rename-mode', choices=RENAME_MODES, default=LINK,
+                        help='link hard links renamed files to the renders (copying if that is not possible), copy '
+                             'always copies and move moves the renders out of the renders dir. Defaults to link.')
+    parser.add_argument('--set-list', help='Path to a csv of sets to rename along with the items')
+    parser.add_argument('--rename-threads', type=int, default=DEFAULT_RENAME_THREADS,
+                        help=f'Number of files to rename at once. Defaults to {DEFAULT_RENAME_THREADS}.')
+    parser.add_argument('--trace', help='File to append a JSONL event for every renamed render to')
+    parser.add_argument('--metrics', help='File to write Prometheus metrics for the run to')
     args = parser.parse_args()
 
     infile = args.infile
@@ -127,33 +255,36 @@ def main():
     only_gender = args.only_gender
     only_render = args.render_type
     only_ids_file = args.id_list
+    mode = args.rename_mode
+    num_threads = args.rename_threads
+    set_list = args.set_list
 
     if not validate_args(infile, renders_dir, only_ids_file):
         exit(1)
+    if set_list and not validate_set_list(set_list):
+        exit(1)
 
-    start_up(infile, renders_dir, outdir, only_gender, only_render, only_ids_file)
+    trace = RunTrace(args.trace)
+    start_up(infile, renders_dir, outdir, only_gender, only_render, only_ids_file, mode, num_threads, set_list, trace)
+    if args.metrics:
+        trace.write_metrics(args.metrics)
+    trace.close()
 
 
 def start_up(infile: str, renders_dir: str, outdir: Optional[str], only_gender: Optional[str],
-             only_render: Optional[str], only_ids_file: Optional[str]):
+             only_render: Optional[str], only_ids_file: Optional[str], mode: str = LINK,
+             num_threads: int = DEFAULT_RENAME_THREADS, set_list: Optional[str] = None,
+             trace: Optional[RunTrace] = None):
     # If outdir is not given, create the dir for renamed
     if not outdir:
-        outdir = f'{str(Path(renders_dir))}_renamed'
-
-    paths = [Path(outdir), Path(outdir).joinpath('male'), Path(outdir).joinpath('female'),
-             Path(outdir).joinpath('male').joinpath('playerchathead'),
-             Path(outdir).joinpath('female').joinpath('playerchathead'),
-             Path(outdir).joinpath('male').joinpath('player'),
-             Path(outdir).joinpath('female').joinpath('player')]
-    for path in paths:
-        if not path.exists():
-            os.mkdir(path)
+        outdir = get_renamed_dir(renders_dir)
+    create_outdir_tree(outdir)
 
     only_ids = None
     if only_ids_file is not None:
         only_ids = [int(item_id) for item_id in open(only_ids_file).read().split(',')]
 
-    rename_images(infile, renders_dir, outdir, only_gender, only_render, only_ids)
+    rename_images(infile, renders_dir, outdir, only_gender, only_render, only_ids, mode, num_threads, set_list, trace)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+# SQLite index of every render in an outdir, so renaming, checking and reporting can look renders up in bulk instead
+# of probing the renders dir one file at a time
+import argparse
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+# Most rows written before they are committed, or seconds between commits, whichever comes first
+COMMIT_BATCH_SIZE = 500
+COMMIT_INTERVAL_SECONDS = 1.0
+# SQLite limits the number of parameters in one query
+QUERY_BATCH_SIZE = 500
+# Seconds to wait for another process writing to the same index
+BUSY_TIMEOUT_SECONDS = 30
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS renders (
+    render_key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    pixel_sha1 TEXT,
+    cache TEXT NOT NULL,
+    rendered REAL NOT NULL
+)
+'''
+COLUMNS = ['render_key', 'path', 'size', 'sha1', 'pixel_sha1', 'cache', 'rendered']
+
+
+def get_index_path(outdir: str) -> Path:
+    # Lives next to the outdir, like the manifest and the journal. Shards each keep their own, merge_shards.py fills
+    # the index of the merged outdir.
+    return Path(f'{str(Path(outdir))}_index.sqlite')
+
+
+@dataclass
+class IndexedRender:
+    render_key: str
+    # Relative to the outdir
+    path: str
+    size: int
+    sha1: str
+    # Hash of the canonical pixels, see png_optimizer. Only known for optimized renders.
+    pixel_sha1: Optional[str]
+    cache: str
+    # When it was rendered
+    rendered: float
+
+
+class RenderIndex:
+    # Every render written to an outdir, filled in by the render stage as renders finish. Writes are batched, so a
+    # render only shows up to other connections once its batch is committed, at most a second later.
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        # Readers are never blocked by the writer
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def write(self, query: str, rows: List[tuple]):
+        with self.lock:
+            self.connection.executemany(query, rows)
+            self.pending += len(rows)
+            if self.pending >= COMMIT_BATCH_SIZE or time.time() - self.last_commit >= COMMIT_INTERVAL_SECONDS:
+                self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def record(self, render_key: str, entry: Dict[str, Any], replace: bool = True, rendered: Optional[float] = None):
+        # Takes the manifest entry of the render, which already has its size and hashes. Without replace, a render
+        # the index already has keeps its row, for renders that were skipped rather than rendered.
+        values = (render_key, entry['path'], entry['size'], entry['sha1'], entry.get('pixel_sha1'), entry['cache'],
+                  rendered or time.time())
+        self.write(f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO renders VALUES '
+                   f'({", ".join("?" * len(COLUMNS))})', [values])
+
+    def remove(self, render_keys: Iterable[str]):
+        self.write('DELETE FROM renders WHERE render_key = ?', [(key,) for key in render_keys])
+
+    def get_renders(self, render_keys: Iterable[str]) -> Dict[str, IndexedRender]:
+        # Every render of the given keys that is in the index
+        render_keys = list(render_keys)
+        renders = {}
+        with self.lock:
+            for start in range(0, len(render_keys), QUERY_BATCH_SIZE):
+                batch = render_keys[start:start + QUERY_BATCH_SIZE]
+                rows = self.connection.execute(f'SELECT {", ".join(COLUMNS)} FROM renders WHERE render_key IN '
+                                               f'({", ".join("?" * len(batch))})', batch)
+                for row in rows:
+                    renders[row[0]] = IndexedRender(*row)
+        return renders
+
+    def get_summary(self) -> Dict[str, Any]:
+        with self.lock:
+            count, size, oldest, newest = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(rendered), MAX(rendered) FROM renders').fetchone()
+            caches = self.connection.execute('SELECT COUNT(DISTINCT cache) FROM renders').fetchone()[0]
+        return {'renders': count, 'bytes': size, 'oldest': oldest, 'newest': newest, 'caches': caches}
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.connection.close()
+
+
+def open_index(outdir: str) -> Optional[RenderIndex]:
+    # The index of an outdir, or None if nothing was ever rendered to it with one
+    path = get_index_path(outdir)
+    if not path.is_file():
+        return None
+    return RenderIndex(path)
+
+
+def report_missing(index: RenderIndex, infile: str, only_gender: Optional[str], only_render: Optional[str],
+                   set_list: Optional[str]):
+    # Every image of the sheet with no render in the index, without looking at the renders dir at all
+    from create_renders import load_plan
+    plan = load_plan(infile, only_gender, only_render, None, set_list)
+    renders = index.get_renders(plan.jobs_by_key.keys())
+    missing = [job for key, jobs in plan.jobs_by_key.items() if key not in renders for job in jobs]
+    for job in missing:
+        print(f'Id {job.item_id}: No {"female" if job.is_female else "male"} {job.render_type} render '
+              f'{job.file_name}')
+    print(f'{len(missing)}/{plan.get_num_jobs()} images have no render')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outdir', default='renders', help='Folder the renders were written to')
+    parser.add_argument('--infile', help='Path to a csv, to list every image of it that has no render')
+    parser.add_argument('--only-gender', choices=['male', 'female'],
+                        help='Only list missing renders for the given gender. Defaults to both.')
+    parser.add_argument('--render-type', choices=['player', 'chathead'],
+                        help='Only list missing renders for the given type. Defaults to both.')
+    parser.add_argument('--set-list', help='Path to a csv of sets to list along with the items')
+    args = parser.parse_args()
+
+    index = open_index(args.outdir)
+    if index is None:
+        print(f'No index at {get_index_path(args.outdir)}!')
+        exit(1)
+    if args.infile and not Path(args.infile).is_file():
+        print('Infile given does not exist!')
+        exit(1)
+
+    summary = index.get_summary()
+    print(f'{summary["renders"]} renders, {summary["bytes"]} bytes, from {summary["caches"]} caches')
+    if summary['renders']:
+        print(f'Rendered between {time.ctime(summary["oldest"])} and {time.ctime(summary["newest"])}')
+    if args.infile:
+        report_missing(index, args.infile, args.only_gender, args.render_type, args.set_list)
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
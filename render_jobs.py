@@ -0,0 +1,169 @@
+import dataclasses
+import hashlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from equipped_render import EquippedRender
+
+COMMA = ','
+PLAYER = 'player'
+CHATHEAD = 'chathead'
+# The renderer puts each render type in its own sub folder of the gender folder
+RENDER_TYPE_DIRS = {PLAYER: 'player', CHATHEAD: 'playerchathead'}
+# Lower runs first. Player renders are the ones we upload most, so they get ahead of chatheads.
+RENDER_TYPE_PRIORITIES = {PLAYER: 0, CHATHEAD: 1}
+
+
+def get_render_key(render_type: str, is_female: bool, playerkit: List[int], colorkit: List[int], pose_anim: int,
+                   xan2d: int, yan2d: int, zan2d: int) -> str:
+    # Hash of everything that goes into the image, jobs with the same key produce the same image
+    key = [render_type, is_female, playerkit, colorkit, pose_anim, xan2d, yan2d, zan2d]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class RenderJob:
+    render_type: str
+    is_female: bool
+    playerkit: List[int]
+    colorkit: List[int]
+    pose_anim: int = -1
+    xan2d: int = -1
+    yan2d: int = -1
+    zan2d: int = -1
+    # Only used for reporting and renaming, not part of the render key
+    item_id: int = -1
+    file_name: str = ''
+    # Worked out the first time it is asked for, unless kit_matrix.create_plan already did it for the whole sheet
+    render_key: str = dataclasses.field(default='', repr=False, compare=False)
+
+    def get_render_key(self) -> str:
+        # The scheduler, journal, index and trace all ask for it, often more than once per job, and nothing changes
+        # a job's render inputs once it is made
+        if not self.render_key:
+            self.render_key = get_render_key(self.render_type, self.is_female, self.playerkit, self.colorkit,
+                                             self.pose_anim, self.xan2d, self.yan2d, self.zan2d)
+        return self.render_key
+
+    def get_priority(self) -> float:
+        return RENDER_TYPE_PRIORITIES[self.render_type]
+
+    def get_gender_dir(self, outdir: str) -> Path:
+        return Path(outdir).joinpath('female' if self.is_female else 'male')
+
+    def get_output_name(self) -> str:
+        # The renderer names each file "[playerkit]_[colorkit].png"
+        return f'{str(self.playerkit)}_{str(self.colorkit)}.png'
+
+    def get_output_path(self, outdir: str) -> Path:
+        return self.get_gender_dir(outdir).joinpath(RENDER_TYPE_DIRS[self.render_type]).joinpath(
+            self.get_output_name())
+
+    def get_renamed_path(self, outdir: str) -> Path:
+        return self.get_gender_dir(outdir).joinpath(RENDER_TYPE_DIRS[self.render_type]).joinpath(self.file_name)
+
+    def get_renderer_args(self, outdir: str) -> List[str]:
+        args = ['--out', str(self.get_gender_dir(outdir)),
+                '--playerkit', COMMA.join(str(k) for k in self.playerkit),
+                '--playercolors', COMMA.join(str(k) for k in self.colorkit)]
+        if self.is_female:
+            args.append('--playerfemale')
+        if self.render_type == CHATHEAD:
+            args += ['--playerchathead', '--anim', '589', '--lowres', '--crophead', '--yan2d', '128']
+        else:
+            args += ['--poseanim', str(self.pose_anim), '--xan2d', str(self.xan2d), '--yan2d', str(self.yan2d),
+                     '--zan2d', str(self.zan2d)]
+        return args
+
+    def get_manifest_entry(self, outdir: str) -> Dict[str, Any]:
+        entry = {'out': str(self.get_gender_dir(outdir)), 'playerkit': self.playerkit, 'playercolors': self.colorkit,
+                 'female': self.is_female, 'chathead': self.render_type == CHATHEAD}
+        if self.render_type == CHATHEAD:
+            entry.update({'anim': 589, 'lowres': True, 'crophead': True, 'yan2d': 128})
+        else:
+            entry.update({'poseanim': self.pose_anim, 'xan2d': self.xan2d, 'yan2d': self.yan2d, 'zan2d': self.zan2d})
+        return entry
+
+    @classmethod
+    def from_render(cls, render: EquippedRender, is_female: bool, render_type: str) -> 'RenderJob':
+        # Strip the [[File:...]] wrapper from the file name
+        file_name = render.get_file_name(is_female)[7:-2]
+        if render_type == CHATHEAD:
+            file_name = file_name.replace('equipped', 'chathead')
+        job = cls(render_type=render_type, is_female=is_female,
+                  playerkit=render.get_complete_playerkit(is_female), colorkit=render.get_colorkit(is_female),
+                  item_id=render.item_id, file_name=file_name)
+        if render_type == PLAYER:
+            job.pose_anim = render.pose_anim
+            job.xan2d = render.xan2d
+            job.yan2d = render.yan2d
+            job.zan2d = render.zan2d
+        return job
+
+
+@dataclass
+class JobOutcome:
+    job: RenderJob
+    ok: bool
+    # Exit status of the renderer process, None if the renderer was not launched for this job alone or did not exit
+    exit_status: Optional[int] = None
+    started: float = 0.0
+    finished: float = 0.0
+    error: str = ''
+    # When the job was put on the queue, and how long of its run went to starting a renderer
+    queued: float = 0.0
+    spawn: float = 0.0
+    # Which try this was, and whether it is the last one. Failed jobs are retried until they run out of attempts.
+    attempt: int = 1
+    final: bool = True
+
+    def get_duration(self) -> float:
+        return self.finished - self.started
+
+    def get_queue_wait(self) -> float:
+        return max(self.started - self.queued, 0.0) if self.queued else 0.0
+
+
+def create_jobs(render: EquippedRender, only_gender: Optional[str], only_render: Optional[str]) -> List[RenderJob]:
+    jobs = []
+    for is_female in [False, True]:
+        if only_gender == ('male' if is_female else 'female'):
+            continue
+        if not render.can_render(is_female):
+            continue
+        if only_render is None or only_render == PLAYER:
+            jobs.append(RenderJob.from_render(render, is_female=is_female, render_type=PLAYER))
+        # Chatheads only make sense for head slot items
+        if (only_render is None or only_render == CHATHEAD) and render.equip_slot == 0:
+            jobs.append(RenderJob.from_render(render, is_female=is_female, render_type=CHATHEAD))
+    return jobs
+
+
+class RenderPlan:
+    # Groups jobs by render key so every unique image is only rendered once. Recolours and infobox versions often
+    # share all of their render inputs.
+
+    def __init__(self):
+        self.jobs_by_key: Dict[str, List[RenderJob]] = {}
+
+    def add(self, job: RenderJob):
+        self.jobs_by_key.setdefault(job.get_render_key(), []).append(job)
+
+    def get_unique_jobs(self) -> List[RenderJob]:
+        return [jobs[0] for jobs in self.jobs_by_key.values()]
+
+    def get_num_jobs(self) -> int:
+        return sum(len(jobs) for jobs in self.jobs_by_key.values())
+
+    def get_num_saved(self) -> int:
+        return self.get_num_jobs() - len(self.jobs_by_key)
+
+    def finish(self, render_key: str) -> List[RenderJob]:
+        # Every job that shares a render, once it is on disk
+        return self.jobs_by_key[render_key]
+
+    def fan_out(self, outcome: JobOutcome) -> List[JobOutcome]:
+        # Give every job that shares the rendered job's key the same outcome
+        return [dataclasses.replace(outcome, job=job) for job in self.jobs_by_key[outcome.job.get_render_key()]]
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Set
+
+from render_jobs import JobOutcome, RenderJob
+
+PLANNED = 'planned'
+DONE = 'done'
+FAILED = 'failed'
+# First line of every journal, records which cache the run renders from
+RUN = 'run'
+# Most time between forcing the journal to disk, so a crash loses at most this much of it
+FSYNC_INTERVAL_SECONDS = 1.0
+
+
+def get_journal_path(outdir: str) -> Path:
+    # Lives next to the outdir, like the _renamed dir and the manifest
+    return Path(f'{str(Path(outdir))}_journal.jsonl')
+
+
+class RenderJournal:
+    # Append-only record of every render job of a run as it is planned, done or failed. Unlike the manifest, which is
+    # only saved at the end of a run, every line is written as soon as it happens, so a run that dies can be resumed.
+
+    def __init__(self, path: Path, cache_fingerprint: str):
+        self.path = path
+        self.cache_fingerprint = cache_fingerprint
+        # Last state of each render key, from the journal being resumed
+        self.states: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.last_sync = 0.0
+
+    def load(self) -> bool:
+        # Read the states of an earlier run. False if there is nothing to resume from this cache.
+        if not self.path.is_file():
+            print('No journal to resume from, starting a new run')
+            return False
+        for line in open(self.path, 'r'):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line is cut short if the run died while writing it
+                continue
+            if entry['state'] == RUN:
+                if entry['cache'] != self.cache_fingerprint:
+                    print('The journal is from a different cache, starting a new run')
+                    self.states = {}
+                    return False
+                continue
+            self.states[entry['key']] = entry['state']
+        return True
+
+    def open(self, resume: bool):
+        # A resumed run carries on appending to its journal, a new run starts a new one
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.journal_file = open(self.path, 'a' if resume else 'w')
+        if not resume:
+            self.write([{'state': RUN, 'cache': self.cache_fingerprint, 'time': time.time()}])
+
+    def get_done_keys(self) -> Set[str]:
+        return {key for key, state in self.states.items() if state == DONE}
+
+    def get_num_failed(self) -> int:
+        return sum(1 for state in self.states.values() if state == FAILED)
+
+    def write(self, entries: List[Dict]):
+        with self.lock:
+            self.journal_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            self.journal_file.flush()
+            if time.time() - self.last_sync >= FSYNC_INTERVAL_SECONDS:
+                os.fsync(self.journal_file.fileno())
+                self.last_sync = time.time()
+
+    def record_planned(self, jobs: List[RenderJob]):
+        self.write([{'key': job.get_render_key(), 'state': PLANNED} for job in jobs])
+
+    def record(self, outcome: JobOutcome):
+        entry = {'key': outcome.job.get_render_key(), 'state': DONE if outcome.ok else FAILED,
+                 'attempt': outcome.attempt, 'time': outcome.finished}
+        if not outcome.ok:
+            entry.update({'exit_status': outcome.exit_status, 'error': outcome.error})
+        self.write([entry])
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.journal_file.close()
+            self.journal_file = None
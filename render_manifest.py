@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from render_jobs import RenderJob
+
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_cache_fingerprint(cache: str) -> str:
+    # Hash of every file in the cache, any change to the cache means every render could have changed
+    sha1 = hashlib.sha1()
+    for path in sorted(p for p in Path(cache).rglob('*') if p.is_file()):
+        sha1.update(str(path.relative_to(cache)).encode('utf-8'))
+        sha1.update(hash_file(path).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def get_manifest_path(outdir: str) -> Path:
+    # Lives next to the outdir, like the _renamed and _wiki dirs
+    return Path(f'{str(Path(outdir))}_manifest.json')
+
+
+class RenderManifest:
+    # Remembers which render keys were rendered with which cache, so later runs can skip them
+
+    def __init__(self, path: Path, outdir: str, cache_fingerprint: str):
+        self.path = path
+        self.outdir = outdir
+        self.cache_fingerprint = cache_fingerprint
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path.is_file():
+            data = json.load(open(path, 'r'))
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data['entries']
+
+    def is_current(self, job: RenderJob) -> bool:
+        entry = self.entries.get(job.get_render_key())
+        if entry is None or entry['cache'] != self.cache_fingerprint:
+            return False
+        # Make sure the render is still there and has not been replaced
+        output_path = Path(self.outdir).joinpath(entry['path'])
+        return output_path.is_file() and output_path.stat().st_size == entry['size']
+
+    def is_optimized(self, job: RenderJob, optimized: str) -> bool:
+        entry = self.entries.get(job.get_render_key())
+        return entry is not None and entry.get('optimized') == optimized
+
+    def record(self, job: RenderJob, optimized: Optional[str] = None, pixel_sha1: Optional[str] = None):
+        # optimized is how the render was optimized, if it was, and pixel_sha1 the hash of its canonical pixels
+        output_path = job.get_output_path(self.outdir)
+        entry = {
+            'cache': self.cache_fingerprint,
+            'path': str(output_path.relative_to(self.outdir)),
+            'size': output_path.stat().st_size,
+            'sha1': hash_file(output_path),
+        }
+        if optimized is not None:
+            entry.update({'optimized': optimized, 'pixel_sha1': pixel_sha1})
+        self.entries[job.get_render_key()] = entry
+
+    def save(self):
+        # Write to a temp file first so an interrupted save cannot corrupt the manifest
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,96 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from kit_matrix import ITEM_KIT_OFFSET
+from render_jobs import CHATHEAD, PLAYER, RenderJob
+from shards import Shard, find_shard_paths, get_shard_path
+
+TIMINGS_VERSION = 1
+# Seconds a render is expected to take with no history at all. Full body renders take longer than chatheads.
+DEFAULT_SECONDS = {PLAYER: 2.0, CHATHEAD: 1.0}
+# Weight of the newest timing of a render key, the rest comes from earlier runs
+NEW_TIMING_WEIGHT = 0.5
+
+
+def get_timings_path(outdir: str) -> Path:
+    # Lives next to the outdir, like the manifest and the journal
+    return Path(f'{str(Path(outdir))}_timings.json')
+
+
+def get_cost_class(job: RenderJob) -> str:
+    # Renders of items in the same slots cost about the same, e.g. capes and weapons are bigger models than rings
+    slots = [str(slot) for slot, kit in enumerate(job.playerkit) if kit >= ITEM_KIT_OFFSET]
+    return f'{job.render_type}:{",".join(slots)}'
+
+
+class RenderTimings:
+    # How long each render key took in earlier runs, kept between runs so the longest renders can be started first.
+    # Renders that were never timed get the average of renders of the same type in the same slots.
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Render key -> {'seconds': ..., 'class': ...}
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Timings from this run, estimates only use earlier runs so they stay the same for the whole run
+        self.new_entries: Dict[str, Dict[str, Any]] = {}
+        self.class_seconds: Dict[str, float] = {}
+        self.type_seconds: Dict[str, float] = {}
+
+    def load(self, paths: List[Path]):
+        for path in paths:
+            if not path.is_file():
+                continue
+            data = json.load(open(path, 'r'))
+            if data.get('version') == TIMINGS_VERSION:
+                self.entries.update(data['entries'])
+        # Average of each class and render type, for renders with no history of their own
+        class_times: Dict[str, List[float]] = {}
+        for entry in self.entries.values():
+            class_times.setdefault(entry['class'], []).append(entry['seconds'])
+        self.class_seconds = {cost_class: sum(times) / len(times) for cost_class, times in class_times.items()}
+        for render_type in DEFAULT_SECONDS:
+            times = [seconds for cost_class, seconds in self.class_seconds.items()
+                     if cost_class.startswith(f'{render_type}:')]
+            if times:
+                self.type_seconds[render_type] = sum(times) / len(times)
+
+    def estimate(self, job: RenderJob) -> float:
+        entry = self.entries.get(job.get_render_key())
+        if entry is not None:
+            return entry['seconds']
+        seconds = self.class_seconds.get(get_cost_class(job))
+        if seconds is not None:
+            return seconds
+        return self.type_seconds.get(job.render_type, DEFAULT_SECONDS[job.render_type])
+
+    def record(self, job: RenderJob, seconds: float):
+        key = job.get_render_key()
+        old_entry = self.entries.get(key)
+        if old_entry is not None:
+            seconds = old_entry['seconds'] * (1 - NEW_TIMING_WEIGHT) + seconds * NEW_TIMING_WEIGHT
+        self.new_entries[key] = {'seconds': round(seconds, 4), 'class': get_cost_class(job)}
+
+    def save(self):
+        if not self.new_entries:
+            return
+        # Keep what this file already had, other shards' timings are in their own files
+        entries = {}
+        if self.path.is_file():
+            data = json.load(open(self.path, 'r'))
+            if data.get('version') == TIMINGS_VERSION:
+                entries = data['entries']
+        entries.update(self.new_entries)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': TIMINGS_VERSION, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+def load_timings(outdir: str, shard: Optional[Shard] = None) -> RenderTimings:
+    # Every run learns from the timings of every shard, but only writes its own
+    path = get_timings_path(outdir)
+    timings = RenderTimings(get_shard_path(path, shard))
+    timings.load([path] + find_shard_paths(path))
+    return timings
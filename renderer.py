@@ -0,0 +1,185 @@
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Optional, Type
+
+from render_jobs import JobOutcome, RenderJob
+
+RENDERER_PATH = os.environ.get('RENDERER_PATH', './renderer-all.jar')
+# Command used to launch the renderer. Set RENDERER_COMMAND to use a stand-in renderer instead of the jar,
+# e.g. RENDERER_COMMAND="python3 fake_renderer.py"
+RENDERER_COMMAND = shlex.split(os.environ.get('RENDERER_COMMAND', f'java -jar {RENDERER_PATH}'))
+# Flag that tells the renderer to read jobs from stdin instead of rendering a single image
+STDIN_JOBS_FLAG = '--stdin-jobs'
+# Flag that tells the renderer to render every job in a manifest file
+MANIFEST_FLAG = '--manifest'
+WORKER_SHUTDOWN_TIMEOUT = 30
+# Error of a job the renderer said it did, but which has no render on disk
+NO_RENDER_ERROR = 'Renderer reported success but wrote no render'
+DEFAULT_SHARD_SIZE = 1000
+
+
+class RendererWorker:
+    # Number of jobs this worker wants handed to render_batch at once
+    batch_size = 1
+
+    def __init__(self, cache: str, outdir: str):
+        self.cache = cache
+        self.outdir = outdir
+
+    def render(self, job: RenderJob) -> JobOutcome:
+        raise NotImplementedError
+
+    def render_batch(self, jobs: List[RenderJob]) -> List[JobOutcome]:
+        return [self.render(job) for job in jobs]
+
+    def close(self):
+        pass
+
+
+class ProcessWorker(RendererWorker):
+    # Launches a fresh renderer for every job. Slow since each job pays for JVM startup and a cache load.
+
+    def render(self, job: RenderJob) -> JobOutcome:
+        command = RENDERER_COMMAND + ['--cache', self.cache] + job.get_renderer_args(self.outdir)
+        started = time.time()
+        process = subprocess.Popen(command)
+        spawn = time.time() - started
+        returncode = process.wait()
+        # A renderer that exits cleanly is not taken at its word, the render has to be there
+        ok = returncode == 0 and job.get_output_path(self.outdir).is_file()
+        error = ''
+        if returncode != 0:
+            error = f'Renderer exited with status {returncode}'
+        elif not ok:
+            error = NO_RENDER_ERROR
+        return JobOutcome(job=job, ok=ok, exit_status=returncode, started=started, finished=time.time(), error=error,
+                          spawn=spawn)
+
+
+class PersistentWorker(RendererWorker):
+    # Keeps a single renderer alive and streams jobs to it. Each job is sent as one JSON line on stdin:
+    #   {"id": 1, "args": ["--out", "renders/male", "--playerkit", ...]}
+    # and the renderer answers each job with one JSON line on stdout:
+    #   {"id": 1, "ok": true}
+    # Any other output from the renderer (logging etc.) is ignored.
+
+    def __init__(self, cache: str, outdir: str):
+        super().__init__(cache, outdir)
+        self.process: Optional[subprocess.Popen] = None
+        self.next_id = 0
+
+    def start(self):
+        self.process = subprocess.Popen(RENDERER_COMMAND + ['--cache', self.cache, STDIN_JOBS_FLAG],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    def render(self, job: RenderJob) -> JobOutcome:
+        started = time.time()
+        # (Re)start the renderer if this is the first job or the last one took it down
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        spawn = time.time() - started
+        self.next_id += 1
+        job_id = self.next_id
+        try:
+            self.process.stdin.write(json.dumps({'id': job_id, 'args': job.get_renderer_args(self.outdir)}) + '\n')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            return JobOutcome(job=job, ok=False, exit_status=self.process.wait(), started=started,
+                              finished=time.time(), error='Renderer closed its stdin', spawn=spawn)
+
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(response, dict) and response.get('id') == job_id:
+                ok = bool(response.get('ok'))
+                error = str(response.get('error', ''))
+                if ok and not job.get_output_path(self.outdir).is_file():
+                    ok, error = False, NO_RENDER_ERROR
+                return JobOutcome(job=job, ok=ok, started=started, finished=time.time(), error=error, spawn=spawn)
+        return JobOutcome(job=job, ok=False, exit_status=self.process.wait(), started=started, finished=time.time(),
+                          error='Renderer exited before finishing the job', spawn=spawn)
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            # Closing stdin tells the renderer there are no more jobs
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=WORKER_SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+
+class ManifestWorker(RendererWorker):
+    # Writes a whole shard of jobs to a JSONL manifest and launches the renderer once for the shard:
+    #   {"out": "renders/male", "playerkit": [...], "playercolors": [...], "female": false, "chathead": false,
+    #    "poseanim": 808, "xan2d": 96, "yan2d": 1, "zan2d": 0}
+    # The renderer does not report back per job, so a job counts as done if its "[playerkit]_[colorkit].png" file
+    # was written while the renderer ran.
+
+    def __init__(self, cache: str, outdir: str, shard_size: int = DEFAULT_SHARD_SIZE):
+        super().__init__(cache, outdir)
+        self.batch_size = shard_size
+
+    def render(self, job: RenderJob) -> JobOutcome:
+        return self.render_batch([job])[0]
+
+    def render_batch(self, jobs: List[RenderJob]) -> List[JobOutcome]:
+        fd, manifest_path = tempfile.mkstemp(prefix='render_manifest_', suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as manifest:
+                for job in jobs:
+                    manifest.write(json.dumps(job.get_manifest_entry(self.outdir)) + '\n')
+            started = time.time()
+            command = RENDERER_COMMAND + ['--cache', self.cache, MANIFEST_FLAG, manifest_path]
+            process = subprocess.Popen(command)
+            spawn = time.time() - started
+            returncode = process.wait()
+            finished = time.time()
+        finally:
+            os.remove(manifest_path)
+
+        outcomes = []
+        for job in jobs:
+            output_path = job.get_output_path(self.outdir)
+            # Truncate to whole seconds, some filesystems only keep second precision mtimes
+            ok = output_path.is_file() and output_path.stat().st_mtime >= int(started)
+            error = '' if ok else f'No render written, renderer exited with status {returncode}'
+            outcomes.append(JobOutcome(job=job, ok=ok, exit_status=returncode, started=started, finished=finished,
+                                       error=error, spawn=spawn))
+        return outcomes
+
+
+WORKER_TYPES: Dict[str, Type[RendererWorker]] = {
+    'process': ProcessWorker,
+    'pool': PersistentWorker,
+    'manifest': ManifestWorker,
+}
+
+
+def create_workers(mode: str, cache: str, outdir: str, num_workers: int,
+                   shard_size: int = DEFAULT_SHARD_SIZE) -> List[RendererWorker]:
+    if mode == 'manifest':
+        return [ManifestWorker(cache, outdir, shard_size) for _ in range(num_workers)]
+    return [WORKER_TYPES[mode](cache, outdir) for _ in range(num_workers)]
+
+
+def validate_worker_args(num_jobs: int, shard_size: int) -> bool:
+    # With no renderers, nothing would ever take the jobs off the queue
+    if num_jobs < 1:
+        print('Jobs must be at least 1!')
+        return False
+    if shard_size < 1:
+        print('Shard size must be at least 1!')
+        return False
+    return True
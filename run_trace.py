@@ -0,0 +1,164 @@
+# Per job trace events, end of run summaries and Prometheus metrics for render, rename and check runs
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Slowest jobs listed in a summary
+WORST_OFFENDERS = 5
+QUANTILES = [0.5, 0.9, 0.99]
+METRIC_PREFIX = 'osw_renders'
+# Per job timings that are totalled in the summary and metrics, when a stage's events have them
+TIMING_FIELDS = ['queue_wait', 'spawn', 'render', 'fetch', 'compare']
+# Fields totalled per stage, when a stage's events have them
+SUMMED_FIELDS = TIMING_FIELDS + ['output_bytes', 'bytes_before']
+# Job times kept per stage for the quantiles. A stage with more jobs keeps a uniform random sample of them instead.
+DURATION_SAMPLE_SIZE = 10000
+
+
+class StageStats:
+    # Running totals of the events of a stage, so a trace takes the same memory however many jobs a run has
+
+    def __init__(self):
+        self.num_final = 0
+        self.num_retries = 0
+        self.totals: Dict[str, float] = {}
+        # Sample of the time of every final event, exact up to DURATION_SAMPLE_SIZE events
+        self.durations: List[float] = []
+        # Heap of the slowest final events, with a tie breaker so events never get compared
+        self.slowest: List[Tuple[float, int, Dict[str, Any]]] = []
+        self.num_failed = 0
+        # The first failed final events
+        self.failed: List[Dict[str, Any]] = []
+
+    def add(self, event: Dict[str, Any]):
+        for field in SUMMED_FIELDS:
+            if field in event:
+                self.totals[field] = self.totals.get(field, 0) + (event[field] or 0)
+        # Attempts that failed but were retried only count towards the totals
+        if not event.get('final', True):
+            self.num_retries += 1
+            return
+        self.num_final += 1
+        if not event['ok']:
+            self.num_failed += 1
+            if len(self.failed) < WORST_OFFENDERS:
+                self.failed.append(event)
+        duration = event['duration']
+        if len(self.durations) < DURATION_SAMPLE_SIZE:
+            self.durations.append(duration)
+        else:
+            # Every event so far has the same chance of being in the sample
+            position = random.randrange(self.num_final)
+            if position < DURATION_SAMPLE_SIZE:
+                self.durations[position] = duration
+        if len(self.slowest) < WORST_OFFENDERS:
+            heapq.heappush(self.slowest, (duration, self.num_final, event))
+        else:
+            heapq.heappushpop(self.slowest, (duration, self.num_final, event))
+
+    def get_quantiles(self) -> List[float]:
+        return np.quantile(self.durations, QUANTILES).tolist()
+
+    def get_slowest(self) -> List[Dict[str, Any]]:
+        return [event for _, _, event in sorted(self.slowest, reverse=True)]
+
+
+class RunTrace:
+    # Keeps running totals of the events of every stage, for the summaries and metrics. Events are appended to a JSONL
+    # file as they happen, if a trace path is given, so a trace is still useful when a run dies part way through.
+
+    def __init__(self, trace_path: Optional[str] = None):
+        self.stats: Dict[str, StageStats] = {}
+        self.stage_times: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+        self.trace_file = open(trace_path, 'a') if trace_path else None
+
+    def start_stage(self, stage: str):
+        self.stage_times[stage] = [time.time(), time.time()]
+        self.stats.setdefault(stage, StageStats())
+
+    def end_stage(self, stage: str):
+        self.stage_times[stage][1] = time.time()
+
+    def emit(self, stage: str, **fields: Any):
+        event = {'stage': stage, 'time': time.time(), **fields}
+        with self.lock:
+            self.stats.setdefault(stage, StageStats()).add(event)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(event) + '\n')
+                self.trace_file.flush()
+
+    def get_stats(self, stage: str) -> StageStats:
+        return self.stats.get(stage) or StageStats()
+
+    def get_stage_seconds(self, stage: str) -> float:
+        started, finished = self.stage_times.get(stage, [0.0, 0.0])
+        return finished - started
+
+    def print_summary(self, stage: str):
+        stats = self.get_stats(stage)
+        if not stats.num_final:
+            return
+        seconds = self.get_stage_seconds(stage)
+        rate = stats.num_final / seconds if seconds else 0.0
+        retry_text = f', {stats.num_retries} retried attempts' if stats.num_retries else ''
+        print(f'{stage.capitalize()} summary: {stats.num_final} jobs in {seconds:.1f}s ({rate:.1f}/s), '
+              f'{stats.num_failed} failed{retry_text}')
+        quantiles = ', '.join(f'p{int(q * 100)} {value:.3f}s' for q, value in zip(QUANTILES, stats.get_quantiles()))
+        print(f'  Job time: {quantiles}')
+        totals = ', '.join(f'{field} {stats.totals[field]:.1f}s' for field in TIMING_FIELDS if field in stats.totals)
+        if totals:
+            print(f'  Total time in: {totals}')
+        print('  Slowest jobs:')
+        for event in stats.get_slowest():
+            print(f'    Id {event.get("item_id")}: {event["duration"]:.3f}s {event.get("name", "")}')
+        for event in stats.failed:
+            exit_status = f' (exit status {event["exit_status"]})' if event.get('exit_status') is not None else ''
+            print(f'  Failed: Id {event.get("item_id")} {event.get("name", "")}{exit_status} {event.get("error", "")}')
+
+    def write_metrics(self, path: str):
+        # Prometheus textfile collector format, written in one go so the collector never sees half a file
+        lines = []
+
+        def add(name: str, help_text: str, values: List[Any]):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            for labels, value in values:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{METRIC_PREFIX}_{name}{{{label_text}}} {value}' if label_text else
+                             f'{METRIC_PREFIX}_{name} {value}')
+
+        stages = sorted(self.stats)
+        add('jobs', 'Jobs in the last run, by stage and result',
+            [({'stage': stage, 'result': result}, self.stats[stage].num_failed if result == 'failed' else
+              self.stats[stage].num_final - self.stats[stage].num_failed)
+             for stage in stages for result in ['ok', 'failed']])
+        add('retries', 'Failed attempts that were retried in the last run',
+            [({'stage': stage}, self.stats[stage].num_retries) for stage in stages])
+        add('stage_seconds', 'Wall clock time of each stage in the last run',
+            [({'stage': stage}, self.get_stage_seconds(stage)) for stage in stages])
+        add('job_seconds', 'Time per job in the last run',
+            [({'stage': stage, 'quantile': q}, value) for stage in stages if self.stats[stage].num_final
+             for q, value in zip(QUANTILES, self.stats[stage].get_quantiles())])
+        add('time_seconds', 'Total time jobs spent in each step in the last run',
+            [({'stage': stage, 'step': field}, self.stats[stage].totals[field])
+             for stage in stages for field in TIMING_FIELDS if field in self.stats[stage].totals])
+        add('output_bytes', 'Bytes written by the last run',
+            [({'stage': stage}, self.stats[stage].totals.get('output_bytes', 0)) for stage in stages])
+        add('last_run_timestamp_seconds', 'When the last run finished', [({}, time.time())])
+
+        tmp_path = Path(f'{path}.tmp')
+        tmp_path.write_text('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
@@ -0,0 +1,212 @@
+import dataclasses
+import itertools
+import os
+import threading
+import time
+from queue import Empty, PriorityQueue
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from concurrency import ConcurrencyController
+from render_jobs import JobOutcome, RenderJob
+from render_timings import RenderTimings
+from renderer import RendererWorker
+
+DEFAULT_JOBS = os.cpu_count() or 1
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds to wait before the first retry of a failed job, doubling with every attempt after that
+DEFAULT_RETRY_BACKOFF = 2.0
+MAX_RETRY_BACKOFF = 60.0
+# Sorts after every real job so workers only see it once the queue is drained
+STOP_PRIORITY = float('inf')
+# Progress bar with the estimate from the render timings in place of tqdm's own, which assumes every job takes as long
+TIMED_BAR_FORMAT = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}{postfix}]'
+
+
+class RenderScheduler:
+    # Runs render jobs of every type from a single priority queue, one thread per renderer worker. With a controller,
+    # only as many workers as it allows take jobs, the rest wait with their renderers closed. With render timings, the
+    # jobs expected to take longest go first, so no long job starts near the end and holds up the whole run.
+
+    def __init__(self, workers: List[RendererWorker], on_outcome: Optional[Callable[[JobOutcome], None]] = None,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+                 controller: Optional[ConcurrencyController] = None, timings: Optional[RenderTimings] = None,
+                 keep_outcomes: bool = True):
+        # on_outcome gets the outcome of every attempt, not just the final one. Without keep_outcomes, run only returns
+        # the failed ones.
+        self.workers = workers
+        self.controller = controller
+        self.timings = timings
+        # Expected seconds of the jobs still to do and of the jobs done, for the estimate of when the run finishes
+        self.remaining_seconds = 0.0
+        self.done_seconds = 0.0
+        self.started = 0.0
+        self.on_outcome = on_outcome
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.jobs: PriorityQueue = PriorityQueue()
+        # Tie breaker so equal priority jobs keep their order and jobs themselves never get compared
+        self.counter = itertools.count()
+        self.outcomes: List[JobOutcome] = []
+        self.keep_outcomes = keep_outcomes
+        # Limits the jobs taken from the iterable that do not have a final outcome yet, when streaming
+        self.in_flight: Optional[threading.Semaphore] = None
+        self.lock = threading.Lock()
+        # Jobs that have not had their final outcome yet, including ones waiting to be retried
+        self.pending = 0
+        self.all_done = threading.Condition(self.lock)
+        self.progress: Optional[tqdm] = None
+
+    def get_priority(self, job: RenderJob) -> float:
+        if self.timings is None:
+            return job.get_priority()
+        return -self.timings.estimate(job)
+
+    def put(self, job: RenderJob, attempt: int = 1):
+        self.jobs.put((self.get_priority(job), next(self.counter), job, time.time(), attempt))
+
+    def update_estimate(self, job: RenderJob):
+        # Going by how much expected work got done so far, rather than how many jobs, takes care of the number of
+        # workers, batching and estimates that are off by the same amount
+        if self.timings is None:
+            return
+        seconds = self.timings.estimate(job)
+        self.remaining_seconds -= seconds
+        self.done_seconds += seconds
+        elapsed = time.time() - self.started
+        # Nothing to go by when the number of jobs is not known up front
+        if self.done_seconds and elapsed and self.progress.total is not None:
+            eta = max(0.0, self.remaining_seconds) * elapsed / self.done_seconds
+            self.progress.set_postfix_str(f'eta {tqdm.format_interval(eta)}', refresh=False)
+
+    def retry(self, outcome: JobOutcome):
+        delay = min(self.retry_backoff * 2 ** (outcome.attempt - 1), MAX_RETRY_BACKOFF)
+        job = outcome.job
+        print(f'Id {job.item_id}: {"female" if job.is_female else "male"} {job.render_type} render failed '
+              f'({outcome.error}), retrying in {delay:.1f}s')
+        # Wait off the queue, so the workers carry on with other jobs in the meantime
+        timer = threading.Timer(delay, self.put, args=(job, outcome.attempt + 1))
+        timer.daemon = True
+        timer.start()
+
+    def take_batch(self, batch_size: int) -> List[Tuple[Optional[RenderJob], float, int]]:
+        # Block for the first job, then top up the batch with whatever is already waiting, up to an even share per
+        # worker of the jobs not done yet, so the first worker to ask does not take every job while the others sit idle
+        # Returns (job, time it was queued, attempt) tuples
+        batch = [self.jobs.get()[2:]]
+        with self.lock:
+            batch_size = min(batch_size, max(1, -(-self.pending // len(self.workers))))
+        while batch[-1][0] is not None and len(batch) < batch_size:
+            try:
+                batch.append(self.jobs.get_nowait()[2:])
+            except Empty:
+                break
+        return batch
+
+    def call_on_outcome(self, outcome: JobOutcome) -> JobOutcome:
+        # Outside the lock, so a slow callback does not hold up the other workers. A callback that raises, e.g. on a
+        # render the renderer said it wrote but did not, turns the outcome into a final failure, which the callback
+        # then gets as well.
+        if self.on_outcome is None:
+            return outcome
+        try:
+            self.on_outcome(outcome)
+            return outcome
+        except Exception as e:
+            failed = dataclasses.replace(outcome, ok=False, final=True, error=f'Could not record render: {e!r}')
+        try:
+            self.on_outcome(failed)
+        except Exception as e:
+            print(f'Could not record failed render of id {failed.job.item_id}: {e!r}')
+        return failed
+
+    def record(self, outcome: JobOutcome):
+        outcome.final = outcome.ok or outcome.attempt >= self.max_attempts
+        outcome = self.call_on_outcome(outcome)
+        with self.lock:
+            if self.controller is not None and outcome.ok:
+                self.controller.record(outcome.get_duration())
+            if not outcome.final:
+                self.retry(outcome)
+                return
+            try:
+                if self.keep_outcomes or not outcome.ok:
+                    self.outcomes.append(outcome)
+                if self.in_flight is not None:
+                    self.in_flight.release()
+                if self.progress is not None:
+                    self.update_estimate(outcome.job)
+                    self.progress.update(1)
+            finally:
+                # Whatever else goes wrong, run must not wait on this job forever
+                self.pending -= 1
+                if not self.pending:
+                    self.all_done.notify_all()
+
+    def work(self, index: int, worker: RendererWorker):
+        while True:
+            if self.controller is not None:
+                self.controller.wait_for_slot(index, worker.close)
+            batch = self.take_batch(worker.batch_size)
+            stop = batch[-1][0] is None
+            jobs = [job for job, _, _ in batch if job is not None]
+            if jobs:
+                try:
+                    outcomes = worker.render_batch(jobs)
+                except Exception as e:
+                    now = time.time()
+                    outcomes = [JobOutcome(job=job, ok=False, started=now, finished=now, error=repr(e))
+                                for job in jobs]
+                for outcome, (_, queued, attempt) in zip(outcomes, batch):
+                    outcome.queued = queued
+                    outcome.attempt = attempt
+                    self.record(outcome)
+            if stop:
+                return
+
+    def add_job(self, job: RenderJob):
+        if self.in_flight is not None:
+            self.in_flight.acquire()
+        with self.lock:
+            self.pending += 1
+            if self.timings is not None:
+                self.remaining_seconds += self.timings.estimate(job)
+        self.put(job)
+
+    def run(self, jobs: Iterable[RenderJob], total: Optional[int] = None,
+            max_in_flight: Optional[int] = None) -> List[JobOutcome]:
+        # With max_in_flight, jobs are only taken from the iterable as earlier ones finish, so a generator of jobs is
+        # never read further ahead than that
+        self.progress = tqdm(total=total, desc='Rendering', bar_format=TIMED_BAR_FORMAT if self.timings else None)
+        self.started = time.time()
+        if self.controller is not None:
+            self.controller.start()
+        threads = [threading.Thread(target=self.work, args=(index, worker))
+                   for index, worker in enumerate(self.workers)]
+        if max_in_flight is None:
+            # Queue every job before the workers start, so the first jobs they take are the highest priority ones
+            for job in jobs:
+                self.add_job(job)
+            for t in threads:
+                t.start()
+        else:
+            self.in_flight = threading.Semaphore(max_in_flight)
+            for t in threads:
+                t.start()
+            for job in jobs:
+                self.add_job(job)
+        # Retries go back on the queue, so the workers can only be stopped once every job has its final outcome
+        with self.all_done:
+            self.all_done.wait_for(lambda: not self.pending)
+        if self.controller is not None:
+            self.controller.stop()
+        # One stop marker per worker
+        for _ in threads:
+            self.jobs.put((STOP_PRIORITY, next(self.counter), None, 0.0, 0))
+        for t in threads:
+            t.join()
+        for worker in self.workers:
+            worker.close()
+        self.progress.close()
+        return self.outcomes
@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclass
+class Shard:
+    # Shard number of number of shards, both counted from 1 like on the command line
+    index: int
+    count: int
+
+    def select(self, jobs: List[T]) -> List[T]:
+        # Deal the jobs out round-robin, so every shard gets a share of every part of the sheet. Cutting the sheet into
+        # contiguous id ranges would give some shards all of the slow jobs, like the sets at the end.
+        return jobs[self.index - 1::self.count]
+
+    def includes(self, position: int) -> bool:
+        # Whether the job at position (from 0) of the whole list of jobs is in this shard, for jobs that come one at a
+        # time
+        return position % self.count == self.index - 1
+
+    def get_suffix(self) -> str:
+        return f'_{self.index}of{self.count}'
+
+    def __str__(self):
+        return f'{self.index}/{self.count}'
+
+
+def parse_shard(shard_arg: str) -> Shard:
+    index, count = (int(part) for part in shard_arg.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError(shard_arg)
+    return Shard(index, count)
+
+
+def validate_shard(shard_arg: str) -> bool:
+    try:
+        parse_shard(shard_arg)
+    except ValueError:
+        print('Shard must be given as K/N, where K is between 1 and N!')
+        return False
+    return True
+
+
+def get_shard_path(path: Path, shard: Optional[Shard]) -> Path:
+    # Each shard keeps its own manifest, journal and failure report, so shards can share an outdir
+    if shard is None:
+        return path
+    return path.with_name(f'{path.stem}{shard.get_suffix()}{path.suffix}')
+
+
+def find_shard_paths(path: Path) -> List[Path]:
+    # Paths of every shard's copy of the file
+    return sorted(path.parent.glob(f'{path.stem}_*of*{path.suffix}'))
+
+
+def get_path_shard(path: Path, unsharded_path: Path) -> Shard:
+    # Reads the shard back out of a path made by get_shard_path
+    index, count = path.stem[len(unsharded_path.stem) + 1:].split('of')
+    return Shard(int(index), int(count))
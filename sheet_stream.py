@@ -0,0 +1,137 @@
+# Read a render sheet a row at a time, for sheets too big to hold in memory
+import csv
+import dataclasses
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterator, List, Optional
+
+from equipped_render import EquippedRender
+from item_sets import SheetIndex, create_set_jobs, load_sets
+from render_jobs import JobOutcome, RenderJob, create_jobs
+from shards import Shard
+
+# Most KiB of seen render keys to keep in memory, the rest stays on disk
+SEEN_CACHE_KIB = 8192
+
+
+def iter_sheet_jobs(infile: str, only_gender: Optional[str], only_render: Optional[str],
+                    only_ids: Optional[List[int]], set_list: Optional[str] = None) -> Iterator[RenderJob]:
+    # The same jobs in the same order as create_renders.load_plan, without ever holding more than one row
+    wanted_ids = set(only_ids) if only_ids is not None else None
+    with open(infile, 'r', newline='') as f:
+        for line in csv.DictReader(f, dialect='excel'):
+            render = EquippedRender.from_dict(line)
+            if wanted_ids is None or render.item_id in wanted_ids:
+                yield from create_jobs(render, only_gender, only_render)
+    if set_list:
+        sets = load_sets(set_list)
+        index = SheetIndex(infile, {item_id for item_set in sets for item_id in item_set.item_ids})
+        yield from create_set_jobs(index, sets, only_gender, only_render)
+
+
+class SeenKeys:
+    # Digest of every render key read so far, and whether it is in this shard, in a temporary SQLite database so the
+    # memory it takes stays the same however many renders the sheet has. SQLite deletes the file when it is closed.
+
+    def __init__(self):
+        # Only ever read back by this run, so nothing needs to survive a crash
+        self.connection = sqlite3.connect('', isolation_level=None)
+        self.connection.execute(f'PRAGMA cache_size=-{SEEN_CACHE_KIB}')
+        self.connection.execute('PRAGMA journal_mode=OFF')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE seen (digest BLOB PRIMARY KEY, in_shard INTEGER NOT NULL) WITHOUT ROWID')
+
+    def get(self, digest: bytes) -> Optional[bool]:
+        # Whether the render is in this shard, or None if it was not seen yet
+        row = self.connection.execute('SELECT in_shard FROM seen WHERE digest = ?', (digest,)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def add(self, digest: bytes, in_shard: bool):
+        self.connection.execute('INSERT INTO seen VALUES (?, ?)', (digest, in_shard))
+
+    def close(self):
+        self.connection.close()
+
+
+class StreamPlan:
+    # Stands in for a RenderPlan when jobs come from a stream. Rows that share a render are still rendered once, but
+    # only the jobs of renders that are still being worked on are kept in memory. Every other render is remembered as
+    # the 20 byte digest of its key in SeenKeys. A row that turns up after its render is finished is handed to
+    # on_duplicate straight away.
+
+    def __init__(self, jobs: Iterator[RenderJob], shard: Optional[Shard] = None):
+        self.jobs = jobs
+        self.shard = shard
+        # Jobs of every render still being worked on
+        self.jobs_by_key: Dict[str, List[RenderJob]] = {}
+        # Final outcome of every render that failed, failures are rare enough to keep
+        self.failed: Dict[str, JobOutcome] = {}
+        # Outcomes for rows of failed renders that turned up after the render failed
+        self.late_failures: List[JobOutcome] = []
+        # Jobs and renders of this shard, and renders of the whole sheet read so far
+        self.num_jobs = 0
+        self.num_unique = 0
+        self.num_renders = 0
+        self.lock = threading.Lock()
+
+    def get_num_saved(self) -> int:
+        return self.num_jobs - self.num_unique
+
+    def iter_unique_jobs(self, on_duplicate: Optional[Callable[[RenderJob], None]] = None) -> Iterator[RenderJob]:
+        # Yields the first job of every render in this shard. on_duplicate gets each later job of a render that was
+        # already finished.
+        seen = SeenKeys()
+        try:
+            yield from self.select_unique_jobs(seen, on_duplicate)
+        finally:
+            seen.close()
+
+    def select_unique_jobs(self, seen: SeenKeys,
+                           on_duplicate: Optional[Callable[[RenderJob], None]]) -> Iterator[RenderJob]:
+        for job in self.jobs:
+            key = job.get_render_key()
+            digest = bytes.fromhex(key)
+            in_shard = seen.get(digest)
+            with self.lock:
+                if in_shard:
+                    self.num_jobs += 1
+                    if key in self.jobs_by_key:
+                        self.jobs_by_key[key].append(job)
+                        continue
+                    if key in self.failed:
+                        self.late_failures.append(dataclasses.replace(self.failed[key], job=job))
+                        continue
+                    done = True
+                elif in_shard is not None:
+                    continue
+                else:
+                    done = False
+                    # Dealt out like Shard.select deals out the unique jobs of a whole plan
+                    position = self.num_renders
+                    self.num_renders += 1
+                    in_shard = self.shard is None or self.shard.includes(position)
+                    seen.add(digest, in_shard)
+                    if not in_shard:
+                        continue
+                    self.num_jobs += 1
+                    self.num_unique += 1
+                    self.jobs_by_key[key] = [job]
+            if done:
+                if on_duplicate is not None:
+                    on_duplicate(job)
+                continue
+            yield job
+
+    def finish(self, key: str) -> List[RenderJob]:
+        # The render is on disk, returns every job that shares it
+        with self.lock:
+            return self.jobs_by_key.pop(key)
+
+    def fan_out(self, outcome: JobOutcome) -> List[JobOutcome]:
+        # Only for final failed outcomes, finished renders go through finish. A render that failed after it was
+        # finished, e.g. because on_ready raised, is only down as failed for the job it failed with.
+        key = outcome.job.get_render_key()
+        with self.lock:
+            self.failed[key] = outcome
+            jobs = self.jobs_by_key.pop(key, [outcome.job])
+        return [dataclasses.replace(outcome, job=job) for job in jobs]
@@ -0,0 +1,57 @@
+# Looks up file metadata through the wiki's MediaWiki API, without downloading the files
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+from wiki_mirror import DEFAULT_REQUESTS_PER_SECOND, REQUEST_TIMEOUT, RateLimiter, create_session
+
+WIKI_API_URL = os.environ.get('WIKI_API_URL', 'https://oldschool.runescape.wiki/api.php')
+# Most titles the API accepts in one query
+IMAGEINFO_BATCH_SIZE = 50
+
+
+@dataclass
+class RemoteFile:
+    sha1: str
+    size: int
+
+
+class WikiApi:
+
+    def __init__(self, user_agent: str, api_url: str = WIKI_API_URL,
+                 requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND):
+        self.api_url = api_url
+        self.session = create_session(user_agent, 1)
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+    def query_file_batch(self, file_names: List[str]) -> Dict[str, RemoteFile]:
+        titles = {f'File:{file_name}': file_name for file_name in file_names}
+        params = {'action': 'query', 'format': 'json', 'formatversion': '2', 'prop': 'imageinfo',
+                  'iiprop': 'sha1|size', 'titles': '|'.join(titles)}
+        self.rate_limiter.wait()
+        resp = self.session.get(self.api_url, params=params, timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        query = resp.json().get('query', {})
+
+        # The API answers with normalized titles (spaces instead of underscores etc.), map them back to our names
+        for normalized in query.get('normalized', []):
+            if normalized['from'] in titles:
+                titles[normalized['to']] = titles.pop(normalized['from'])
+        files = {}
+        for page in query.get('pages', []):
+            if page.get('missing') or not page.get('imageinfo') or page.get('title') not in titles:
+                continue
+            info = page['imageinfo'][0]
+            files[titles[page['title']]] = RemoteFile(sha1=info['sha1'], size=info['size'])
+        return files
+
+    def get_files(self, file_names: Iterable[str]) -> Dict[str, RemoteFile]:
+        # Files missing from the wiki are left out
+        file_names = sorted(set(file_name for file_name in file_names if file_name))
+        files = {}
+        for i in range(0, len(file_names), IMAGEINFO_BATCH_SIZE):
+            files.update(self.query_file_batch(file_names[i:i + IMAGEINFO_BATCH_SIZE]))
+        return files
+
+    def close(self):
+        self.session.close()
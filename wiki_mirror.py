@@ -0,0 +1,131 @@
+# Local mirror of wiki images that only downloads images that changed since they were last fetched
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+WIKI_IMAGES_URL = os.environ.get('WIKI_IMAGES_URL', 'https://oldschool.runescape.wiki/images')
+# ETag and Last-Modified of each mirrored image are kept here, inside the mirror dir, along with its pixel hash once it
+# was compared
+METADATA_DIR = '.metadata'
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+REQUEST_TIMEOUT = 30
+
+
+class RateLimiter:
+    # Spaces out calls so there are at most rate per second, across every thread
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def create_session(user_agent: str, max_connections: int) -> requests.Session:
+    # One pooled session so connections are reused between requests
+    session = requests.Session()
+    session.headers['User-agent'] = user_agent
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class WikiMirror:
+
+    def __init__(self, mirror_dir: str, user_agent: str, base_url: str = WIKI_IMAGES_URL,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND):
+        self.mirror_dir = Path(mirror_dir)
+        self.metadata_dir = self.mirror_dir.joinpath(METADATA_DIR)
+        self.metadata_dir.mkdir(parents=True, exist_ok=True)
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = create_session(user_agent, max_connections)
+
+    def get_url(self, file_name: str) -> str:
+        # Images live under /[first hex of md5]/[first two hex of md5]/, hashed on the underscored name
+        db_key = file_name.replace(' ', '_')
+        md5_val = hashlib.md5(db_key.encode('utf-8')).hexdigest()
+        return f'{self.base_url}/{md5_val[:1]}/{md5_val[:2]}/{quote(db_key)}'
+
+    def get_path(self, file_name: str) -> Path:
+        return self.mirror_dir.joinpath(file_name)
+
+    def get_metadata_path(self, file_name: str) -> Path:
+        return self.metadata_dir.joinpath(f'{file_name}.json')
+
+    def fetch(self, file_name: str) -> Optional[Path]:
+        # Returns the path of the up to date image, or None if the wiki does not have it
+        if not file_name:
+            return None
+        path = self.get_path(file_name)
+        metadata_path = self.get_metadata_path(file_name)
+        headers = {}
+        if path.is_file() and metadata_path.is_file():
+            metadata = json.load(open(metadata_path, 'r'))
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        with self.connections:
+            self.rate_limiter.wait()
+            resp = self.session.get(self.get_url(file_name), headers=headers, timeout=REQUEST_TIMEOUT)
+
+        if resp.status_code == 304:
+            return path
+        if resp.status_code == 200:
+            tmp_path = path.with_name(f'{path.name}.part')
+            with open(tmp_path, 'wb') as out_file:
+                out_file.write(resp.content)
+            os.replace(tmp_path, path)
+            with open(metadata_path, 'w') as f:
+                json.dump({'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}, f)
+            return path
+        if resp.status_code == 404:
+            # Deleted from the wiki, so the mirrored copy is stale
+            path.unlink(missing_ok=True)
+            metadata_path.unlink(missing_ok=True)
+        return None
+
+    def get_pixel_hash(self, file_name: str, sha1: str) -> Optional[str]:
+        # Pixel hash of the mirrored image, if it is known for the wiki file with the given SHA-1
+        metadata_path = self.get_metadata_path(file_name)
+        if not metadata_path.is_file():
+            return None
+        metadata = json.load(open(metadata_path, 'r'))
+        return metadata.get('pixel_sha1') if metadata.get('sha1') == sha1 else None
+
+    def set_pixel_hash(self, file_name: str, sha1: str, pixel_sha1: str):
+        # Downloading the image again writes new metadata, which drops the pixel hash along with the old image
+        metadata_path = self.get_metadata_path(file_name)
+        if not metadata_path.is_file():
+            return
+        metadata = json.load(open(metadata_path, 'r'))
+        metadata.update(sha1=sha1, pixel_sha1=pixel_sha1)
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+
+    def close(self):
+        self.session.close()